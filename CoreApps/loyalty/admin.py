@@ -4,7 +4,7 @@ from .models import LoyaltyCard, LoyaltyLog
 class LoyaltyLogInline(admin.TabularInline):
     model = LoyaltyLog
     extra = 1
-    readonly_fields = ('timestamp',)
+    readonly_fields = ('appointment', 'timestamp')
 
 @admin.register(LoyaltyCard)
 class LoyaltyCardAdmin(admin.ModelAdmin):
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.25 on 2026-10-18 10:57
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scheduling', '0011_appointment_reminder_sent_at'),
+        ('loyalty', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='loyaltylog',
+            name='appointment',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='loyalty_logs', to='scheduling.appointment'),
+        ),
+        migrations.AddConstraint(
+            model_name='loyaltylog',
+            constraint=models.UniqueConstraint(condition=models.Q(('appointment__isnull', False)), fields=('appointment',), name='loyalty_log_appointment_uniq'),
+        ),
+    ]
@@ -17,7 +17,18 @@ class LoyaltyLog(models.Model):
     card = models.ForeignKey(LoyaltyCard, on_delete=models.CASCADE, related_name='logs')
     points_change = models.IntegerField()
     reason = models.CharField(max_length=255, help_text="Ej: 'Cita completada', 'Bono de bienvenida'")
+    # Cita que originó los puntos (vacío para ajustes manuales). Única: una cita suma una sola vez
+    appointment = models.ForeignKey(
+        'scheduling.Appointment', on_delete=models.SET_NULL, null=True, blank=True, related_name='loyalty_logs'
+    )
     timestamp = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['appointment'], condition=models.Q(appointment__isnull=False), name='loyalty_log_appointment_uniq'
+            ),
+        ]
+
     def __str__(self):
         return f"{self.points_change} puntos para {self.card.customer} por {self.reason}"
\ No newline at end of file
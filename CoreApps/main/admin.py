@@ -1,3 +1,19 @@
 from django.contrib import admin
+from django.utils import timezone
+from .models import OutboxMessage
 
 # Register your models here.
+
+
+@admin.register(OutboxMessage)
+class OutboxMessageAdmin(admin.ModelAdmin):
+    list_display = ('recipient', 'channel', 'status', 'attempts', 'next_attempt_at', 'sent_at', 'created_at')
+    list_filter = ('status', 'channel')
+    search_fields = ('recipient', 'dedupe_key')
+    readonly_fields = ('created_at', 'sent_at', 'last_error')
+    actions = ['retry_messages']
+
+    @admin.action(description="Reintentar envío ahora")
+    def retry_messages(self, request, queryset):
+        updated = queryset.exclude(status='SENT').update(status='PENDING', attempts=0, next_attempt_at=timezone.now())
+        self.message_user(request, f"{updated} mensaje(s) vuelven a la cola.")
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class MainConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'CoreApps.main'
+
+    def ready(self):
+        # Registra las señales de invalidación de caché (slots de disponibilidad)
+        from . import signals  # noqa: F401
@@ -0,0 +1,144 @@
+# CoreApps/main/booking.py
+
+from datetime import timedelta
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
+from CoreApps.users.models import StaffMember
+from CoreApps.scheduling.models import Appointment, SlotHold, TimeOffBlock
+from .slot_cache import invalidate_staff_interval
+from .utils import get_block_duration
+
+# Tiempo que un horario queda retenido mientras el cliente llena el formulario de confirmación
+SLOT_HOLD_TTL = getattr(settings, 'SLOT_HOLD_TTL', 5 * 60)
+
+
+class SlotUnavailable(Exception):
+    """ El horario pedido ya no está libre para ese miembro del personal. """
+
+
+def lock_staff_member(staff_member_id):
+    """
+    Bloquea la fila del miembro del personal (SELECT ... FOR UPDATE) hasta que termine la transacción.
+    Dos reservas para el MISMO staff se ejecutan una detrás de otra; las de staff distintos
+    no se esperan entre sí. (En SQLite FOR UPDATE no existe: ahí la propia base de datos
+    ya admite un solo escritor a la vez.)
+    """
+    return StaffMember.objects.select_for_update().only('pk').get(pk=staff_member_id)
+
+
+def active_holds(staff_member, start_time, end_time, now=None):
+    """ Reservas temporales vigentes del staff que se cruzan con el intervalo. """
+    return SlotHold.objects.filter(
+        staff_member=staff_member,
+        start_time__lt=end_time,
+        end_time__gt=start_time,
+        expires_at__gt=now or timezone.now()
+    )
+
+
+def reap_expired_holds(now=None, staff_member=None):
+    """
+    Borra las reservas temporales vencidas (de un solo staff si se indica, como hace place_hold
+    con el staff que tiene bloqueado). No es urgente: el motor de slots ya ignora las vencidas
+    y las listas en caché vencen con ellas, así que se borran con un solo DELETE, sin post_delete
+    por fila ni invalidaciones. Devuelve cuántas se borraron.
+    """
+    holds = SlotHold.objects.filter(expires_at__lte=now or timezone.now())
+    if staff_member is not None:
+        holds = holds.filter(staff_member=staff_member)
+    return holds._raw_delete(holds.db)
+
+
+def release_holds(holder):
+    """
+    Libera las reservas temporales de un cliente (ej: volvió a elegir horario).
+    Un solo DELETE (sin post_delete por fila) y luego se invalidan los días que tocaban,
+    ahora y al confirmar la transacción, como hacen las señales.
+    """
+    if not holder:
+        return
+    holds = SlotHold.objects.filter(holder=holder)
+    intervals = set(holds.values_list('staff_member_id', 'start_time', 'end_time'))
+    if not intervals:
+        return
+    holds._raw_delete(holds.db)
+
+    def invalidate():
+        for interval in intervals:
+            invalidate_staff_interval(*interval)
+
+    invalidate()
+    transaction.on_commit(invalidate)
+
+
+def place_hold(staff_member, service, start_time, holder, is_domicilio=False, ttl=None):
+    """
+    Retiene el horario para 'holder' durante 'ttl' segundos (SLOT_HOLD_TTL por defecto).
+    Retiene lo mismo que bloquea el motor de slots: la duración del servicio más el buffer
+    de traslado si es a domicilio (ver get_block_duration).
+    Cada cliente retiene un solo horario: el anterior se libera.
+    Lanza SlotUnavailable si el horario ya está ocupado o retenido por otro cliente.
+    """
+    end_time = start_time + get_block_duration(service, staff_member.business if is_domicilio else None, is_domicilio)
+    now = timezone.now()
+    with transaction.atomic():
+        lock_staff_member(staff_member.pk)
+        reap_expired_holds(now, staff_member)
+        release_holds(holder)
+
+        busy = (
+            Appointment.blocking_appointments().filter(
+                staff_member=staff_member, start_time__lt=end_time, end_time__gt=start_time
+            ).exists()
+            or TimeOffBlock.objects.filter(
+                staff_member=staff_member, start_time__lt=end_time, end_time__gt=start_time
+            ).exists()
+            or active_holds(staff_member, start_time, end_time, now).exists()
+        )
+        if busy:
+            raise SlotUnavailable("El horario ya está ocupado o retenido por otro cliente.")
+
+        return SlotHold.objects.create(
+            staff_member=staff_member,
+            start_time=start_time,
+            end_time=end_time,
+            holder=holder,
+            expires_at=now + timedelta(seconds=ttl or SLOT_HOLD_TTL)
+        )
+
+
+def book_appointment(business, staff_member, customer, service, start_time, end_time=None,
+                     status='SCHEDULED', holder=None, idempotency_key=None):
+    """
+    Crea una cita sin riesgo de doble reserva: toma el bloqueo del staff y recién entonces
+    verifica los choques (Appointment.clean y reservas temporales de OTROS clientes) y guarda.
+    La reserva temporal del propio 'holder' se consume. La cita guarda la 'idempotency_key'
+    del formulario (única en la base de datos). Si se llama dentro de otra transacción,
+    el bloqueo dura hasta que esa transacción termine.
+    Lanza SlotUnavailable si el horario se cruza con otra cita, un bloqueo de tiempo o una reserva ajena.
+    """
+    end_time = end_time or start_time + service.duration
+    with transaction.atomic():
+        lock_staff_member(staff_member.pk)
+        others_holds = active_holds(staff_member, start_time, end_time)
+        if holder:
+            others_holds = others_holds.exclude(holder=holder)
+        if others_holds.exists():
+            raise SlotUnavailable("El horario está retenido por otro cliente.")
+        try:
+            appointment = Appointment.objects.create(
+                business=business,
+                staff_member=staff_member,
+                customer=customer,
+                service=service,
+                start_time=start_time,
+                end_time=end_time,
+                status=status,
+                idempotency_key=idempotency_key
+            )
+        except ValidationError as e:
+            raise SlotUnavailable(' '.join(e.messages)) from e
+        release_holds(holder)
+        return appointment
@@ -0,0 +1,148 @@
+# CoreApps/main/calendar_feed.py
+
+import json
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.core import signing
+from django.http import HttpResponse
+from django.utils.module_loading import import_string
+from CoreApps.scheduling.models import Appointment
+
+# orjson (serializador JSON rápido) está en requirements.txt; si falta en algún entorno
+# se usa el módulo json estándar, con el mismo resultado
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depende del entorno
+    orjson = None
+
+# Token de sincronización del calendario de citas: el cliente lo devuelve y recibe
+# solo las citas creadas/modificadas/canceladas desde que se emitió.
+SYNC_TOKEN_SALT = 'tivy.calendar.appointments-sync'
+# Un token viejo obliga a recargar todo (evita deltas enormes tras días sin abrir la pestaña)
+SYNC_TOKEN_MAX_AGE = 60 * 60 * 24
+# Margen hacia atrás: una cita guardada justo antes de emitir el token, pero confirmada
+# (commit) después, tiene un updated_at anterior. Repetir unos segundos es barato y no pierde cambios.
+SYNC_TOKEN_OVERLAP = timedelta(seconds=60)
+
+
+class InvalidSyncToken(Exception):
+    """ El token no es válido, venció o pertenece a otro calendario. """
+
+
+def get_appointments_scope(user):
+    """
+    Devuelve (alcance, queryset) de las citas que el usuario puede ver en el calendario:
+    todas las del negocio para el dueño, o solo las propias para un miembro del personal.
+    El alcance ('business:<id>' / 'staff:<id>') se firma dentro del token de sincronización.
+    """
+    if hasattr(user, 'business_profile'):
+        business = user.business_profile
+        return f'business:{business.pk}', Appointment.objects.filter(business=business)
+    if hasattr(user, 'staff_profiles'):
+        staff_member = user.staff_profiles.first()
+        if staff_member:
+            return f'staff:{staff_member.pk}', Appointment.objects.filter(staff_member=staff_member)
+    return 'none', Appointment.objects.none()
+
+
+def make_sync_token(scope, issued_at):
+    """ Firma el alcance y el momento de emisión (tomado ANTES de consultar las citas). """
+    return signing.dumps({'scope': scope, 'since': issued_at.isoformat()}, salt=SYNC_TOKEN_SALT)
+
+
+def read_sync_token(token, scope):
+    """ Valida el token y devuelve el momento desde el que hay que buscar cambios. """
+    try:
+        payload = signing.loads(token, salt=SYNC_TOKEN_SALT, max_age=SYNC_TOKEN_MAX_AGE)
+        since = datetime.fromisoformat(payload['since'])
+    except (signing.BadSignature, KeyError, TypeError, ValueError):
+        raise InvalidSyncToken()
+    if payload.get('scope') != scope:
+        raise InvalidSyncToken()
+    return since
+
+
+def changed_since(queryset, since):
+    """ Citas modificadas desde 'since' (usa el índice sobre (negocio/staff, updated_at)). """
+    return queryset.filter(updated_at__gte=since - SYNC_TOKEN_OVERLAP)
+
+
+# Columnas mínimas que necesita un evento: una sola consulta con JOINs, sin instanciar modelos
+APPOINTMENT_EVENT_FIELDS = (
+    'id', 'start_time', 'end_time', 'status',
+    'service__name', 'service__price',
+    'customer__user__first_name', 'customer__user__last_name', 'customer__user__phone_number',
+    'staff_member__name',
+)
+# Etiquetas y colores por estado, calculados una sola vez (no get_status_display() por fila)
+STATUS_LABELS = dict(Appointment.STATUS_CHOICES)
+STATUS_COLORS = {
+    'COMPLETED': '#198754',
+    'CANCELED': '#dc3545',
+}
+DEFAULT_STATUS_COLOR = '#007bff'
+
+
+def appointment_events(queryset, include_staff=False):
+    """
+    Convierte un queryset de citas al formato de evento de FullCalendar
+    leyendo solo APPOINTMENT_EVENT_FIELDS con values_list().
+    """
+    events = []
+    for (pk, start_time, end_time, status, service_name, service_price,
+         first_name, last_name, phone_number, staff_name) in queryset.values_list(*APPOINTMENT_EVENT_FIELDS):
+        client_name = f"{first_name} {last_name}"
+        title = f"{service_name}\nCliente: {client_name}\n"
+        if include_staff:
+            title += f"Staff: {staff_name}"
+        color = STATUS_COLORS.get(status, DEFAULT_STATUS_COLOR)
+        events.append({
+            'id': pk,
+            'title': title,
+            'start': start_time.isoformat(),
+            'end': end_time.isoformat(),
+            'color': color,
+            'borderColor': color,
+            'extendedProps': {
+                'service_name': service_name,
+                'client_name': client_name,
+                'client_phone': phone_number or "N/A",
+                'staff_name': staff_name,
+                'price': f"${service_price}",
+                'status_display': STATUS_LABELS.get(status, status),
+                'raw_status': status
+            }
+        })
+    return events
+
+
+# --- Serialización JSON ---
+# Los eventos solo contienen tipos básicos (las fechas ya van como texto ISO), así que
+# orjson y json estándar producen el mismo contenido.
+def _dumps_orjson(data):
+    return orjson.dumps(data)
+
+
+def _dumps_stdlib(data):
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def _select_dumps():
+    """
+    Serializador a usar: el indicado en settings.CALENDAR_JSON_DUMPS (ruta 'modulo.funcion'
+    que recibe los datos y devuelve bytes), o orjson si está instalado, o json estándar.
+    """
+    dumps_path = getattr(settings, 'CALENDAR_JSON_DUMPS', None)
+    if dumps_path:
+        return import_string(dumps_path)
+    return _dumps_orjson if orjson is not None else _dumps_stdlib
+
+
+dumps_json = _select_dumps()
+
+
+class FastJsonResponse(HttpResponse):
+    """ Como JsonResponse (con safe=False), pero serializa con dumps_json. """
+    def __init__(self, data, **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(content=dumps_json(data), **kwargs)
@@ -0,0 +1,183 @@
+# CoreApps/main/dashboard_metrics.py
+
+import json
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum, Window
+from django.utils import timezone
+from CoreApps.users.models import Customer
+from CoreApps.scheduling.models import Appointment
+from .models import BusinessDailyMetrics
+from .utils import local_day_bounds
+
+WEEK_DAYS = 7
+TOP_DAYS = 30
+TOP_LIMIT = 5
+UPCOMING_LIMIT = 3
+
+# Segundos que vive el contexto del dashboard en caché. Es corto a propósito: la invalidación
+# por señales cubre las citas y clientes, el TTL cubre lo demás (ej: la hora que avanza).
+DASHBOARD_CACHE_TIMEOUT = getattr(settings, 'DASHBOARD_CACHE_TIMEOUT', 60)
+DASHBOARD_STATS_KEYS = {'hits': 'dashboard:stats:hits', 'misses': 'dashboard:stats:misses'}
+# Leer los KPIs del resumen diario (BusinessDailyMetrics) en vez de las citas. Más barato con
+# mucha historia, pero exige que el resumen esté al día (ver el comando rebuild_daily_metrics).
+DASHBOARD_USE_DAILY_ROLLUP = getattr(settings, 'DASHBOARD_USE_DAILY_ROLLUP', False)
+
+
+def _week_days(today):
+    return [today - timedelta(days=offset) for offset in range(WEEK_DAYS - 1, -1, -1)]
+
+
+def _kpis_and_weekly_series(business, today):
+    """
+    KPIs de hoy y serie de citas completadas por día de la semana, directo de las citas:
+    UNA consulta con un Count/Sum(..., filter=Q(...)) por dato, acotada a la semana con
+    local_day_bounds (usa el índice de negocio + start_time). Los clientes nuevos de la
+    semana son otra consulta. Devuelve (días, totales).
+    """
+    days = _week_days(today)
+    week_start, week_end = local_day_bounds(days[0], today)
+    today_start = local_day_bounds(today)[0]
+    not_canceled_today = Q(start_time__gte=today_start) & ~Q(status='CANCELED')
+    buckets = {}
+    for index, day in enumerate(days):
+        day_start, day_end = local_day_bounds(day)
+        buckets[f'completed_{index}'] = Count(
+            'id', filter=Q(status='COMPLETED', start_time__gte=day_start, start_time__lt=day_end)
+        )
+    totals = Appointment.objects.filter(
+        business=business, start_time__gte=week_start, start_time__lt=week_end
+    ).aggregate(
+        appointments_today=Count('id', filter=not_canceled_today),
+        revenue_today=Sum('service__price', filter=not_canceled_today),
+        **buckets
+    )
+    totals['new_clients_week'] = Customer.objects.filter(
+        business=business, created_at__gte=week_start, created_at__lt=week_end
+    ).count()
+    return days, totals
+
+
+def _kpis_and_weekly_series_from_rollup(business, today):
+    """
+    Lo mismo que _kpis_and_weekly_series, en UNA consulta sobre el resumen diario
+    (activado con DASHBOARD_USE_DAILY_ROLLUP).
+    """
+    days = _week_days(today)
+    buckets = {f'completed_{index}': Sum('completed', filter=Q(date=day)) for index, day in enumerate(days)}
+    totals = BusinessDailyMetrics.objects.filter(business=business, date__gte=days[0], date__lte=today).aggregate(
+        appointments_today=Sum('appointments', filter=Q(date=today)),
+        revenue_today=Sum('revenue', filter=Q(date=today)),
+        new_clients_week=Sum('new_customers'),
+        **buckets
+    )
+    return days, totals
+
+
+def _top_services_and_staff(business, since):
+    """
+    Top de servicios y de staff en UNA pasada: dos COUNT(...) OVER (PARTITION BY ...) sobre las
+    mismas citas y DISTINCT por pareja (servicio, staff). Devuelve ([(nombre, total)], [(nombre, total)]).
+    """
+    pairs = Appointment.objects.filter(business=business, start_time__gte=since).annotate(
+        service_total=Window(Count('id'), partition_by=[F('service__name')]),
+        staff_total=Window(Count('id'), partition_by=[F('staff_member__name')]),
+    ).values_list('service__name', 'service_total', 'staff_member__name', 'staff_total').order_by().distinct()
+
+    services, staff = {}, {}
+    for service_name, service_total, staff_name, staff_total in pairs:
+        services[service_name] = service_total
+        staff[staff_name] = staff_total
+
+    def top(totals):
+        return sorted(totals.items(), key=lambda item: (-item[1], item[0]))[:TOP_LIMIT]
+    return top(services), top(staff)
+
+
+def get_dashboard_metrics(business, now=None):
+    """
+    Contexto de KPIs y gráficos del dashboard de un negocio, listo para la plantilla
+    (los datos de Chart.js ya van como JSON). Son 4 consultas en total: KPIs de la semana,
+    clientes nuevos, top de servicios/staff y próximas citas (3 si los KPIs salen del resumen diario).
+    """
+    now = now or timezone.now()
+    today = timezone.localdate(now)
+    if DASHBOARD_USE_DAILY_ROLLUP:
+        days, totals = _kpis_and_weekly_series_from_rollup(business, today)
+    else:
+        days, totals = _kpis_and_weekly_series(business, today)
+    # Límite "aware" en vez de lookups __date: así se usan los índices sobre start_time
+    top_services, top_staff = _top_services_and_staff(business, local_day_bounds(today - timedelta(days=TOP_DAYS - 1))[0])
+
+    return {
+        # --- 1. KPIs (Tarjetas Superiores) ---
+        'kpi_total_appointments_today': totals['appointments_today'] or 0,
+        'kpi_revenue_today': totals['revenue_today'] or 0,
+        'kpi_new_clients_week': totals['new_clients_week'] or 0,
+        # --- 2. Lista de Próximas Citas ---
+        'upcoming_appointments': list(Appointment.objects.filter(
+            business=business,
+            start_time__gte=now,
+            status='SCHEDULED'
+        ).select_related('service', 'customer', 'staff_member').order_by('start_time')[:UPCOMING_LIMIT]),
+        # --- 3. Datos para Gráficos ---
+        'chart_weekly_labels': json.dumps([day.strftime('%a %d') for day in days]), # Ej: "Lun 27"
+        'chart_weekly_data': json.dumps([totals[f'completed_{index}'] or 0 for index in range(len(days))]),
+        'chart_top_services_labels': json.dumps([name for name, _ in top_services]),
+        'chart_top_services_data': json.dumps([count for _, count in top_services]),
+        'chart_top_staff_labels': json.dumps([name for name, _ in top_staff]),
+        'chart_top_staff_data': json.dumps([count for _, count in top_staff]),
+    }
+
+
+def _dashboard_key(business_id, day):
+    # El día va en la clave: a medianoche "hoy" cambia y la entrada vieja deja de usarse sola
+    return f"dashboard:{business_id}:{day.isoformat()}"
+
+
+def _count(stat):
+    key = DASHBOARD_STATS_KEYS[stat]
+    try:
+        cache.incr(key)
+    except ValueError: # La clave aún no existe (o el backend la descartó)
+        cache.add(key, 0, None)
+        cache.incr(key)
+
+
+def get_dashboard_metrics_cached(business):
+    """
+    Igual que get_dashboard_metrics, pero reutiliza el resultado por negocio durante
+    DASHBOARD_CACHE_TIMEOUT segundos. Cuenta aciertos y fallos (ver dashboard_cache_stats).
+    """
+    key = _dashboard_key(business.pk, timezone.localdate())
+    metrics = cache.get(key)
+    if metrics is not None:
+        _count('hits')
+        return metrics
+    _count('misses')
+    metrics = get_dashboard_metrics(business)
+    cache.set(key, metrics, DASHBOARD_CACHE_TIMEOUT)
+    return metrics
+
+
+def invalidate_dashboard(business_id):
+    """
+    Olvida el dashboard del negocio ahora y otra vez al confirmar la transacción
+    (igual que la caché de slots): una carga concurrente que leyó datos viejos no queda guardada.
+    """
+    if not business_id:
+        return
+    cache.delete(_dashboard_key(business_id, timezone.localdate()))
+    transaction.on_commit(lambda: cache.delete(_dashboard_key(business_id, timezone.localdate())))
+
+
+def dashboard_cache_stats(reset=False):
+    """ {'hits': n, 'misses': n, 'hit_ratio': 0..1} para ajustar DASHBOARD_CACHE_TIMEOUT. """
+    stats = cache.get_many(list(DASHBOARD_STATS_KEYS.values()))
+    hits = stats.get(DASHBOARD_STATS_KEYS['hits'], 0)
+    misses = stats.get(DASHBOARD_STATS_KEYS['misses'], 0)
+    if reset:
+        cache.delete_many(list(DASHBOARD_STATS_KEYS.values()))
+    return {'hits': hits, 'misses': misses, 'hit_ratio': hits / (hits + misses) if hits + misses else 0}
@@ -0,0 +1,68 @@
+# CoreApps/main/entitlements.py
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from CoreApps.users.models import StaffMember, Subscription
+
+# Estados de suscripción con los que el negocio puede usar su plan (dashboard, reservas, recordatorios)
+VALID_SUBSCRIPTION_STATUSES = ['ACTIVE', 'TRIAL', 'DEMO']
+# Segundos que se reutilizan los permisos del plan. Las señales los invalidan al cambiar
+# la suscripción, el plan o el personal; el TTL solo acota cualquier cambio que se escape.
+ENTITLEMENTS_CACHE_TIMEOUT = getattr(settings, 'ENTITLEMENTS_CACHE_TIMEOUT', 10 * 60)
+UNLIMITED = -1
+
+
+def _entitlements_key(business_id):
+    return f"entitlements:{business_id}"
+
+
+def build_entitlements(business_id):
+    """
+    Arma los permisos del negocio con dos consultas (suscripción + plan, y conteo del personal):
+    {'subscription', 'plan', 'is_valid', 'max_staff', 'staff_count', 'can_add_staff', 'allow_*'}.
+    Sin suscripción, 'subscription' y 'plan' son None y no se permite nada.
+    """
+    subscription = Subscription.objects.select_related('plan').filter(business_id=business_id).first()
+    plan = subscription.plan if subscription else None
+    max_staff = plan.max_staff if plan else 0
+    staff_count = StaffMember.objects.filter(business_id=business_id).count()
+    return {
+        'subscription': subscription,
+        'plan': plan,
+        'is_valid': bool(subscription and subscription.status in VALID_SUBSCRIPTION_STATUSES),
+        'max_staff': max_staff,
+        'staff_count': staff_count,
+        'can_add_staff': plan is not None and (max_staff == UNLIMITED or staff_count < max_staff),
+        'allow_payments': bool(plan and plan.allow_payments),
+        'allow_whatsapp_reminders': bool(plan and plan.allow_whatsapp_reminders),
+        'allow_custom_branding': bool(plan and plan.allow_custom_branding),
+    }
+
+
+def get_entitlements(business):
+    """
+    Permisos del plan del negocio. Se guardan en el propio objeto Business (una sola resolución
+    por petición, aunque varias partes de la vista pregunten) y en la caché compartida
+    (las peticiones siguientes no consultan la base de datos).
+    """
+    entitlements = getattr(business, '_entitlements', None)
+    if entitlements is None:
+        key = _entitlements_key(business.pk)
+        entitlements = cache.get(key)
+        if entitlements is None:
+            entitlements = build_entitlements(business.pk)
+            cache.set(key, entitlements, ENTITLEMENTS_CACHE_TIMEOUT)
+        business._entitlements = entitlements
+    return entitlements
+
+
+def invalidate_entitlements(*business_ids):
+    """
+    Olvida los permisos de los negocios ahora y otra vez al confirmar la transacción
+    (igual que las demás cachés): una lectura concurrente previa al commit no queda guardada.
+    """
+    keys = [_entitlements_key(business_id) for business_id in business_ids if business_id]
+    if keys:
+        cache.delete_many(keys)
+        transaction.on_commit(lambda: cache.delete_many(keys))
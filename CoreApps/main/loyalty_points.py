@@ -0,0 +1,104 @@
+# CoreApps/main/loyalty_points.py
+
+from decimal import ROUND_DOWN, Decimal
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.db.models.lookups import GreaterThanOrEqual
+from CoreApps.loyalty.models import LoyaltyCard, LoyaltyLog
+from CoreApps.scheduling.models import Appointment
+
+# Puntos por cada unidad del precio del servicio (1 = un punto por dólar, redondeando hacia abajo)
+LOYALTY_POINTS_PER_UNIT = Decimal(str(getattr(settings, 'LOYALTY_POINTS_PER_UNIT', 1)))
+# Niveles por puntos acumulados, de mayor a menor umbral
+LOYALTY_TIERS = getattr(settings, 'LOYALTY_TIERS', [(300, 'Oro'), (100, 'Plata'), (0, 'Bronce')])
+ACCRUAL_REASON = "Cita completada"
+
+
+def points_for(price):
+    """ Puntos que otorga un servicio con ese precio. """
+    return int((Decimal(price) * LOYALTY_POINTS_PER_UNIT).to_integral_value(rounding=ROUND_DOWN))
+
+
+def tier_for(points):
+    """ Nivel que corresponde a un saldo (en Python; ver tier_expression para SQL). """
+    for threshold, name in LOYALTY_TIERS:
+        if points >= threshold:
+            return name
+    return LOYALTY_TIERS[-1][1]
+
+
+def tier_expression(points):
+    """ El mismo cálculo de tier_for como expresión SQL sobre 'points' (ej: F('points') + n). """
+    return Case(
+        *[When(GreaterThanOrEqual(points, threshold), then=Value(name)) for threshold, name in LOYALTY_TIERS],
+        default=Value(LOYALTY_TIERS[-1][1]),
+    )
+
+
+def accrue_for_completed(appointments):
+    """
+    Suma puntos por citas COMPLETADAS que aún no los sumaron. Todo va en una transacción:
+    - crea las tarjetas que falten y agrega los LoyaltyLog de un solo bulk_create;
+    - actualiza points y tier_level de todas las tarjetas en UN UPDATE con incrementos F(),
+      así dos acumulaciones simultáneas sobre la misma tarjeta no se pisan.
+    La restricción única sobre LoyaltyLog.appointment impide sumar dos veces la misma cita.
+    Devuelve {card_id: puntos sumados}.
+    """
+    appointments = [appointment for appointment in appointments if appointment.status == 'COMPLETED']
+    if not appointments:
+        return {}
+
+    with transaction.atomic():
+        already_accrued = set(LoyaltyLog.objects.filter(
+            appointment__in=appointments
+        ).values_list('appointment_id', flat=True))
+        pending = [appointment for appointment in appointments if appointment.pk not in already_accrued]
+        if not pending:
+            return {}
+
+        customer_ids = {appointment.customer_id for appointment in pending}
+        LoyaltyCard.objects.bulk_create(
+            [LoyaltyCard(customer_id=customer_id) for customer_id in customer_ids], ignore_conflicts=True
+        )
+        cards = dict(LoyaltyCard.objects.filter(customer_id__in=customer_ids).values_list('customer_id', 'id'))
+
+        prices = dict(Appointment.objects.filter(pk__in=[appointment.pk for appointment in pending]).values_list('pk', 'service__price'))
+        logs, deltas = [], {}
+        for appointment in pending:
+            points = points_for(prices[appointment.pk])
+            card_id = cards[appointment.customer_id]
+            logs.append(LoyaltyLog(card_id=card_id, appointment=appointment, points_change=points, reason=ACCRUAL_REASON))
+            deltas[card_id] = deltas.get(card_id, 0) + points
+        LoyaltyLog.objects.bulk_create(logs)
+
+        delta = Case(
+            *[When(pk=card_id, then=Value(points)) for card_id, points in deltas.items()],
+            default=Value(0), output_field=IntegerField(),
+        )
+        # El nivel se calcula sobre el saldo NUEVO (en el UPDATE, F('points') aún es el viejo)
+        LoyaltyCard.objects.filter(pk__in=deltas).update(
+            points=F('points') + delta,
+            tier_level=tier_expression(F('points') + delta),
+        )
+    return deltas
+
+
+def reconcile_balances(dry_run=False):
+    """
+    Recalcula el saldo de TODAS las tarjetas desde su historial con una sola consulta agrupada
+    (SUM de LoyaltyLog por tarjeta) y corrige solo las que difieren. Devuelve las tarjetas corregidas.
+    """
+    drifted = []
+    for card in LoyaltyCard.objects.annotate(
+        ledger_points=Coalesce(Sum('logs__points_change'), 0)
+    ).only('id', 'points', 'tier_level').iterator(chunk_size=2000):
+        points = max(card.ledger_points, 0)  # points es PositiveIntegerField
+        tier = tier_for(points)
+        if (card.points, card.tier_level) != (points, tier):
+            card.points, card.tier_level = points, tier
+            drifted.append(card)
+    if drifted and not dry_run:
+        LoyaltyCard.objects.bulk_update(drifted, ['points', 'tier_level'], batch_size=500)
+    return drifted
@@ -0,0 +1,47 @@
+# CoreApps/main/management/commands/backfill_phone_numbers.py
+
+from django.core.management.base import BaseCommand
+from CoreApps.users.models import User
+from CoreApps.users.phone import normalize_phone_numbers
+
+
+class Command(BaseCommand):
+    help = (
+        "Completa User.phone_number_normalized (número formateado para WhatsApp) en los usuarios "
+        "existentes. Recorre la tabla por lotes y solo escribe las filas que cambian."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000, help="Usuarios por lote.")
+        parser.add_argument('--dry-run', action='store_true', help="Solo contar, sin guardar cambios.")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_pk = 0
+        scanned = updated = rejected_total = 0
+        while True:
+            # Paginación por pk (no OFFSET): cada lote cuesta lo mismo aunque la tabla sea grande
+            rows = list(
+                User.objects.filter(pk__gt=last_pk).order_by('pk')
+                .values_list('pk', 'phone_number', 'phone_number_normalized')[:batch_size]
+            )
+            if not rows:
+                break
+            last_pk = rows[-1][0]
+            scanned += len(rows)
+
+            normalized, rejected = normalize_phone_numbers([phone_number for _, phone_number, _ in rows])
+            rejected_total += sum(rejected)
+            changed = [
+                User(pk=pk, phone_number_normalized=value or '')
+                for (pk, _, current), value in zip(rows, normalized) if (value or '') != current
+            ]
+            if changed and not options['dry_run']:
+                # bulk_update no pasa por User.save(): escribe solo la columna normalizada
+                User.objects.bulk_update(changed, ['phone_number_normalized'])
+            updated += len(changed)
+
+        prefix = "[dry-run] " if options['dry_run'] else ""
+        self.stdout.write(
+            f"{prefix}Usuarios revisados: {scanned} | Actualizados: {updated} | Números no formateables: {rejected_total}"
+        )
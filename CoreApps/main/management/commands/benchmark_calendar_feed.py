@@ -0,0 +1,168 @@
+# CoreApps/main/management/commands/benchmark_calendar_feed.py
+
+import time
+from datetime import datetime, timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.http import JsonResponse
+from django.utils import timezone
+
+from CoreApps.users.models import User, Business, StaffMember, Customer
+from CoreApps.catalog.models import Service
+from CoreApps.scheduling.models import Appointment
+from CoreApps.main.calendar_feed import FastJsonResponse, appointment_events, dumps_json
+
+
+def is_test_database(connection):
+    """ True si la conexión apunta a una base de datos de pruebas (test_*, TEST.NAME o en memoria). """
+    name = str(connection.settings_dict['NAME'])
+    test_name = connection.settings_dict.get('TEST', {}).get('NAME')
+    return name.startswith('test_') or name == test_name or name == ':memory:' or 'mode=memory' in name
+
+
+def legacy_events(queryset, include_staff=False):
+    """
+    Serialización anterior (modelos completos + get_status_display() por fila),
+    se mantiene aquí solo como referencia para comparar.
+    """
+    events = []
+    for app in queryset.select_related('service', 'customer__user', 'staff_member'):
+        title = f"{app.service.name}\n"
+        title += f"Cliente: {app.customer.user.first_name} {app.customer.user.last_name}\n"
+        if include_staff:
+            title += f"Staff: {app.staff_member.name}"
+        color = '#007bff'
+        if app.status == 'COMPLETED':
+            color = '#198754'
+        elif app.status == 'CANCELED':
+            color = '#dc3545'
+        events.append({
+            'id': app.pk,
+            'title': title,
+            'start': app.start_time.isoformat(),
+            'end': app.end_time.isoformat(),
+            'color': color,
+            'borderColor': color,
+            'extendedProps': {
+                'service_name': app.service.name,
+                'client_name': f"{app.customer.user.first_name} {app.customer.user.last_name}",
+                'client_phone': app.customer.user.phone_number or "N/A",
+                'staff_name': app.staff_member.name,
+                'price': f"${app.service.price}",
+                'status_display': app.get_status_display(),
+                'raw_status': app.status
+            }
+        })
+    return events
+
+
+class Command(BaseCommand):
+    help = (
+        "Mide el costo por evento de api_get_appointments (consulta + armado + JSON) "
+        "con N citas en el rango. Por defecto crea una base de datos de pruebas desechable "
+        "(como 'manage.py test'); los datos de prueba nunca tocan la base de datos real."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000], help="Cantidades de citas a medir.")
+        parser.add_argument('--repeat', type=int, default=3, help="Repeticiones por medición (se toma la mejor).")
+        parser.add_argument('--staff', type=int, default=50, help="Miembros del personal del negocio de prueba.")
+        parser.add_argument(
+            '--database',
+            help="Usar esta conexión YA existente en vez de crear una base de pruebas. "
+                 "Solo se acepta si es una base de datos de pruebas (test_*, TEST.NAME o en memoria)."
+        )
+
+    def handle(self, *args, **options):
+        if options['database']:
+            connection = connections[options['database']]
+            if not is_test_database(connection):
+                raise CommandError(
+                    f"'{options['database']}' no es una base de datos de pruebas; "
+                    "omite --database para medir sobre una base desechable."
+                )
+            self._run(options['database'], options)
+            return
+
+        connection = connections['default']
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            self._run('default', options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def _run(self, using, options):
+        sizes = sorted(options['sizes'])
+        # Aun en una base de pruebas, no dejamos rastro de los datos de prueba
+        with transaction.atomic(using=using):
+            business, range_start = self._create_fixture(using, max(sizes), options['staff'])
+            self.stdout.write(f"Serializador JSON: {dumps_json.__module__}.{dumps_json.__name__}")
+            self.stdout.write(f"{'citas':>8} | {'modelos + JsonResponse':>24} | {'values_list + dumps_json':>26} | {'mejora':>7}")
+            for size in sizes:
+                queryset = Appointment.objects.using(using).filter(
+                    business=business,
+                    start_time__range=[range_start, self._range_end(using, business, range_start, size)],
+                ).order_by('start_time')
+
+                legacy = self._best_of(options['repeat'], lambda: JsonResponse(legacy_events(queryset, True), safe=False))
+                lean = self._best_of(options['repeat'], lambda: FastJsonResponse(appointment_events(queryset, True)))
+                self.stdout.write(
+                    f"{size:>8} | {legacy / size * 1e6:>20.1f} µs | {lean / size * 1e6:>22.1f} µs | {legacy / lean:>6.1f}x"
+                )
+            transaction.set_rollback(True, using=using)
+
+    def _best_of(self, repeat, func):
+        best = None
+        for _ in range(max(1, repeat)):
+            started = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def _range_end(self, using, business, range_start, size):
+        """ Fin del rango que contiene exactamente 'size' citas. """
+        return Appointment.objects.using(using).filter(
+            business=business, start_time__gte=range_start
+        ).order_by('start_time').values_list('start_time', flat=True)[size - 1]
+
+    def _create_fixture(self, using, total, staff_count):
+        """
+        Negocio de prueba con 'total' citas repartidas entre el personal.
+        Usa bulk_create: no pasa por clean() ni por las señales de la caché de slots.
+        """
+        tag = timezone.now().strftime('%Y%m%d%H%M%S%f')
+        owner = User.objects.using(using).create(username=f'bench-{tag}@tivy.app', email=f'bench-{tag}@tivy.app')
+        business = Business.objects.using(using).create(user=owner, display_name=f"Benchmark {tag}", slug=f"benchmark-{tag}")
+        staff_members = StaffMember.objects.using(using).bulk_create(
+            [StaffMember(business=business, name=f"Estilista {i}") for i in range(staff_count)]
+        )
+        services = Service.objects.using(using).bulk_create([
+            Service(business=business, name=f"Servicio {i}", duration=timedelta(minutes=30), price=10 + i)
+            for i in range(5)
+        ])
+        users = User.objects.using(using).bulk_create([
+            User(username=f'bench-{tag}-{i}@tivy.app', email=f'bench-{tag}-{i}@tivy.app',
+                 first_name="Cliente", last_name=str(i), phone_number=f'09{i:08d}')
+            for i in range(200)
+        ])
+        customers = Customer.objects.using(using).bulk_create([Customer(user=user, business=business) for user in users])
+
+        range_start = timezone.make_aware(datetime.combine(timezone.localdate() + timedelta(days=1), datetime.min.time()))
+        statuses = [status for status, _ in Appointment.STATUS_CHOICES]
+        appointments = []
+        for index in range(total):
+            # Cada staff atiende citas de 30 minutos seguidas
+            start_time = range_start + timedelta(minutes=30 * (index // staff_count))
+            appointments.append(Appointment(
+                business=business,
+                staff_member=staff_members[index % staff_count],
+                customer=customers[index % len(customers)],
+                service=services[index % len(services)],
+                start_time=start_time,
+                end_time=start_time + timedelta(minutes=30),
+                status=statuses[index % len(statuses)],
+            ))
+        Appointment.objects.using(using).bulk_create(appointments, batch_size=1000)
+        return business, range_start
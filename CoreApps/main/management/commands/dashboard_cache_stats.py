@@ -0,0 +1,21 @@
+# CoreApps/main/management/commands/dashboard_cache_stats.py
+
+from django.core.management.base import BaseCommand
+from CoreApps.main.dashboard_metrics import DASHBOARD_CACHE_TIMEOUT, dashboard_cache_stats
+
+
+class Command(BaseCommand):
+    help = (
+        "Muestra aciertos y fallos de la caché del dashboard para ajustar DASHBOARD_CACHE_TIMEOUT. "
+        "Con una caché local (LocMem) los contadores son del proceso; usar un backend compartido para verlos todos."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help="Poner los contadores en cero después de mostrarlos.")
+
+    def handle(self, *args, **options):
+        stats = dashboard_cache_stats(reset=options['reset'])
+        self.stdout.write(
+            f"TTL: {DASHBOARD_CACHE_TIMEOUT}s | Aciertos: {stats['hits']} | Fallos: {stats['misses']} | "
+            f"Tasa de acierto: {stats['hit_ratio']:.1%}"
+        )
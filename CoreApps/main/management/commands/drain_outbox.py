@@ -0,0 +1,33 @@
+# CoreApps/main/management/commands/drain_outbox.py
+
+import time
+from django.core.management.base import BaseCommand
+from CoreApps.main.outbox import drain_outbox
+
+
+class Command(BaseCommand):
+    help = (
+        "Envía los mensajes pendientes del outbox (WhatsApp) con reintentos y backoff. "
+        "Sin --loop procesa lo pendiente y termina (ideal para cron); con --loop queda como worker."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help="Mensajes máximos por pasada.")
+        parser.add_argument('--loop', action='store_true', help="No terminar: seguir revisando la cola.")
+        parser.add_argument('--interval', type=float, default=5, help="Segundos de espera entre pasadas con --loop.")
+
+    def handle(self, *args, **options):
+        while True:
+            # Vaciamos todo lo que esté listo antes de dormir
+            while True:
+                counts = drain_outbox(batch_size=options['batch_size'])
+                processed = sum(counts.values())
+                if processed:
+                    self.stdout.write(
+                        f"Enviados: {counts['SENT']} | Para reintentar: {counts['PENDING']} | Descartados: {counts['DEAD']}"
+                    )
+                if processed < options['batch_size']:
+                    break
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
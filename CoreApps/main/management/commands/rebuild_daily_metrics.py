@@ -0,0 +1,38 @@
+# CoreApps/main/management/commands/rebuild_daily_metrics.py
+
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from CoreApps.users.models import Business
+from CoreApps.main.metrics import rebuild_daily_metrics
+
+
+class Command(BaseCommand):
+    help = (
+        "Reconstruye el resumen diario del dashboard (BusinessDailyMetrics) desde las citas y los clientes. "
+        "Necesario tras cargas masivas (bulk_create/update no disparan señales) o cambios de precio de servicios."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--business', help="Slug del negocio (por defecto, todos).")
+        parser.add_argument(
+            '--days', type=int,
+            help="Solo los últimos N días y los futuros hasta N días (por defecto, toda la historia)."
+        )
+
+    def handle(self, *args, **options):
+        businesses = Business.objects.order_by('pk')
+        if options['business']:
+            businesses = businesses.filter(slug=options['business'])
+            if not businesses.exists():
+                raise CommandError(f"No existe el negocio '{options['business']}'.")
+
+        start_date = end_date = None
+        if options['days']:
+            today = timezone.localdate()
+            start_date, end_date = today - timedelta(days=options['days']), today + timedelta(days=options['days'])
+
+        total_days = 0
+        for business_id in businesses.values_list('pk', flat=True).iterator():
+            total_days += rebuild_daily_metrics(business_id, start_date, end_date)
+        self.stdout.write(f"Negocios: {businesses.count()} | Días con actividad: {total_days}")
@@ -0,0 +1,21 @@
+# CoreApps/main/management/commands/reconcile_loyalty.py
+
+from django.core.management.base import BaseCommand
+from CoreApps.main.loyalty_points import reconcile_balances
+
+
+class Command(BaseCommand):
+    help = (
+        "Recalcula points y tier_level de todas las tarjetas de fidelidad desde su historial (LoyaltyLog). "
+        "Necesario tras ajustes manuales en el admin o cargas masivas."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Solo informar las diferencias, sin guardarlas.")
+
+    def handle(self, *args, **options):
+        drifted = reconcile_balances(dry_run=options['dry_run'])
+        for card in drifted[:20]:
+            self.stdout.write(f"Tarjeta {card.pk}: {card.points} puntos ({card.tier_level})")
+        action = "por corregir" if options['dry_run'] else "corregidas"
+        self.stdout.write(f"Tarjetas {action}: {len(drifted)}")
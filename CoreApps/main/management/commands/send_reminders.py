@@ -0,0 +1,32 @@
+# CoreApps/main/management/commands/send_reminders.py
+
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from CoreApps.main.reminders import REMINDER_LEAD_TIME, send_due_reminders
+
+
+class Command(BaseCommand):
+    help = (
+        "Encola recordatorios por WhatsApp de las próximas citas (planes con allow_whatsapp_reminders). "
+        "Los envía el comando drain_outbox. Sin --loop hace una pasada (ideal para cron); con --loop queda como worker."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--lead-hours', type=float, default=REMINDER_LEAD_TIME.total_seconds() / 3600,
+            help="Recordar las citas que empiezan dentro de estas horas."
+        )
+        parser.add_argument('--batch-size', type=int, default=500, help="Citas por transacción.")
+        parser.add_argument('--loop', action='store_true', help="No terminar: repetir cada --interval segundos.")
+        parser.add_argument('--interval', type=float, default=60, help="Segundos entre pasadas con --loop.")
+
+    def handle(self, *args, **options):
+        lead_time = timedelta(hours=options['lead_hours'])
+        while True:
+            processed = send_due_reminders(lead_time=lead_time, batch_size=options['batch_size'])
+            if processed or not options['loop']:
+                self.stdout.write(f"Recordatorios encolados: {processed}")
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,154 @@
+# CoreApps/main/metrics.py
+
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import Greatest, TruncDate
+from django.utils import timezone
+from CoreApps.users.models import Customer
+from CoreApps.catalog.models import Service
+from CoreApps.scheduling.models import Appointment
+from .models import BusinessDailyMetrics
+from .utils import local_day_bounds
+
+# Campos que cambian el aporte de una cita al resumen (save(update_fields=...) acepta nombre o attname)
+METRIC_FIELDS = {'start_time', 'status', 'service', 'service_id'}
+COUNT_FIELDS = ('appointments', 'completed', 'canceled', 'new_customers')
+
+
+def _local_date(field):
+    """ Fecha en hora local de un DateTimeField (las métricas son por día local del negocio). """
+    return TruncDate(field, tzinfo=timezone.get_current_timezone())
+
+
+def compute_daily_metrics(business_id, start_date=None, end_date=None):
+    """
+    Calcula las métricas de cada día [start_date, end_date] (o de toda la historia) del negocio
+    con dos consultas agrupadas por día: una sobre citas y otra sobre clientes nuevos.
+    Devuelve {fecha: {campo: valor}} solo con los días que tienen datos.
+    """
+    appointments = Appointment.objects.filter(business_id=business_id)
+    customers = Customer.objects.filter(business_id=business_id)
+    if start_date is not None:
+        range_start, range_end = local_day_bounds(start_date, end_date)
+        appointments = appointments.filter(start_time__gte=range_start, start_time__lt=range_end)
+        customers = customers.filter(created_at__gte=range_start, created_at__lt=range_end)
+
+    not_canceled = ~Q(status='CANCELED')
+    metrics = {}
+    for row in appointments.annotate(day=_local_date('start_time')).values('day').annotate(
+        appointments=Count('id', filter=not_canceled),
+        completed=Count('id', filter=Q(status='COMPLETED')),
+        canceled=Count('id', filter=Q(status='CANCELED')),
+        revenue=Sum('service__price', filter=not_canceled),
+    ).order_by():
+        day = row.pop('day')
+        row['revenue'] = row['revenue'] or 0
+        metrics[day] = row
+    for day, count in customers.annotate(day=_local_date('created_at')).values('day').annotate(
+        count=Count('id')
+    ).order_by().values_list('day', 'count'):
+        metrics.setdefault(day, {'appointments': 0, 'completed': 0, 'canceled': 0, 'revenue': 0})['new_customers'] = count
+    for values in metrics.values():
+        values.setdefault('new_customers', 0)
+    return metrics
+
+
+def rebuild_daily_metrics(business_id, start_date=None, end_date=None):
+    """
+    Reescribe el resumen del negocio para [start_date, end_date] (o entero): borra las filas
+    del rango y las vuelve a crear desde las citas y clientes. Es idempotente.
+    """
+    metrics = compute_daily_metrics(business_id, start_date, end_date)
+    with transaction.atomic():
+        rows = BusinessDailyMetrics.objects.filter(business_id=business_id)
+        if start_date is not None:
+            rows = rows.filter(date__gte=start_date, date__lte=end_date or start_date)
+        rows.delete()
+        BusinessDailyMetrics.objects.bulk_create([
+            BusinessDailyMetrics(business_id=business_id, date=day, **values) for day, values in metrics.items()
+        ])
+    return len(metrics)
+
+
+def _contribution(status, price):
+    """ Lo que suma UNA cita a su día (el mismo criterio de compute_daily_metrics). """
+    if status == 'CANCELED':
+        return {'canceled': 1}
+    return {'appointments': 1, 'completed': int(status == 'COMPLETED'), 'revenue': price or 0}
+
+
+def _add(deltas, day, contribution, sign):
+    changes = deltas.setdefault(day, {})
+    for field, value in contribution.items():
+        changes[field] = changes.get(field, 0) + sign * value
+
+
+def apply_deltas(business_id, deltas, create_missing=True):
+    """
+    Suma {fecha: {campo: delta}} a las filas del negocio con UPDATE ... SET campo = campo + delta:
+    dos cambios simultáneos del mismo día no se pisan, y como corre dentro de la transacción
+    del cambio, un rollback también deshace el resumen. Los contadores no bajan de 0.
+    Con create_missing=False (bajas) solo se actualizan las filas que ya existen.
+    """
+    for day, changes in sorted(deltas.items()):
+        changes = {field: value for field, value in changes.items() if value}
+        if not changes:
+            continue
+        if create_missing:
+            BusinessDailyMetrics.objects.bulk_create(
+                [BusinessDailyMetrics(business_id=business_id, date=day)], ignore_conflicts=True
+            )
+        BusinessDailyMetrics.objects.filter(business_id=business_id, date=day).update(updated_at=timezone.now(), **{
+            field: Greatest(F(field) + value, 0) if field in COUNT_FIELDS else F(field) + value
+            for field, value in changes.items()
+        })
+
+
+def _service_prices(appointment, service_ids):
+    service_ids = {service_id for service_id in service_ids if service_id}
+    if service_ids == {appointment.service_id} and Appointment.service.is_cached(appointment):
+        return {appointment.service_id: appointment.service.price}
+    return dict(Service.objects.filter(pk__in=service_ids).values_list('pk', 'price'))
+
+
+def record_appointment_saved(appointment, created):
+    """
+    Aplica al resumen lo que cambió la cita: resta su aporte anterior (día, estado y servicio
+    del snapshot de carga) y suma el nuevo. Sin cambios en esos tres datos, no consulta nada.
+    Si no se conoce el estado anterior (instancia armada a mano), recalcula el día desde cero.
+    """
+    new = (timezone.localdate(appointment.start_time), appointment.status, appointment.service_id)
+    old = None
+    if not created:
+        loaded = getattr(appointment, '_loaded_schedule', None)
+        if loaded is None or loaded[1] is None:
+            rebuild_daily_metrics(appointment.business_id, new[0])
+            return
+        old = (timezone.localdate(loaded[1]), loaded[3], loaded[4])
+        if old == new:
+            return
+
+    prices = _service_prices(appointment, [new[2], old[2] if old else None])
+    deltas = {}
+    if old:
+        _add(deltas, old[0], _contribution(old[1], prices.get(old[2])), -1)
+    _add(deltas, new[0], _contribution(new[1], prices.get(new[2])), 1)
+    apply_deltas(appointment.business_id, deltas)
+
+
+def record_appointment_deleted(appointment):
+    """ Resta el aporte de la cita borrada (también en borrados en cascada, ej: de un cliente). """
+    prices = _service_prices(appointment, [appointment.service_id])
+    deltas = {}
+    _add(deltas, timezone.localdate(appointment.start_time), _contribution(appointment.status, prices.get(appointment.service_id)), -1)
+    apply_deltas(appointment.business_id, deltas, create_missing=False)
+
+
+def record_customer_change(customer, sign):
+    """ Alta (+1) o baja (-1) de un cliente en el día en que se creó. """
+    if customer.created_at is None:
+        return
+    apply_deltas(
+        customer.business_id, {timezone.localdate(customer.created_at): {'new_customers': sign}},
+        create_missing=sign > 0
+    )
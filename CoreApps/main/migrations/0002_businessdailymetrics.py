@@ -0,0 +1,36 @@
+# Generated by Django 4.2.25 on 2026-10-18 10:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0009_user_phone_number_normalized'),
+        ('main', '0001_outboxmessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BusinessDailyMetrics',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('appointments', models.PositiveIntegerField(default=0)),
+                ('completed', models.PositiveIntegerField(default=0)),
+                ('canceled', models.PositiveIntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('new_customers', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('business', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_metrics', to='users.business')),
+            ],
+            options={
+                'ordering': ['date'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='businessdailymetrics',
+            constraint=models.UniqueConstraint(fields=('business', 'date'), name='daily_metrics_business_date_uniq'),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Migración de datos: llena BusinessDailyMetrics con la historia existente. Sin esto, el
+# dashboard de un negocio con citas previas mostraría ceros hasta correr rebuild_daily_metrics.
+# Es el mismo cálculo de CoreApps.main.metrics.compute_daily_metrics, pero con los modelos
+# históricos y agrupando por (negocio, día) para todos los negocios a la vez.
+
+from django.db import migrations
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+BATCH_SIZE = 1000
+
+
+def backfill_daily_metrics(apps, schema_editor):
+    Appointment = apps.get_model('scheduling', 'Appointment')
+    Customer = apps.get_model('users', 'Customer')
+    BusinessDailyMetrics = apps.get_model('main', 'BusinessDailyMetrics')
+
+    tzinfo = timezone.get_current_timezone()
+    not_canceled = ~Q(status='CANCELED')
+    metrics = {}
+    for row in Appointment.objects.annotate(day=TruncDate('start_time', tzinfo=tzinfo)).values(
+        'business_id', 'day'
+    ).annotate(
+        appointments=Count('id', filter=not_canceled),
+        completed=Count('id', filter=Q(status='COMPLETED')),
+        canceled=Count('id', filter=Q(status='CANCELED')),
+        revenue=Sum('service__price', filter=not_canceled),
+    ).order_by():
+        key = (row.pop('business_id'), row.pop('day'))
+        row['revenue'] = row['revenue'] or 0
+        metrics[key] = row
+    for business_id, day, count in Customer.objects.annotate(day=TruncDate('created_at', tzinfo=tzinfo)).values(
+        'business_id', 'day'
+    ).annotate(count=Count('id')).order_by().values_list('business_id', 'day', 'count'):
+        metrics.setdefault(
+            (business_id, day), {'appointments': 0, 'completed': 0, 'canceled': 0, 'revenue': 0}
+        )['new_customers'] = count
+
+    # Idempotente: reemplaza lo que hubiera (ej: filas creadas por señales en un deploy parcial)
+    BusinessDailyMetrics.objects.all().delete()
+    BusinessDailyMetrics.objects.bulk_create([
+        BusinessDailyMetrics(business_id=business_id, date=day, **{'new_customers': 0, **values})
+        for (business_id, day), values in metrics.items()
+    ], batch_size=BATCH_SIZE)
+
+
+def clear_daily_metrics(apps, schema_editor):
+    """ Reversa: el resumen se puede volver a calcular en cualquier momento. """
+    apps.get_model('main', 'BusinessDailyMetrics').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0002_businessdailymetrics'),
+        ('scheduling', '0011_appointment_reminder_sent_at'),
+        ('catalog', '0003_service_photo'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_daily_metrics, clear_daily_metrics),
+    ]
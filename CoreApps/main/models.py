@@ -1,3 +1,68 @@
 from django.db import models
+from django.utils import timezone
+from CoreApps.users.models import Business
 
 # Create your models here.
+
+
+class OutboxMessage(models.Model):
+    """
+    Mensaje saliente (WhatsApp) pendiente de envío. Se escribe DENTRO de la transacción
+    que lo origina (ej: la reserva), así nunca se pierde ni se envía por una cita que
+    no llegó a guardarse. Lo despacha el comando 'drain_outbox' (ver CoreApps/main/outbox.py).
+    """
+    STATUS_CHOICES = (
+        ('PENDING', 'Pendiente'),
+        ('SENT', 'Enviado'),
+        ('DEAD', 'Fallido (sin más reintentos)'),
+    )
+
+    channel = models.CharField(max_length=20, default='whatsapp')
+    recipient = models.CharField(max_length=30)
+    body = models.TextField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='PENDING')
+    attempts = models.PositiveIntegerField(default=0)
+    # Momento a partir del cual el worker puede (re)intentar el envío
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    # Evita encolar dos veces el mismo aviso (ej: 'appointment:15:confirmation')
+    dedupe_key = models.CharField(max_length=100, unique=True, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.channel} a {self.recipient} ({self.get_status_display()})"
+
+    class Meta:
+        indexes = [
+            # Consulta del worker: pendientes cuyo próximo intento ya venció
+            models.Index(fields=['status', 'next_attempt_at'], name='outbox_status_next_idx'),
+        ]
+        ordering = ['next_attempt_at']
+
+
+class BusinessDailyMetrics(models.Model):
+    """
+    Resumen diario por negocio (día en hora local) para el dashboard: unas pocas filas
+    pequeñas en vez de recorrer las citas en cada carga. Lo mantienen las señales al cambiar
+    citas o clientes (CoreApps/main/metrics.py); se reconstruye con 'rebuild_daily_metrics'.
+    """
+    business = models.ForeignKey(Business, on_delete=models.CASCADE, related_name='daily_metrics')
+    date = models.DateField()
+    # Citas del día que no están canceladas (agendadas + completadas)
+    appointments = models.PositiveIntegerField(default=0)
+    completed = models.PositiveIntegerField(default=0)
+    canceled = models.PositiveIntegerField(default=0)
+    # Suma del precio de los servicios de las citas no canceladas
+    revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    new_customers = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.business.display_name} | {self.date}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['business', 'date'], name='daily_metrics_business_date_uniq'),
+        ]
+        ordering = ['date']
@@ -0,0 +1,131 @@
+# CoreApps/main/outbox.py
+
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+from .models import OutboxMessage
+from .wasenderapi_utils import send_whatsapp_batch, send_whatsapp_message
+
+logger = logging.getLogger(__name__)
+
+# Intentos antes de dar el mensaje por perdido (queda en estado DEAD para revisarlo en el admin)
+OUTBOX_MAX_ATTEMPTS = getattr(settings, 'OUTBOX_MAX_ATTEMPTS', 5)
+# Espera entre reintentos: base * 2^(intento-1), con un máximo
+OUTBOX_BACKOFF_BASE = getattr(settings, 'OUTBOX_BACKOFF_BASE', 30)
+OUTBOX_BACKOFF_MAX = getattr(settings, 'OUTBOX_BACKOFF_MAX', 60 * 60)
+# Mientras un worker envía un mensaje, nadie más lo toma durante este tiempo.
+# Si el worker muere a mitad de camino, el mensaje vuelve a la cola al vencer.
+OUTBOX_LEASE = getattr(settings, 'OUTBOX_LEASE', 2 * 60)
+# Fracción del lease que se planifica usar: el resto es margen para envíos lentos
+OUTBOX_LEASE_MARGIN = 0.5
+
+
+def enqueue_whatsapp(recipient, body, dedupe_key=None):
+    """
+    Encola un WhatsApp. Llamar dentro de la transacción del cambio que lo origina:
+    si esa transacción se revierte, el mensaje desaparece con ella.
+    Con 'dedupe_key', encolar dos veces lo mismo no crea un segundo mensaje.
+    """
+    return enqueue_whatsapp_many([(recipient, body, dedupe_key)])
+
+
+def enqueue_whatsapp_many(messages):
+    """
+    Encola varios WhatsApp [(destinatario, texto, dedupe_key)] con un solo INSERT.
+    Los que ya estaban encolados (misma dedupe_key) se ignoran.
+    """
+    return OutboxMessage.objects.bulk_create(
+        [OutboxMessage(recipient=recipient, body=body, dedupe_key=dedupe_key) for recipient, body, dedupe_key in messages],
+        ignore_conflicts=True
+    )
+
+
+def backoff_delay(attempts):
+    """ Segundos de espera antes del siguiente intento tras 'attempts' intentos fallidos. """
+    return min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1))
+
+
+def claim_chunk_size(batch_size):
+    """
+    Cuántos mensajes tomar de una vez para que TODOS se envíen antes de que venza su lease:
+    lo que permiten, en la mitad del lease, el límite de ritmo del proveedor y el pool de
+    conexiones si cada envío tardara el timeout completo. Nunca menos de uno.
+    """
+    budget = OUTBOX_LEASE * OUTBOX_LEASE_MARGIN
+    by_rate = getattr(settings, 'WASENDERAPI_RATE_PER_SECOND', 10) * budget
+    by_pool = getattr(settings, 'WASENDERAPI_POOL_SIZE', 10) * budget / getattr(settings, 'WASENDERAPI_TIMEOUT', 20)
+    return max(1, min(batch_size, int(by_rate), int(by_pool)))
+
+
+def claim(message, now):
+    """
+    Toma el mensaje para este worker hasta now + OUTBOX_LEASE. El UPDATE condicional
+    (mismo número de intentos) hace que, si dos workers leen el mismo mensaje, solo uno lo envíe.
+    El par (attempts, next_attempt_at) resultante identifica el lease de este worker.
+    """
+    lease_until = now + timedelta(seconds=OUTBOX_LEASE)
+    claimed = OutboxMessage.objects.filter(
+        pk=message.pk, status='PENDING', attempts=message.attempts
+    ).update(attempts=F('attempts') + 1, next_attempt_at=lease_until)
+    if claimed:
+        message.attempts += 1
+        message.next_attempt_at = lease_until
+    return bool(claimed)
+
+
+def record_result(message, success, response, now=None):
+    """
+    Guarda el resultado del envío de un mensaje ya tomado: SENT, reintento con backoff,
+    o DEAD al agotar OUTBOX_MAX_ATTEMPTS. Devuelve el estado final, o None si el lease
+    ya no es de este worker (venció y otro lo tomó): en ese caso no se pisa su resultado.
+    """
+    now = now or timezone.now()
+    lease = {'attempts': message.attempts, 'next_attempt_at': message.next_attempt_at}
+    if success:
+        message.status = 'SENT'
+        message.sent_at = now
+        message.last_error = ''
+    else:
+        message.last_error = str(response)[:2000]
+        if message.attempts >= OUTBOX_MAX_ATTEMPTS:
+            message.status = 'DEAD'
+            logger.error(f"Outbox: mensaje {message.pk} descartado tras {message.attempts} intentos: {message.last_error}")
+        else:
+            message.next_attempt_at = now + timedelta(seconds=backoff_delay(message.attempts))
+            logger.warning(f"Outbox: fallo el intento {message.attempts} del mensaje {message.pk}: {message.last_error}")
+    updated = OutboxMessage.objects.filter(pk=message.pk, status='PENDING', **lease).update(
+        status=message.status, sent_at=message.sent_at, last_error=message.last_error,
+        next_attempt_at=message.next_attempt_at,
+    )
+    if not updated:
+        logger.warning(f"Outbox: el lease del mensaje {message.pk} (intento {message.attempts}) venció antes de guardar el resultado")
+        return None
+    return message.status
+
+
+def drain_outbox(batch_size=100, send=None, now=None):
+    """
+    Envía los mensajes pendientes cuyo próximo intento ya venció (más antiguos primero),
+    en lote por la sesión compartida y con el límite de ritmo de WASenderAPI.
+    Los mensajes se toman por tramos de claim_chunk_size justo antes de enviarlos: ningún
+    lease vence mientras espera su turno (otro worker lo reenviaría).
+    Devuelve un contador {'SENT': n, 'PENDING': n, 'DEAD': n} de lo procesado.
+    """
+    counts = {'SENT': 0, 'PENDING': 0, 'DEAD': 0}
+    due = list(OutboxMessage.objects.filter(
+        status='PENDING', next_attempt_at__lte=now or timezone.now()
+    ).order_by('next_attempt_at')[:batch_size])
+    chunk_size = claim_chunk_size(batch_size)
+    for start in range(0, len(due), chunk_size):
+        claim_time = now or timezone.now()
+        claimed = [message for message in due[start:start + chunk_size] if claim(message, claim_time)]
+        results = send_whatsapp_batch(
+            [(message.recipient, message.body) for message in claimed], send=send or send_whatsapp_message
+        )
+        for message, (success, response) in zip(claimed, results):
+            status = record_result(message, success, response)
+            if status:
+                counts[status] += 1
+    return counts
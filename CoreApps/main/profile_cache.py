@@ -0,0 +1,112 @@
+# CoreApps/main/profile_cache.py
+
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+from CoreApps.users.models import Business
+from .entitlements import get_entitlements
+
+# Segundos que el perfil público se sirve sin revisar la base de datos
+PUBLIC_PROFILE_CACHE_TIMEOUT = getattr(settings, 'PUBLIC_PROFILE_CACHE_TIMEOUT', 5 * 60)
+# Pasado ese tiempo, la versión vieja se sigue sirviendo hasta este margen extra mientras
+# UNA sola petición la regenera (las demás no esperan ni golpean la base de datos)
+PUBLIC_PROFILE_STALE_TIMEOUT = getattr(settings, 'PUBLIC_PROFILE_STALE_TIMEOUT', 60 * 60)
+# Segundos que navegadores y proxies pueden reutilizar la página (solo visitantes anónimos)
+PUBLIC_PROFILE_MAX_AGE = getattr(settings, 'PUBLIC_PROFILE_MAX_AGE', 60)
+# Máximo que dura el candado de regeneración (si el proceso muere, otro lo retoma)
+PUBLIC_PROFILE_LOCK_TIMEOUT = 30
+
+
+def _profile_key(slug):
+    return f"public_profile:{slug}"
+
+
+def _lock_key(slug):
+    return f"public_profile:lock:{slug}"
+
+
+def build_public_profile(slug):
+    """
+    Arma la entrada de caché del perfil: datos mínimos del negocio y el HTML ya renderizado
+    de main/_public_profile_content.html. Devuelve None si el slug no existe.
+    """
+    business = Business.objects.filter(slug=slug).first()
+    if business is None:
+        return None
+    # Acepta reservas si su suscripción es válida (permisos del plan, también en caché)
+    available = get_entitlements(business)['is_valid']
+    html = ''
+    if available:
+        html = render_to_string('main/_public_profile_content.html', {
+            'business': business,
+            'services': business.services.filter(is_active=True),
+        })
+    return {
+        'business_id': business.pk,
+        'display_name': business.display_name,
+        'available': available,
+        'html': html,
+        'fresh_until': time.time() + PUBLIC_PROFILE_CACHE_TIMEOUT,
+    }
+
+
+def _store(slug, profile):
+    cache.set(_profile_key(slug), profile, PUBLIC_PROFILE_CACHE_TIMEOUT + PUBLIC_PROFILE_STALE_TIMEOUT)
+
+
+def _rebuild(slug):
+    profile = build_public_profile(slug)
+    if profile is None:
+        return None
+    _store(slug, profile)
+    return mark_safe_profile(profile)
+
+
+def get_public_profile(slug):
+    """
+    Perfil público por slug, con caché "stale-while-revalidate":
+    - fresco: se sirve tal cual;
+    - vencido: la petición que consigue el candado lo regenera; las demás sirven el viejo;
+    - ausente (o invalidado por un cambio): se arma en el momento.
+    Devuelve None si el negocio no existe.
+    """
+    profile = cache.get(_profile_key(slug))
+    if profile is not None and profile['fresh_until'] > time.time():
+        return mark_safe_profile(profile)
+    if profile is None:
+        # Sin nada que servir mientras tanto: se arma sin candado (y sin tocar el de otra petición)
+        return _rebuild(slug)
+    if not cache.add(_lock_key(slug), 1, PUBLIC_PROFILE_LOCK_TIMEOUT):
+        # Otra petición ya lo está regenerando: servimos la versión anterior
+        return mark_safe_profile(profile)
+    try:
+        return _rebuild(slug)
+    finally:
+        # Solo libera el candado quien lo tomó
+        cache.delete(_lock_key(slug))
+
+
+def mark_safe_profile(profile):
+    """ El HTML guardado ya fue escapado por la plantilla al renderizarlo. """
+    return dict(profile, html=mark_safe(profile['html']))
+
+
+def invalidate_public_profile(*slugs):
+    """
+    Borra el perfil en caché (ahora y otra vez al confirmar la transacción, como las demás cachés).
+    Un cambio del negocio, sus servicios o su suscripción debe verse de inmediato
+    (ej: suscripción cancelada), por eso se borra y no se deja vencer.
+    """
+    keys = [_profile_key(slug) for slug in slugs if slug]
+    if keys:
+        cache.delete_many(keys)
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def invalidate_business_profile(business_id):
+    """ Igual que invalidate_public_profile, a partir del id del negocio (servicios, suscripción). """
+    if business_id:
+        invalidate_public_profile(*Business.objects.filter(pk=business_id).values_list('slug', flat=True))
@@ -0,0 +1,87 @@
+# CoreApps/main/reminders.py
+
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.template.loader import get_template
+from django.utils import timezone
+from django.utils.timezone import localtime
+from CoreApps.scheduling.models import Appointment
+from .entitlements import VALID_SUBSCRIPTION_STATUSES
+from .outbox import enqueue_whatsapp_many
+
+# Con cuánta anticipación se recuerda una cita
+REMINDER_LEAD_TIME = timedelta(hours=getattr(settings, 'APPOINTMENT_REMINDER_LEAD_HOURS', 24))
+# Solo las columnas que usa la plantilla: una consulta con JOINs, sin instanciar modelos
+REMINDER_FIELDS = (
+    'id', 'start_time',
+    'customer__user__first_name', 'customer__user__phone_number_normalized', 'customer__address_line',
+    'service__name', 'service__location_type', 'staff_member__name',
+    'business__display_name', 'business__address',
+)
+
+
+def due_reminders(now, lead_time=None):
+    """
+    Citas agendadas, sin recordatorio, que empiezan dentro de (now, now + lead_time] y cuyo
+    negocio tiene un plan con allow_whatsapp_reminders. Recorre el índice parcial
+    appt_reminder_due_idx: las citas ya recordadas ni siquiera están en él.
+    """
+    return Appointment.objects.filter(
+        status='SCHEDULED',
+        reminder_sent_at__isnull=True,
+        start_time__gt=now,
+        start_time__lte=now + (lead_time or REMINDER_LEAD_TIME),
+        business__subscription__plan__allow_whatsapp_reminders=True,
+        business__subscription__status__in=VALID_SUBSCRIPTION_STATUSES,
+    ).order_by('start_time')
+
+
+def render_reminders(rows):
+    """
+    Arma los mensajes [(teléfono, texto, dedupe_key)] de las filas de REMINDER_FIELDS.
+    La plantilla se compila una sola vez para todo el lote. El teléfono es la columna ya normalizada
+    (User.phone_number_normalized): las citas sin teléfono válido no generan mensaje.
+    """
+    template = get_template('appointments/messages/wa_reminder.txt')
+    messages = []
+    for (pk, start_time, first_name, phone_number, customer_address,
+         service_name, location_type, staff_name, business_name, business_address) in rows:
+        if not phone_number:
+            continue
+        start_time = localtime(start_time)
+        body = template.render({
+            'customer_name': first_name,
+            'service_name': service_name,
+            'staff_name': staff_name,
+            'business_name': business_name,
+            'business_address': business_address,
+            'customer_address': customer_address,
+            'location_type': location_type,
+            'date': start_time.strftime('%A, %d de %B'),
+            'time': start_time.strftime('%I:%M %p'),
+        })
+        # La hora va en la clave: si la cita se reprograma, el nuevo recordatorio no choca con el viejo
+        messages.append((phone_number, body, f'appointment:{pk}:reminder:{start_time.isoformat()}'))
+    return messages
+
+
+def send_due_reminders(now=None, lead_time=None, batch_size=500):
+    """
+    Encola los recordatorios pendientes en el outbox (lo envía 'drain_outbox') y marca las citas
+    con reminder_sent_at en la MISMA transacción: repetir la pasada no duplica mensajes.
+    Devuelve cuántas citas se procesaron.
+    """
+    now = now or timezone.now()
+    processed = 0
+    while True:
+        with transaction.atomic():
+            rows = list(due_reminders(now, lead_time).values_list(*REMINDER_FIELDS)[:batch_size])
+            if not rows:
+                return processed
+            enqueue_whatsapp_many(render_reminders(rows))
+            # update() no toca updated_at: el recordatorio no es un cambio para el calendario
+            Appointment.objects.filter(pk__in=[row[0] for row in rows]).update(reminder_sent_at=now)
+        processed += len(rows)
+        if len(rows) < batch_size:
+            return processed
@@ -0,0 +1,159 @@
+# CoreApps/main/signals.py
+
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
+from CoreApps.users.models import Business, Customer, Plan, StaffMember, Subscription
+from CoreApps.catalog.models import Service
+from CoreApps.scheduling.models import AvailabilityBlock, AvailabilityRule, Appointment, SlotHold, TimeOffBlock
+from .dashboard_metrics import invalidate_dashboard
+from .entitlements import invalidate_entitlements
+from .metrics import METRIC_FIELDS, record_appointment_deleted, record_appointment_saved, record_customer_change
+from .profile_cache import invalidate_business_profile, invalidate_public_profile
+from .slot_cache import invalidate_staff, invalidate_staff_interval
+
+# Modelos cuyo cambio altera la disponibilidad de un miembro del personal
+SLOT_AFFECTING_MODELS = (AvailabilityBlock, Appointment, TimeOffBlock, SlotHold)
+
+
+def _snapshot(instance):
+    return (instance.staff_member_id, instance.start_time, instance.end_time)
+
+
+def _invalidate(staff_member_id, start_time, end_time):
+    """
+    Invalida ahora y otra vez al confirmar la transacción: así ninguna lectura concurrente
+    que vio la base de datos ANTES del commit deja en caché una lista vieja con la versión nueva.
+    """
+    invalidate_staff_interval(staff_member_id, start_time, end_time)
+    transaction.on_commit(lambda: invalidate_staff_interval(staff_member_id, start_time, end_time))
+
+
+# Campos que pueden mover un intervalo o (en citas) hacer que deje de bloquear
+# (save(update_fields=...) acepta el nombre o el attname)
+SLOT_FIELDS = {'staff_member', 'staff_member_id', 'start_time', 'end_time', 'status'}
+
+
+def invalidate_slots_on_save(sender, instance, created=False, update_fields=None, **kwargs):
+    """
+    El intervalo anterior sale del snapshot de carga (ScheduleSnapshotMixin), sin consultar:
+    si una cita o bloque se MUEVE de día (o de staff), también hay que invalidar el día viejo.
+    """
+    if update_fields is not None and not SLOT_FIELDS.intersection(update_fields):
+        return
+    if not created and getattr(instance, '_loaded_schedule', None) == instance._schedule_state():
+        return
+    previous = instance.loaded_interval()
+    if previous and previous != _snapshot(instance):
+        _invalidate(*previous)
+    _invalidate(*_snapshot(instance))
+
+
+def invalidate_slots_on_delete(sender, instance, **kwargs):
+    _invalidate(*_snapshot(instance))
+
+
+def invalidate_slots_on_rule_change(sender, instance, **kwargs):
+    """ Una regla recurrente puede tocar cualquier fecha: invalidamos todo el staff. """
+    invalidate_staff(instance.staff_member_id)
+    transaction.on_commit(lambda: invalidate_staff(instance.staff_member_id))
+
+
+for model in SLOT_AFFECTING_MODELS:
+    post_save.connect(invalidate_slots_on_save, sender=model, dispatch_uid=f'slots_post_save_{model.__name__}')
+    post_delete.connect(invalidate_slots_on_delete, sender=model, dispatch_uid=f'slots_post_delete_{model.__name__}')
+
+post_save.connect(invalidate_slots_on_rule_change, sender=AvailabilityRule, dispatch_uid='slots_post_save_AvailabilityRule')
+post_delete.connect(invalidate_slots_on_rule_change, sender=AvailabilityRule, dispatch_uid='slots_post_delete_AvailabilityRule')
+
+
+# --- Resumen diario del dashboard (BusinessDailyMetrics) ---
+def update_metrics_on_appointment_save(sender, instance, created=False, update_fields=None, raw=False, **kwargs):
+    # Ej: marcar el recordatorio como enviado no cambia el resumen
+    if raw or (update_fields is not None and not METRIC_FIELDS.intersection(update_fields)):
+        return
+    record_appointment_saved(instance, created)
+
+
+def update_metrics_on_appointment_delete(sender, instance, **kwargs):
+    record_appointment_deleted(instance)
+
+
+def update_metrics_on_customer_save(sender, instance, raw=False, created=False, **kwargs):
+    # Solo cuenta el alta del cliente: editar sus datos no cambia las métricas
+    if not raw and created:
+        record_customer_change(instance, 1)
+
+
+def update_metrics_on_customer_delete(sender, instance, **kwargs):
+    record_customer_change(instance, -1)
+
+
+post_save.connect(update_metrics_on_appointment_save, sender=Appointment, dispatch_uid='metrics_post_save_Appointment')
+post_delete.connect(update_metrics_on_appointment_delete, sender=Appointment, dispatch_uid='metrics_post_delete_Appointment')
+post_save.connect(update_metrics_on_customer_save, sender=Customer, dispatch_uid='metrics_post_save_Customer')
+post_delete.connect(update_metrics_on_customer_delete, sender=Customer, dispatch_uid='metrics_post_delete_Customer')
+
+
+# --- Caché del dashboard: se conecta DESPUÉS del resumen diario, así la invalidación
+# llega cuando el resumen ya está actualizado ---
+def invalidate_dashboard_on_change(sender, instance, raw=False, **kwargs):
+    # Cita creada, cambio de estado u horario, o cliente nuevo: cambian KPIs o próximas citas.
+    # Invalidar en cada guardado es más simple que comparar campos y cuesta un cache.delete.
+    if not raw:
+        invalidate_dashboard(instance.business_id)
+
+
+for model in (Appointment, Customer):
+    post_save.connect(invalidate_dashboard_on_change, sender=model, dispatch_uid=f'dashboard_post_save_{model.__name__}')
+    post_delete.connect(invalidate_dashboard_on_change, sender=model, dispatch_uid=f'dashboard_post_delete_{model.__name__}')
+
+
+# --- Caché del perfil público (por slug) ---
+def remember_previous_slug(sender, instance, raw=False, **kwargs):
+    """ Si el negocio cambia de slug, también hay que olvidar el perfil guardado con el viejo. """
+    if raw or instance.pk is None:
+        return
+    instance._previous_slug = sender.objects.filter(pk=instance.pk).values_list('slug', flat=True).first()
+
+
+def invalidate_profile_on_business_change(sender, instance, raw=False, **kwargs):
+    if not raw:
+        invalidate_public_profile(instance.slug, getattr(instance, '_previous_slug', None))
+
+
+def invalidate_profile_on_related_change(sender, instance, raw=False, **kwargs):
+    # Servicio o suscripción del negocio: cambian la lista de servicios o si acepta reservas
+    if not raw:
+        invalidate_business_profile(instance.business_id)
+
+
+pre_save.connect(remember_previous_slug, sender=Business, dispatch_uid='profile_pre_save_Business')
+post_save.connect(invalidate_profile_on_business_change, sender=Business, dispatch_uid='profile_post_save_Business')
+post_delete.connect(invalidate_profile_on_business_change, sender=Business, dispatch_uid='profile_post_delete_Business')
+for model in (Service, Subscription):
+    post_save.connect(invalidate_profile_on_related_change, sender=model, dispatch_uid=f'profile_post_save_{model.__name__}')
+    post_delete.connect(invalidate_profile_on_related_change, sender=model, dispatch_uid=f'profile_post_delete_{model.__name__}')
+
+
+# --- Permisos del plan (entitlements) ---
+def invalidate_entitlements_on_change(sender, instance, raw=False, **kwargs):
+    # Suscripción (estado, plan) o personal (el conteo): cambian los permisos de SU negocio
+    if raw:
+        return
+    invalidate_entitlements(instance.business_id)
+    # Si el negocio ya está cargado en esta petición, olvidamos también su copia en memoria
+    if sender.business.is_cached(instance):
+        instance.business.__dict__.pop('_entitlements', None)
+
+
+def invalidate_entitlements_on_plan_change(sender, instance, raw=False, **kwargs):
+    """ Un cambio de límites del plan afecta a todos los negocios suscritos a él. """
+    if not raw:
+        invalidate_entitlements(*Subscription.objects.filter(plan=instance).values_list('business_id', flat=True))
+
+
+for model in (Subscription, StaffMember):
+    post_save.connect(invalidate_entitlements_on_change, sender=model, dispatch_uid=f'entitlements_post_save_{model.__name__}')
+    post_delete.connect(invalidate_entitlements_on_change, sender=model, dispatch_uid=f'entitlements_post_delete_{model.__name__}')
+post_save.connect(invalidate_entitlements_on_plan_change, sender=Plan, dispatch_uid='entitlements_post_save_Plan')
+post_delete.connect(invalidate_entitlements_on_plan_change, sender=Plan, dispatch_uid='entitlements_post_delete_Plan')
@@ -0,0 +1,127 @@
+# CoreApps/main/slot_cache.py
+
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from .utils import get_advance_step, get_block_duration, generate_available_slots_range_with_expiries
+
+# Tiempo máximo que vive una lista de slots en caché. La invalidación real la hacen las señales
+# (CoreApps/main/signals.py); este TTL solo limpia entradas huérfanas de versiones viejas.
+SLOTS_CACHE_TIMEOUT = getattr(settings, 'SLOTS_CACHE_TIMEOUT', 60 * 60)
+
+
+def _staff_version_key(staff_member_id):
+    return f"slots:ver:{staff_member_id}"
+
+
+def _version_key(staff_member_id, day):
+    return f"slots:ver:{staff_member_id}:{day.isoformat()}"
+
+
+def _slots_key(staff_member_id, day, block_duration, advance_step, staff_version, day_version):
+    # La grilla depende del bloque (duración + buffer) Y del avance (duración sola):
+    # un servicio de 60 min y uno de 30 min + 30 de traslado bloquean igual, pero avanzan distinto
+    return (
+        f"slots:{staff_member_id}:{day.isoformat()}:{int(block_duration.total_seconds())}:"
+        f"{int(advance_step.total_seconds())}:{staff_version}:{day_version}"
+    )
+
+
+def _get_versions(version_keys):
+    """
+    Devuelve {clave: versión}. Cada staff (y cada staff-día) tiene una versión aleatoria:
+    invalidar es simplemente olvidarla, y las entradas viejas dejan de leerse.
+    """
+    versions = cache.get_many(version_keys)
+    for key in version_keys:
+        if key not in versions:
+            # add() no pisa una versión creada en paralelo por otro proceso
+            cache.add(key, uuid.uuid4().hex, SLOTS_CACHE_TIMEOUT)
+            versions[key] = cache.get(key)
+    return versions
+
+
+def get_available_slots_cached(staff_members, service, target_date, is_domicilio=False):
+    """
+    Igual que generate_available_slots_bulk, pero reutiliza las listas de slots ya calculadas.
+    La clave es (staff, día, duración efectiva del bloque, avance entre slots), así servicios
+    con la misma duración y el mismo buffer comparten la entrada. Solo se calcula (en lote)
+    el personal que no está en caché.
+    Devuelve {staff_member.pk: [slots '%H:%M']}.
+    """
+    staff_members = list(staff_members)
+    if not staff_members:
+        return {}
+
+    versions = _get_versions(
+        [_staff_version_key(staff.pk) for staff in staff_members] +
+        [_version_key(staff.pk, target_date) for staff in staff_members]
+    )
+    advance_step = get_advance_step(service)
+    keys = {}
+    for staff in staff_members:
+        # Solo tocamos staff.business si hace falta el buffer (evita consultas extra)
+        business = staff.business if is_domicilio else None
+        block_duration = get_block_duration(service, business, is_domicilio)
+        keys[staff.pk] = _slots_key(
+            staff.pk, target_date, block_duration, advance_step,
+            versions[_staff_version_key(staff.pk)], versions[_version_key(staff.pk, target_date)]
+        )
+
+    cached = cache.get_many(list(keys.values()))
+    results = {staff.pk: cached[keys[staff.pk]] for staff in staff_members if keys[staff.pk] in cached}
+
+    missing = [staff for staff in staff_members if staff.pk not in results]
+    if missing:
+        computed, hold_expiries = generate_available_slots_range_with_expiries(
+            missing, service, target_date, target_date, is_domicilio
+        )
+        computed = computed[target_date]
+        results.update(computed)
+        # Una lista calculada con una reserva temporal vigente vence junto con la reserva:
+        # agrupamos por timeout para seguir escribiendo con set_many
+        now = timezone.now()
+        entries_by_timeout = {}
+        for staff_pk, slots in computed.items():
+            timeout = SLOTS_CACHE_TIMEOUT
+            expires_at = hold_expiries.get((staff_pk, target_date))
+            if expires_at:
+                timeout = max(1, min(timeout, int((expires_at - now).total_seconds())))
+            entries_by_timeout.setdefault(timeout, {})[keys[staff_pk]] = slots
+        for timeout, entries in entries_by_timeout.items():
+            cache.set_many(entries, timeout)
+    return results
+
+
+def get_staff_available_slots_cached(staff_member, service, target_date, is_domicilio=False):
+    """ Versión para un solo miembro del personal (ej: reprogramar una cita). """
+    return get_available_slots_cached([staff_member], service, target_date, is_domicilio)[staff_member.pk]
+
+
+def invalidate_staff(staff_member_id):
+    """
+    Invalida TODOS los días de un miembro del personal (ej: cambió una regla recurrente,
+    que puede afectar a un número ilimitado de fechas).
+    """
+    cache.delete(_staff_version_key(staff_member_id))
+
+
+def invalidate_staff_days(staff_member_id, days):
+    """ Invalida las listas de slots de un miembro del personal para los días indicados. """
+    cache.delete_many([_version_key(staff_member_id, day) for day in days])
+
+
+def invalidate_staff_interval(staff_member_id, start_time, end_time):
+    """
+    Invalida todos los días (en hora local) que toca un intervalo de un miembro del personal.
+    """
+    if staff_member_id is None or start_time is None:
+        return
+    first_day = timezone.localdate(start_time)
+    last_day = timezone.localdate(end_time) if end_time and end_time > start_time else first_day
+    invalidate_staff_days(
+        staff_member_id,
+        [first_day + timedelta(days=offset) for offset in range((last_day - first_day).days + 1)]
+    )
@@ -1,24 +1,67 @@
 # CoreApps/main/tests.py
 
-from django.test import TestCase, Client
+from django.test import TestCase, SimpleTestCase, TransactionTestCase, Client, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, connections, transaction, OperationalError
+from unittest import skipUnless
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command, CommandError
 from django.urls import reverse
+from django.apps import apps
 from django.utils import timezone
-from datetime import timedelta, datetime
+from datetime import timedelta, datetime, date
+from io import BytesIO, StringIO
 from unittest.mock import patch
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+import base64
+import hashlib
+import hmac
+import importlib
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import threading
+import time
 
 # --- IMPORTS CORREGIDOS ---
 # 1. Modelos de Usuarios y Negocio
 from CoreApps.users.models import User, Business, StaffMember, Customer, Plan, Subscription
 # 2. Modelos de Catálogo (AQUÍ ESTABA EL ERROR)
 from CoreApps.catalog.models import Service
+from CoreApps.loyalty.models import LoyaltyCard, LoyaltyLog
 # 3. Modelos de Agendamiento
-from CoreApps.scheduling.models import Appointment
+from CoreApps.scheduling.models import Appointment, AvailabilityBlock, AvailabilityRule, SlotHold, TimeOffBlock
+# 4. Motor de slots
+from CoreApps.main.utils import (
+    compute_slots_for_day, generate_available_slots, generate_available_slots_bulk, merge_intervals, PROBE_STEP,
+    find_first_available_slots,
+)
+from CoreApps.main.slot_cache import get_available_slots_cached, get_staff_available_slots_cached
+from CoreApps.main.calendar_feed import appointment_events, dumps_json
+from CoreApps.main.views import ConfirmBookingView
+from CoreApps.main.models import BusinessDailyMetrics, OutboxMessage
+from CoreApps.main.metrics import compute_daily_metrics, rebuild_daily_metrics, record_appointment_saved
+from CoreApps.main.dashboard_metrics import dashboard_cache_stats, get_dashboard_metrics, get_dashboard_metrics_cached
+from CoreApps.main.outbox import OUTBOX_LEASE, claim, drain_outbox, enqueue_whatsapp, record_result
+from CoreApps.main.wasenderapi_utils import (
+    TokenBucket, send_whatsapp_batch, decrypt_whatsapp_media, decrypt_whatsapp_media_stream, media_keys,
+    format_phone_number_for_api, normalize_phone_numbers,
+)
+from CoreApps.main.reminders import send_due_reminders
+from CoreApps.main.entitlements import get_entitlements
+from CoreApps.main.loyalty_points import accrue_for_completed, reconcile_balances
+from CoreApps.main.profile_cache import _lock_key, _profile_key, get_public_profile
+from CoreApps.main.booking import SlotUnavailable, book_appointment, lock_staff_member, place_hold, reap_expired_holds, release_holds
 
 class AppointmentViewTests(TestCase):
     def setUp(self):
         """
         CONFIGURACIÓN INICIAL (LABORATORIO)
         """
+        cache.clear()
         # 1. Creamos un Usuario Dueño
         self.owner_user = User.objects.create_user(
             username='dueno@tivy.app', email='dueno@tivy.app', password='password123',
@@ -59,7 +102,8 @@ class AppointmentViewTests(TestCase):
         )
 
         # 5. Creamos una Cita
-        start_time = timezone.now() + timedelta(days=1)
+        # Hora fija (mañana 15:00) para no chocar con el horario que usa el Test B (10:00)
+        start_time = timezone.make_aware(datetime.combine(timezone.now().date() + timedelta(days=1), datetime.strptime("15:00", "%H:%M").time()))
         self.appointment = Appointment.objects.create(
             business=self.business,
             staff_member=self.staff,
@@ -168,7 +212,7 @@ class AppointmentViewTests(TestCase):
         
         print("\n✅ Test de Conflicto B (Overbooking) PASÓ correctamente.")
 
-    @patch('CoreApps.main.views.send_whatsapp_message')
+    @patch('CoreApps.main.outbox.send_whatsapp_message')
     def test_booking_succeeds_even_if_whatsapp_crashes(self, mock_send_whatsapp):
         """
         TEST C: Tolerancia a Fallos.
@@ -212,6 +256,12 @@ class AppointmentViewTests(TestCase):
         exists = Appointment.objects.filter(customer__user__email='usuario_suerte@test.com').exists()
         self.assertTrue(exists, "La cita no se guardó porque falló la notificación.")
 
+        # c) El mensaje quedó en el outbox; el worker registra el fallo y lo reintentará
+        mock_send_whatsapp.assert_not_called()
+        self.assertEqual(drain_outbox(), {'SENT': 0, 'PENDING': 1, 'DEAD': 0})
+        message = OutboxMessage.objects.get()
+        self.assertIn("CRASH", message.last_error)
+
         print("\n✅ Test C (Tolerancia a Fallos WA) PASÓ.")
 
 # --- NUEVO TEST ESCENARIO D ---
@@ -287,4 +337,1818 @@ class AppointmentViewTests(TestCase):
         user_exists = User.objects.filter(email=new_email).exists()
         self.assertFalse(user_exists, "FALLO CRÍTICO: El rollback no funcionó. Se creó un usuario huérfano.")
         
-        print("\n✅ Test E (Rollback Atómico) PASÓ.")
\ No newline at end of file
+        print("\n✅ Test E (Rollback Atómico) PASÓ.")
+
+
+# --- EQUIVALENCIA DEL MOTOR DE SLOTS (SWEEP-LINE) ---
+
+def reference_slots_for_day(target_date, working_blocks, blockers, block_duration, advance_step, probe_step=PROBE_STEP):
+    """
+    Implementación ORIGINAL (bucle anidado) de generate_available_slots, usada como
+    referencia para verificar que el motor de barrido devuelve exactamente lo mismo.
+    """
+    available_slots = []
+    blockers = sorted(blockers)
+    for work_start, work_end in working_blocks:
+        current_time = timezone.make_aware(datetime.combine(target_date, work_start.time()))
+        work_end_time = timezone.make_aware(datetime.combine(target_date, work_end.time()))
+        while (current_time + block_duration) <= work_end_time:
+            slot_start_time = current_time
+            slot_end_time = current_time + block_duration
+            has_conflict = False
+            for block_start, block_end in blockers:
+                if slot_start_time < block_end and slot_end_time > block_start:
+                    has_conflict = True
+                    break
+            if not has_conflict:
+                available_slots.append(slot_start_time.strftime('%H:%M'))
+                current_time += advance_step
+            else:
+                current_time += probe_step
+    return available_slots
+
+
+class SlotEngineEquivalenceTests(SimpleTestCase):
+    """
+    Compara el motor de barrido contra la implementación original con agendas aleatorias.
+    """
+    target_date = date(2030, 3, 11)
+
+    def at(self, minutes):
+        base = timezone.make_aware(datetime.combine(self.target_date, datetime.min.time()))
+        return base + timedelta(minutes=minutes)
+
+    def random_day(self, rng):
+        working_blocks = []
+        cursor = rng.randrange(6 * 60, 10 * 60, 5)
+        for _ in range(rng.randint(1, 3)):
+            length = rng.randrange(30, 6 * 60, 5)
+            working_blocks.append((self.at(cursor), self.at(min(cursor + length, 24 * 60 - 1))))
+            cursor += length + rng.randrange(0, 120, 5)
+            if cursor >= 24 * 60 - 30:
+                break
+
+        blockers = []
+        for _ in range(rng.randint(0, 40)):
+            start = rng.randrange(5 * 60, 23 * 60, rng.choice([1, 5, 15]))
+            blockers.append((self.at(start), self.at(start + rng.randrange(5, 180, 5))))
+        return working_blocks, blockers
+
+    def test_random_schedules_match_reference(self):
+        rng = random.Random(20240521)
+        for _ in range(1500):
+            working_blocks, blockers = self.random_day(rng)
+            service_duration = timedelta(minutes=rng.choice([5, 10, 15, 20, 30, 45, 50, 60, 90]))
+            buffer = timedelta(minutes=rng.choice([0, 0, 10, 30]))
+            block_duration = service_duration + buffer
+            advance_step = max(service_duration, PROBE_STEP)
+
+            expected = reference_slots_for_day(self.target_date, working_blocks, blockers, block_duration, advance_step)
+            result = compute_slots_for_day(self.target_date, working_blocks, blockers, block_duration, advance_step)
+            self.assertEqual(result, expected, f"Diferencia con bloques={working_blocks} bloqueos={blockers}")
+
+    def test_merge_intervals_joins_overlapping_and_touching(self):
+        merged = merge_intervals([
+            (self.at(60), self.at(90)), (self.at(0), self.at(30)),
+            (self.at(30), self.at(45)), (self.at(80), self.at(120)),
+        ])
+        self.assertEqual(merged, [(self.at(0), self.at(45)), (self.at(60), self.at(120))])
+
+
+class SchedulingDataMixin:
+    """
+    Negocio, staff, servicio y cliente mínimos para probar la agenda de un día futuro.
+    """
+    def setUp(self):
+        cache.clear()
+        owner = User.objects.create_user(
+            username='slots@tivy.app', email='slots@tivy.app', password='password123',
+            first_name='Ana', last_name='Slots'
+        )
+        self.business = Business.objects.create(user=owner, display_name="Spa Slots", slug="spa-slots")
+        self.staff = StaffMember.objects.create(business=self.business, name="Estilista")
+        self.service = Service.objects.create(
+            business=self.business, name="Masaje", duration=timedelta(minutes=45), price=20
+        )
+        client_user = User.objects.create_user(
+            username='cliente.slots@tivy.app', email='cliente.slots@tivy.app', password='password123'
+        )
+        self.customer = Customer.objects.create(user=client_user, business=self.business)
+        self.target_date = timezone.now().date() + timedelta(days=5)
+
+    def at(self, hour, minute=0):
+        return timezone.make_aware(datetime.combine(self.target_date, datetime.min.time())) + timedelta(hours=hour, minutes=minute)
+
+
+class GenerateAvailableSlotsDBTests(SchedulingDataMixin, TestCase):
+    """
+    Verifica generate_available_slots contra la implementación original usando datos reales.
+    """
+    def test_matches_reference_with_appointments_and_time_off(self):
+        AvailabilityBlock.objects.create(staff_member=self.staff, start_time=self.at(8), end_time=self.at(12))
+        AvailabilityBlock.objects.create(staff_member=self.staff, start_time=self.at(13), end_time=self.at(19))
+        TimeOffBlock.objects.create(staff_member=self.staff, start_time=self.at(10, 10), end_time=self.at(10, 40), reason="Pausa")
+        for hour, minute in [(8, 30), (14, 0), (15, 20), (17, 5)]:
+            Appointment.objects.create(
+                business=self.business, staff_member=self.staff, customer=self.customer, service=self.service,
+                start_time=self.at(hour, minute), end_time=self.at(hour, minute) + self.service.duration,
+            )
+
+        for is_domicilio in (False, True):
+            block_duration = self.service.duration + (self.business.travel_buffer if is_domicilio else timedelta())
+            blockers = list(TimeOffBlock.objects.values_list('start_time', 'end_time')) + \
+                list(Appointment.objects.values_list('start_time', 'end_time'))
+            expected = reference_slots_for_day(
+                self.target_date,
+                list(AvailabilityBlock.objects.values_list('start_time', 'end_time')),
+                blockers, block_duration, max(self.service.duration, PROBE_STEP),
+            )
+            result = generate_available_slots(self.staff, self.service, self.target_date, is_domicilio=is_domicilio)
+            self.assertEqual(result, expected)
+            self.assertTrue(result)
+
+    def test_no_working_blocks_returns_empty(self):
+        self.assertEqual(generate_available_slots(self.staff, self.service, self.target_date), [])
+
+    def test_bulk_matches_per_staff_with_constant_queries(self):
+        """
+        La versión por lotes devuelve lo mismo que llamar staff por staff,
+        con 5 consultas en total (una por tabla de agenda) sin importar la cantidad de personal.
+        """
+        staff_members = [self.staff] + [
+            StaffMember.objects.create(business=self.business, name=f"Estilista {i}") for i in range(5)
+        ]
+        for index, staff in enumerate(staff_members):
+            AvailabilityBlock.objects.create(staff_member=staff, start_time=self.at(9), end_time=self.at(13 + index % 3))
+            Appointment.objects.create(
+                business=self.business, staff_member=staff, customer=self.customer, service=self.service,
+                start_time=self.at(10, 15 * index), end_time=self.at(10, 15 * index) + self.service.duration,
+            )
+        TimeOffBlock.objects.create(staff_member=staff_members[2], start_time=self.at(11), end_time=self.at(12))
+
+        expected = {staff.pk: generate_available_slots(staff, self.service, self.target_date) for staff in staff_members}
+        with self.assertNumQueries(5):
+            result = generate_available_slots_bulk(staff_members, self.service, self.target_date)
+        self.assertEqual(result, expected)
+
+    def test_availability_calendar_counts_match_daily_generation(self):
+        """
+        El endpoint del calendario devuelve por día la misma cantidad de slots que
+        generate_available_slots, con consultas constantes sin importar el rango.
+        """
+        self.service.assignees.add(self.staff)
+        for offset in range(0, 10, 2):
+            day = self.target_date + timedelta(days=offset)
+            start = timezone.make_aware(datetime.combine(day, datetime.min.time())) + timedelta(hours=9)
+            AvailabilityBlock.objects.create(staff_member=self.staff, start_time=start, end_time=start + timedelta(hours=3))
+            Appointment.objects.create(
+                business=self.business, staff_member=self.staff, customer=self.customer, service=self.service,
+                start_time=start + timedelta(hours=1), end_time=start + timedelta(hours=1) + self.service.duration,
+            )
+
+        url = reverse('api_availability_calendar', kwargs={'slug': self.business.slug})
+        params = {
+            'service_id': self.service.id,
+            'start': self.target_date.isoformat(),
+            'end': (self.target_date + timedelta(days=9)).isoformat(),
+        }
+        # Negocio + servicio + staff + 5 tablas de agenda
+        with self.assertNumQueries(8):
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+
+        days = response.json()['days']
+        self.assertEqual(len(days), 10)
+        for item in days:
+            day = datetime.strptime(item['date'], '%Y-%m-%d').date()
+            expected = len(generate_available_slots(self.staff, self.service, day))
+            self.assertEqual(item['available_slots'], expected, f"Conteo distinto para {day}")
+        self.assertEqual(days[1]['available_slots'], 0)
+        self.assertGreater(days[0]['available_slots'], 0)
+
+    def test_availability_calendar_requires_service(self):
+        url = reverse('api_availability_calendar', kwargs={'slug': self.business.slug})
+        self.assertEqual(self.client.get(url).status_code, 400)
+
+    def test_select_time_page_lists_slots_and_heatmap(self):
+        self.service.assignees.add(self.staff)
+        AvailabilityBlock.objects.create(staff_member=self.staff, start_time=self.at(9), end_time=self.at(11))
+        url = reverse('select_staff_and_time', kwargs={'slug': self.business.slug})
+        response = self.client.get(url, {'service_id': self.service.id, 'date': self.target_date.isoformat()})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['availability_data'][0]['slots'], ['09:00', '09:45'])
+        self.assertContains(response, 'availability-heatmap')
+
+    def test_first_available_slots_across_staff_and_days(self):
+        """
+        La búsqueda devuelve los primeros N slots en orden cronológico entre todo el personal
+        y se detiene en la primera ventana que alcanza el límite.
+        """
+        other = StaffMember.objects.create(business=self.business, name="Otro")
+        late_day = self.target_date + timedelta(days=3)
+        AvailabilityBlock.objects.create(staff_member=self.staff, start_time=self.at(10), end_time=self.at(11, 30))
+        AvailabilityBlock.objects.create(staff_member=other, start_time=self.at(9, 30), end_time=self.at(10, 15))
+        late_start = timezone.make_aware(datetime.combine(late_day, datetime.min.time())) + timedelta(hours=8)
+        AvailabilityBlock.objects.create(staff_member=other, start_time=late_start, end_time=late_start + timedelta(hours=1))
+
+        now = timezone.make_aware(datetime.combine(self.target_date, datetime.min.time()))
+        found = find_first_available_slots([self.staff, other], self.service, limit=3, start=now, window_days=2)
+        self.assertEqual(
+            [(item['date'], item['time'], item['staff'].pk) for item in found],
+            [
+                (self.target_date, '09:30', other.pk),
+                (self.target_date, '10:00', self.staff.pk),
+                (self.target_date, '10:45', self.staff.pk),
+            ]
+        )
+
+        # Con un límite mayor, salta de ventana hasta encontrar el día siguiente con horario
+        with self.assertNumQueries(10):
+            found = find_first_available_slots([self.staff, other], self.service, limit=4, start=now, window_days=2)
+        self.assertEqual((found[-1]['date'], found[-1]['time']), (late_day, '08:00'))
+
+    def test_first_available_endpoint_skips_past_slots(self):
+        self.service.assignees.add(self.staff)
+        AvailabilityBlock.objects.create(staff_member=self.staff, start_time=self.at(9), end_time=self.at(10))
+        url = reverse('api_first_available_slots', kwargs={'slug': self.business.slug})
+        response = self.client.get(url, {'service_id': self.service.id, 'limit': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['slots'], [{
+            'date': self.target_date.isoformat(), 'time': '09:00',
+            'staff_id': self.staff.id, 'staff_name': self.staff.name,
+        }])
+
+    def test_first_available_endpoint_rejects_invalid_staff_id(self):
+        url = reverse('api_first_available_slots', kwargs={'slug': self.business.slug})
+        response = self.client.get(url, {'service_id': self.service.id, 'staff_id': 'abc'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('staff_id', response.json()['error'])
+
+
+class SlotCacheTests(SchedulingDataMixin, TestCase):
+    """
+    Caché de slots por (staff, día, duración) con invalidación por señales.
+    """
+    def book(self, hour, minute=0, **kwargs):
+        return Appointment.objects.create(
+            business=self.business, staff_member=self.staff, customer=self.customer, service=self.service,
+            start_time=self.at(hour, minute), end_time=self.at(hour, minute) + self.service.duration, **kwargs
+        )
+
+    def test_second_read_hits_cache(self):
+        AvailabilityBlock.objects.create(staff_member=self.staff, start_time=self.at(9), end_time=self.at(12))
+        first = get_staff_available_slots_cached(self.staff, self.service, self.target_date)
+        with self.assertNumQueries(0):
+            second = get_staff_available_slots_cached(self.staff, self.service, self.target_date)
+        self.assertEqual(first, second)
+        self.assertEqual(first, generate_available_slots(self.staff, self.service, self.target_date))
+
+    def test_booking_invalidates_only_that_staff_day(self):
+        other = StaffMember.objects.create(business=self.business, name="Otro")
+        for staff in (self.staff, other):
+            AvailabilityBlock.objects.create(staff_member=staff, start_time=self.at(9), end_time=self.at(12))
+        before = get_available_slots_cached([self.staff, other], self.service, self.target_date)
+        self.assertIn('09:00', before[self.staff.pk])
+
+        self.book(9)
+
+        # Solo se recalcula el staff afectado: 5 consultas, y el otro sale de la caché
+        with self.assertNumQueries(5):
+            after = get_available_slots_cached([self.staff, other], self.service, self.target_date)
+        self.assertNotIn('09:00', after[self.staff.pk])
+        self.assertEqual(after[other.pk], before[other.pk])
+
+    def test_moving_appointment_invalidates_old_and_new_day(self):
+        next_day = self.target_date + timedelta(days=1)
+        for day in (self.target_date, next_day):
+            start = timezone.make_aware(datetime.combine(day, datetime.min.time())) + timedelta(hours=9)
+            AvailabilityBlock.objects.create(staff_member=self.staff, start_time=start, end_time=start + timedelta(hours=2))
+        appointment = self.book(9)
+
+        self.assertNotIn('09:00', get_staff_available_slots_cached(self.staff, self.service, self.target_date))
+        self.assertIn('09:00', get_staff_available_slots_cached(self.staff, self.service, next_day))
+
+        appointment.start_time += timedelta(days=1)
+        appointment.end_time += timedelta(days=1)
+        appointment.save()
+
+        self.assertIn('09:00', get_staff_available_slots_cached(self.staff, self.service, self.target_date))
+        self.assertNotIn('09:00', get_staff_available_slots_cached(self.staff, self.service, next_day))
+
+    def test_canceled_appointment_frees_slot_for_engine_and_holds(self):
+        AvailabilityBlock.objects.create(staff_member=self.staff, start_time=self.at(9), end_time=self.at(12))
+        appointment = self.book(9)
+        self.assertNotIn('09:00', get_staff_available_slots_cached(self.staff, self.service, self.target_date))
+
+        appointment.status = 'CANCELED'
+        appointment.save(update_fields=['status'])
+
+        # El motor de slots y place_hold usan la misma regla (Appointment.blocking_appointments)
+        self.assertIn('09:00', get_staff_available_slots_cached(self.staff, self.service, self.target_date))
+        self.assertEqual(place_hold(self.staff, self.service, self.at(9), 'sesion-a').start_time, self.at(9))
+
+    def test_same_block_with_different_step_does_not_share_entry(self):
+        # 60 min en el local vs 30 min + 30 de traslado a domicilio: mismo bloque, distinto avance
+        AvailabilityBlock.objects.create(staff_member=self.staff, start_time=self.at(9), end_time=self.at(12))
+        self.business.travel_buffer = timedelta(minutes=30)
+        self.business.save()
+        local = Service.objects.create(business=self.business, name="Corte largo", duration=timedelta(minutes=60), price=30)
+        home = Service.objects.create(
+            business=self.business, name="Corte a domicilio", duration=timedelta(minutes=30), price=30,
+            location_type='DOMICILIO'
+        )
+        staff = StaffMember.objects.select_related('business').get(pk=self.staff.pk)
+        self.assertEqual(get_staff_available_slots_cached(staff, local, self.target_date), ['09:00', '10:00', '11:00'])
+        self.assertEqual(
+            get_staff_available_slots_cached(staff, home, self.target_date, is_domicilio=True),
+            ['09:00', '09:30', '10:00', '10:30', '11:00']
+        )
+        self.assertEqual(get_staff_available_slots_cached(staff, local, self.target_date), ['09:00', '10:00', '11:00'])
+
+    def test_deleting_time_off_invalidates(self):
+        AvailabilityBlock.objects.create(staff_member=self.staff, start_time=self.at(9), end_time=self.at(12))
+        block = TimeOffBlock.objects.create(staff_member=self.staff, start_time=self.at(9), end_time=self.at(10))
+        self.assertNotIn('09:00', get_staff_available_slots_cached(self.staff, self.service, self.target_date))
+        block.delete()
+        self.assertIn('09:00', get_staff_available_slots_cached(self.staff, self.service, self.target_date))
+
+    def test_previous_interval_comes_from_loaded_row(self):
+        next_day = self.target_date + timedelta(days=1)
+        for day in (self.target_date, next_day):
+            start = timezone.make_aware(datetime.combine(day, datetime.min.time())) + timedelta(hours=9)
+            AvailabilityBlock.objects.create(staff_member=self.staff, start_time=start, end_time=start + timedelta(hours=2))
+        TimeOffBlock.objects.create(staff_member=self.staff, start_time=self.at(9), end_time=self.at(10))
+        self.assertNotIn('09:00', get_staff_available_slots_cached(self.staff, self.service, self.target_date))
+        self.assertIn('09:00', get_staff_available_slots_cached(self.staff, self.service, next_day))
+
+        block = TimeOffBlock.objects.get(staff_member=self.staff)
+        # Un cambio que no toca el horario: solo el UPDATE, y la caché sigue valiendo
+        block.reason = "Trámite"
+        with self.assertNumQueries(1):
+            block.save(update_fields=['reason'])
+        with self.assertNumQueries(0):
+            get_staff_available_slots_cached(self.staff, self.service, self.target_date)
+
+        # Mover el bloque invalida el día viejo (tomado del snapshot de carga) y el nuevo, sin SELECT previo
+        block.start_time += timedelta(days=1)
+        block.end_time += timedelta(days=1)
+        with self.assertNumQueries(1):
+            block.save()
+        self.assertIn('09:00', get_staff_available_slots_cached(self.staff, self.service, self.target_date))
+        self.assertNotIn('09:00', get_staff_available_slots_cached(self.staff, self.service, next_day))
+
+
+class AvailabilityRuleTests(SchedulingDataMixin, TestCase):
+    """
+    Horarios recurrentes (AvailabilityRule) expandidos bajo demanda.
+    """
+    def make_rule(self, **kwargs):
+        values = dict(
+            staff_member=self.staff, weekday=self.target_date.weekday(),
+            start_time=datetime.strptime('09:00', '%H:%M').time(), end_time=datetime.strptime('11:00', '%H:%M').time(),
+            valid_from=self.target_date - timedelta(days=14), valid_until=self.target_date + timedelta(days=14),
+        )
+        values.update(kwargs)
+        return AvailabilityRule.objects.create(**values)
+
+    def test_rule_produces_same_slots_as_equivalent_block(self):
+        rule = self.make_rule()
+        from_rule = generate_available_slots(self.staff, self.service, self.target_date)
+        rule.delete()
+        AvailabilityBlock.objects.create(staff_member=self.staff, start_time=self.at(9), end_time=self.at(11))
+        self.assertEqual(from_rule, generate_available_slots(self.staff, self.service, self.target_date))
+        self.assertEqual(from_rule, ['09:00', '09:45'])
+
+    def test_rule_respects_validity_and_excluded_dates(self):
+        self.make_rule(excluded_dates=[self.target_date.isoformat()])
+        self.assertEqual(generate_available_slots(self.staff, self.service, self.target_date), [])
+        next_week = self.target_date + timedelta(days=7)
+        self.assertEqual(generate_available_slots(self.staff, self.service, next_week), ['09:00', '09:45'])
+        self.assertEqual(generate_available_slots(self.staff, self.service, self.target_date + timedelta(days=21)), [])
+
+    def test_rule_change_invalidates_cache(self):
+        rule = self.make_rule()
+        self.assertIn('09:00', get_staff_available_slots_cached(self.staff, self.service, self.target_date))
+        rule.excluded_dates = [self.target_date.isoformat()]
+        rule.save()
+        self.assertEqual(get_staff_available_slots_cached(self.staff, self.service, self.target_date), [])
+
+    def test_create_recurring_availability_stores_rules(self):
+        self.client.force_login(self.business.user)
+        response = self.client.post(reverse('api_create_availability'), {
+            'staff_id': self.staff.id,
+            'start_time': f'{self.target_date.isoformat()}T09:00',
+            'end_time': f'{self.target_date.isoformat()}T11:00',
+            'repeat': 'on',
+            'repeat_on': ['0', '2'],
+            'repeat_until': (self.target_date + timedelta(days=365)).isoformat(),
+        })
+        self.assertTrue(response.json()['success'])
+        self.assertEqual(AvailabilityRule.objects.filter(staff_member=self.staff).count(), 2)
+        self.assertFalse(AvailabilityBlock.objects.exists())
+
+    def test_events_feed_expands_occurrences_and_deletes_one(self):
+        self.client.force_login(self.business.user)
+        rule = self.make_rule()
+        url = reverse('api_get_availability_events')
+        params = {
+            'staff_id': self.staff.id,
+            'start': f'{self.target_date.isoformat()}T00:00:00',
+            'end': f'{(self.target_date + timedelta(days=8)).isoformat()}T00:00:00',
+        }
+        ids = [event['id'] for event in self.client.get(url, params).json()]
+        occurrence_id = f'rule_{rule.pk}_{self.target_date.isoformat()}'
+        self.assertIn(occurrence_id, ids)
+        self.assertIn(f'rule_{rule.pk}_{(self.target_date + timedelta(days=7)).isoformat()}', ids)
+
+        response = self.client.post(reverse('api_delete_event'), {'event_id': occurrence_id})
+        self.assertTrue(response.json()['success'])
+        ids = [event['id'] for event in self.client.get(url, params).json()]
+        self.assertNotIn(occurrence_id, ids)
+        self.assertEqual(len(ids), 1)
+
+    def test_occurrence_date_is_validated(self):
+        self.client.force_login(self.business.user)
+        rule = self.make_rule()
+        times = {'start_time': f'{self.target_date.isoformat()}T10:00:00', 'end_time': f'{self.target_date.isoformat()}T12:00:00'}
+        invalid_days = [
+            'no-es-fecha',
+            (self.target_date + timedelta(days=1)).isoformat(),   # otro día de la semana
+            (self.target_date + timedelta(days=21)).isoformat(),  # fuera de vigencia
+        ]
+        for day in invalid_days:
+            event_id = f'rule_{rule.pk}_{day}'
+            self.assertEqual(self.client.post(reverse('api_delete_event'), {'event_id': event_id}).status_code, 400)
+            self.assertEqual(self.client.post(reverse('api_update_event'), {'event_id': event_id, **times}).status_code, 400)
+        rule.refresh_from_db()
+        self.assertEqual(rule.excluded_dates, [])
+        self.assertFalse(AvailabilityBlock.objects.exists())
+
+    def test_whole_rule_update_and_delete(self):
+        self.client.force_login(self.business.user)
+        rule = self.make_rule()
+        next_day = self.target_date + timedelta(days=1)
+        response = self.client.post(reverse('api_update_event'), {
+            'event_id': f'rule_{rule.pk}',
+            'start_time': f'{next_day.isoformat()}T10:00:00', 'end_time': f'{next_day.isoformat()}T12:00:00',
+        })
+        self.assertTrue(response.json()['success'])
+        rule.refresh_from_db()
+        self.assertEqual((rule.weekday, rule.start_time.hour, rule.end_time.hour), (next_day.weekday(), 10, 12))
+        self.assertEqual(generate_available_slots(self.staff, self.service, next_day)[0], '10:00')
+
+        response = self.client.post(reverse('api_delete_event'), {'event_id': f'rule_{rule.pk}'})
+        self.assertTrue(response.json()['success'])
+        self.assertFalse(AvailabilityRule.objects.exists())
+
+    def test_migration_collapses_repeated_blocks(self):
+        migration = importlib.import_module('CoreApps.scheduling.migrations.0005_collapse_repeated_availability_blocks')
+        for week in range(4):
+            start = self.at(9) + timedelta(weeks=week)
+            if week != 2: # Una semana faltante queda como fecha excluida
+                AvailabilityBlock.objects.create(staff_member=self.staff, start_time=start, end_time=start + timedelta(hours=2))
+        AvailabilityBlock.objects.create(staff_member=self.staff, start_time=self.at(15), end_time=self.at(16)) # Bloque suelto
+
+        migration.collapse_blocks_into_rules(apps, None)
+
+        rule = AvailabilityRule.objects.get(staff_member=self.staff)
+        self.assertEqual(rule.weekday, self.target_date.weekday())
+        self.assertEqual(rule.excluded_dates, [(self.target_date + timedelta(weeks=2)).isoformat()])
+        self.assertEqual(AvailabilityBlock.objects.count(), 1)
+        self.assertEqual(generate_available_slots(self.staff, self.service, self.target_date + timedelta(weeks=3)), ['09:00', '09:45'])
+
+
+class AvailabilityEventsFeedTests(SchedulingDataMixin, TestCase):
+    """
+    El feed del calendario de disponibilidad respeta el rango visible y responde 304 si nada cambió.
+    """
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.business.user)
+        self.url = reverse('api_get_availability_events')
+        self.params = {
+            'staff_id': self.staff.id,
+            'start': f'{self.target_date.isoformat()}T00:00:00',
+            'end': f'{(self.target_date + timedelta(days=7)).isoformat()}T00:00:00',
+        }
+
+    def test_only_events_in_visible_range(self):
+        inside = AvailabilityBlock.objects.create(staff_member=self.staff, start_time=self.at(9), end_time=self.at(12))
+        AvailabilityBlock.objects.create(
+            staff_member=self.staff, start_time=self.at(9) + timedelta(days=30), end_time=self.at(12) + timedelta(days=30)
+        )
+        TimeOffBlock.objects.create(
+            staff_member=self.staff, start_time=self.at(9) - timedelta(days=30), end_time=self.at(10) - timedelta(days=30)
+        )
+        response = self.client.get(self.url, self.params)
+        self.assertEqual([event['id'] for event in response.json()], [f'avail_{inside.pk}'])
+
+    def test_unchanged_calendar_returns_not_modified(self):
+        block = AvailabilityBlock.objects.create(staff_member=self.staff, start_time=self.at(9), end_time=self.at(12))
+        first = self.client.get(self.url, self.params)
+        etag = first['ETag']
+        self.assertTrue(etag)
+
+        self.assertEqual(self.client.get(self.url, self.params, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # Modificar un bloque cambia el ETag
+        block.end_time = self.at(13)
+        block.save()
+        changed = self.client.get(self.url, self.params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(changed.status_code, 200)
+
+        # Borrar también, aunque no deje marca de modificación
+        TimeOffBlock.objects.create(staff_member=self.staff, start_time=self.at(10), end_time=self.at(11)).delete()
+        self.assertEqual(self.client.get(self.url, self.params, HTTP_IF_NONE_MATCH=changed['ETag']).status_code, 304)
+        block.delete()
+        self.assertEqual(self.client.get(self.url, self.params, HTTP_IF_NONE_MATCH=changed['ETag']).status_code, 200)
+
+    def test_permission_is_checked_before_conditional_response(self):
+        etag = self.client.get(self.url, self.params)['ETag']
+        stranger = User.objects.create_user(username='otro@tivy.app', email='otro@tivy.app', password='password123')
+        self.client.force_login(stranger)
+        self.assertEqual(self.client.get(self.url, self.params, HTTP_IF_NONE_MATCH=etag).status_code, 403)
+
+
+class AppointmentSyncTokenTests(SchedulingDataMixin, TestCase):
+    """
+    Modo delta del calendario de citas: con el token solo llegan las citas cambiadas.
+    """
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.business.user)
+        self.url = reverse('api_get_appointments')
+
+    def book(self, hour):
+        return Appointment.objects.create(
+            business=self.business, staff_member=self.staff, customer=self.customer, service=self.service,
+            start_time=self.at(hour), end_time=self.at(hour) + self.service.duration,
+        )
+
+    def full_fetch(self):
+        return self.client.get(self.url, {
+            'start': self.target_date.isoformat(), 'end': (self.target_date + timedelta(days=1)).isoformat()
+        })
+
+    def test_delta_returns_only_changed_appointments(self):
+        old = self.book(9)
+        untouched = self.book(11)
+        # Simulamos que ambas citas se guardaron hace rato
+        Appointment.objects.filter(pk__in=[old.pk, untouched.pk]).update(updated_at=timezone.now() - timedelta(hours=1))
+
+        response = self.full_fetch()
+        self.assertEqual(len(response.json()), 2)
+        token = response['X-Sync-Token']
+
+        new = self.book(14)
+        old.status = 'CANCELED'
+        old.save()
+
+        delta = self.client.get(self.url, {'sync_token': token}).json()
+        events = {event['id']: event for event in delta['events']}
+        self.assertEqual(set(events), {old.pk, new.pk})
+        self.assertEqual(events[old.pk]['extendedProps']['raw_status'], 'CANCELED')
+        self.assertTrue(delta['sync_token'])
+
+    def test_invalid_or_foreign_token_forces_full_reload(self):
+        self.assertEqual(self.client.get(self.url, {'sync_token': 'basura'}).status_code, 410)
+
+        token = self.full_fetch()['X-Sync-Token']
+        other_owner = User.objects.create_user(username='otro@tivy.app', email='otro@tivy.app', password='password123')
+        Business.objects.create(user=other_owner, display_name="Otro Spa", slug="otro-spa")
+        self.client.force_login(other_owner)
+        self.assertEqual(self.client.get(self.url, {'sync_token': token}).status_code, 410)
+
+    def test_lean_serialization_matches_model_serialization(self):
+        from CoreApps.main.management.commands.benchmark_calendar_feed import legacy_events
+        other = StaffMember.objects.create(business=self.business, name="Otro")
+        self.book(9)
+        Appointment.objects.create(
+            business=self.business, staff_member=other, customer=self.customer, service=self.service,
+            start_time=self.at(10), end_time=self.at(10) + self.service.duration, status='CANCELED',
+        )
+        queryset = Appointment.objects.order_by('start_time')
+        # Una sola consulta sin importar la cantidad de citas
+        with self.assertNumQueries(1):
+            events = appointment_events(queryset, include_staff=True)
+        self.assertEqual(events, legacy_events(queryset, include_staff=True))
+        self.assertEqual(json.loads(dumps_json(events)), events)
+
+    def test_benchmark_command_runs_and_rolls_back(self):
+        out = StringIO()
+        # Ya estamos en la base de pruebas: se usa tal cual (sin crear otra)
+        call_command('benchmark_calendar_feed', sizes=[20, 40], repeat=1, staff=3, database='default', stdout=out)
+        self.assertIn('40 |', out.getvalue())
+        self.assertFalse(Business.objects.filter(slug__startswith='benchmark-').exists())
+
+    def test_benchmark_command_refuses_a_real_database(self):
+        with patch.dict(connections['default'].settings_dict, {'NAME': 'tivy_produccion', 'TEST': {}}):
+            with self.assertRaises(CommandError):
+                call_command('benchmark_calendar_feed', sizes=[20], database='default', stdout=StringIO())
+        self.assertFalse(Business.objects.filter(slug__startswith='benchmark-').exists())
+
+
+@skipUnless(connection.vendor == 'sqlite', "Los planes de EXPLAIN QUERY PLAN son específicos de SQLite")
+class SchedulingIndexUsageTests(SchedulingDataMixin, TestCase):
+    """
+    Prueba con EXPLAIN que las consultas reales del motor de slots, del anti-choque y del
+    dashboard usan los índices compuestos (y no un recorrido completo ni solo el índice del FK).
+    """
+    def query_plans(self, func, table):
+        """ Ejecuta func, captura su SQL y devuelve el plan de cada consulta sobre 'table'. """
+        with CaptureQueriesContext(connection) as captured:
+            func()
+        plans = []
+        with connection.cursor() as cursor:
+            for query in captured.captured_queries:
+                sql = query['sql']
+                if sql.startswith('SELECT') and f'FROM "{table}"' in sql:
+                    cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+                    plans.append(' | '.join(str(row[-1]) for row in cursor.fetchall()))
+        self.assertTrue(plans, f"No se ejecutó ninguna consulta sobre {table}")
+        return plans
+
+    def test_slot_engine_uses_staff_time_indexes(self):
+        AvailabilityBlock.objects.create(staff_member=self.staff, start_time=self.at(9), end_time=self.at(12))
+        run = lambda: generate_available_slots(self.staff, self.service, self.target_date)
+        for table, index in [
+            ('scheduling_availabilityblock', 'avail_staff_start_idx'),
+            ('scheduling_timeoffblock', 'timeoff_staff_start_idx'),
+            ('scheduling_appointment', 'appt_staff_start_end_idx'),
+        ]:
+            for plan in self.query_plans(run, table):
+                self.assertIn(index, plan)
+
+    def test_overlap_check_uses_staff_time_index(self):
+        appointment = Appointment(
+            business=self.business, staff_member=self.staff, customer=self.customer, service=self.service,
+            start_time=self.at(9), end_time=self.at(10),
+        )
+        for plan in self.query_plans(appointment.clean, 'scheduling_appointment'):
+            self.assertIn('appt_staff_start_end_idx', plan)
+
+    def test_dashboard_uses_business_time_index(self):
+        plan = Plan.objects.create(name="Pro", price_monthly=10)
+        Subscription.objects.create(business=self.business, plan=plan, status='ACTIVE')
+        self.client.force_login(self.business.user)
+        plans = self.query_plans(lambda: self.client.get(reverse('dashboard')), 'scheduling_appointment')
+        # KPIs y gráfico semanal salen del resumen diario; quedan próximas citas y la pasada de los "top"
+        self.assertGreaterEqual(len(plans), 2)
+        for plan in plans:
+            self.assertIn('appt_business_start_status_idx', plan)
+
+
+class ConcurrentBookingTests(SchedulingDataMixin, TransactionTestCase):
+    """
+    Prueba de estrés: muchos hilos reservando a la vez nunca producen una doble reserva.
+    Cada hilo usa su propia conexión y su propia transacción, como peticiones reales.
+    OJO: solo demuestra la exclusión por el bloqueo de fila (lock_staff_member) en una base de
+    datos con SELECT ... FOR UPDATE (ej: PostgreSQL). En SQLite el FOR UPDATE no existe y la
+    exclusión la da el único escritor de la base de datos; ahí lo que cubre el orden
+    "bloquear y recién entonces verificar" es test_lock_is_taken_before_conflict_queries.
+    """
+    THREADS = 16
+
+    def attempt_booking(self, staff_member, start_time):
+        """
+        Intenta reservar en una transacción propia. Si la base de datos está ocupada
+        (SQLite admite un solo escritor), reintenta como lo haría el cliente.
+        Devuelve 'ok' o 'taken'.
+        """
+        try:
+            for _ in range(500):
+                try:
+                    with transaction.atomic():
+                        book_appointment(self.business, staff_member, self.customer, self.service, start_time)
+                    return 'ok'
+                except SlotUnavailable:
+                    return 'taken'
+                except OperationalError:
+                    time.sleep(random.uniform(0.001, 0.01))
+            return 'gave_up'
+        finally:
+            connections.close_all()
+
+    def run_in_threads(self, jobs):
+        barrier = threading.Barrier(len(jobs))
+        results = [None] * len(jobs)
+
+        def worker(index, job):
+            barrier.wait() # Todos arrancan al mismo tiempo
+            results[index] = job()
+
+        threads = [threading.Thread(target=worker, args=(index, job)) for index, job in enumerate(jobs)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_same_slot_is_booked_exactly_once(self):
+        # Horarios que se solapan parcialmente (9:00, 9:15, 9:30...) para el mismo staff
+        starts = [self.at(9, 15 * (index % 4)) for index in range(self.THREADS)]
+        results = self.run_in_threads([
+            (lambda start=start: self.attempt_booking(self.staff, start)) for start in starts
+        ])
+        self.assertEqual(results.count('ok') + results.count('taken'), self.THREADS)
+
+        booked = list(Appointment.objects.filter(staff_member=self.staff).order_by('start_time'))
+        self.assertGreaterEqual(len(booked), 1)
+        self.assertEqual(len(booked), results.count('ok'))
+        for previous, current in zip(booked, booked[1:]):
+            self.assertLessEqual(previous.end_time, current.start_time, "¡Doble reserva!")
+
+    def test_different_staff_all_succeed(self):
+        staff_members = [self.staff] + [
+            StaffMember.objects.create(business=self.business, name=f"Estilista {i}") for i in range(self.THREADS - 1)
+        ]
+        results = self.run_in_threads([
+            (lambda staff=staff: self.attempt_booking(staff, self.at(9))) for staff in staff_members
+        ])
+        self.assertEqual(results, ['ok'] * self.THREADS)
+        self.assertEqual(Appointment.objects.filter(start_time=self.at(9)).count(), self.THREADS)
+
+    def assert_lock_precedes_conflict_queries(self, queries):
+        sqls = [query['sql'] for query in queries]
+        lock_index = next(index for index, sql in enumerate(sqls) if 'FROM "users_staffmember"' in sql)
+        if connection.features.has_select_for_update:
+            self.assertIn('FOR UPDATE', sqls[lock_index])
+        conflict_tables = ('"scheduling_appointment"', '"scheduling_slothold"', '"scheduling_timeoffblock"')
+        first_conflict = next(index for index, sql in enumerate(sqls) if sql.startswith('SELECT') and any(table in sql for table in conflict_tables))
+        self.assertLess(lock_index, first_conflict, "Se verificaron choques antes de tomar el bloqueo del staff")
+
+    def test_lock_is_taken_before_conflict_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            book_appointment(self.business, self.staff, self.customer, self.service, self.at(9))
+        self.assert_lock_precedes_conflict_queries(queries)
+
+        with CaptureQueriesContext(connection) as queries:
+            place_hold(self.staff, self.service, self.at(10), 'sesion-a')
+        self.assert_lock_precedes_conflict_queries(queries)
+
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_lock_on_one_staff_does_not_block_another(self):
+        """ Mientras una reserva retiene el bloqueo de un staff, otro staff reserva sin esperar. """
+        other = StaffMember.objects.create(business=self.business, name="Otro")
+        locked = threading.Event()
+        release = threading.Event()
+
+        def hold_lock():
+            try:
+                with transaction.atomic():
+                    lock_staff_member(self.staff.pk)
+                    locked.set()
+                    release.wait(timeout=10)
+            finally:
+                connections.close_all()
+
+        holder = threading.Thread(target=hold_lock)
+        holder.start()
+        try:
+            self.assertTrue(locked.wait(timeout=10))
+            result = self.run_in_threads([lambda: self.attempt_booking(other, self.at(9))])
+            self.assertEqual(result, ['ok'])
+        finally:
+            release.set()
+            holder.join()
+
+
+class SlotHoldTests(SchedulingDataMixin, TestCase):
+    """
+    Reservas temporales durante el checkout: bloquean el horario para los demás y vencen solas.
+    """
+    def setUp(self):
+        super().setUp()
+        self.service.assignees.add(self.staff)
+        AvailabilityBlock.objects.create(staff_member=self.staff, start_time=self.at(9), end_time=self.at(11))
+
+    def test_hold_blocks_slot_until_it_expires(self):
+        self.assertIn('09:00', get_staff_available_slots_cached(self.staff, self.service, self.target_date))
+        hold = place_hold(self.staff, self.service, self.at(9), 'sesion-a')
+        self.assertNotIn('09:00', get_staff_available_slots_cached(self.staff, self.service, self.target_date))
+
+        # Otro cliente no puede retener ni reservar el mismo horario
+        with self.assertRaises(SlotUnavailable):
+            place_hold(self.staff, self.service, self.at(9, 15), 'sesion-b')
+        with self.assertRaises(SlotUnavailable):
+            book_appointment(self.business, self.staff, self.customer, self.service, self.at(9), holder='sesion-b')
+
+        # Vencida, se ignora (sin necesidad de borrarla) y la limpieza perezosa la elimina
+        SlotHold.objects.filter(pk=hold.pk).update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertIn('09:00', generate_available_slots(self.staff, self.service, self.target_date))
+        self.assertEqual(reap_expired_holds(), 1)
+
+    def test_place_hold_reaps_only_the_locked_staff(self):
+        other = StaffMember.objects.create(business=self.business, name="Otro")
+        expired = timezone.now() - timedelta(seconds=1)
+        for staff in (self.staff, other):
+            SlotHold.objects.create(staff_member=staff, start_time=self.at(10), end_time=self.at(10, 45), holder='vieja', expires_at=expired)
+        place_hold(self.staff, self.service, self.at(9), 'sesion-a')
+        self.assertFalse(SlotHold.objects.filter(staff_member=self.staff, holder='vieja').exists())
+        self.assertTrue(SlotHold.objects.filter(staff_member=other, holder='vieja').exists())
+
+    def test_releasing_a_hold_reopens_the_cached_slot(self):
+        place_hold(self.staff, self.service, self.at(9), 'sesion-a')
+        self.assertNotIn('09:00', get_staff_available_slots_cached(self.staff, self.service, self.target_date))
+        # Un solo SELECT de los intervalos y un solo DELETE, sin cargar las reservas
+        with self.assertNumQueries(2):
+            release_holds('sesion-a')
+        self.assertIn('09:00', get_staff_available_slots_cached(self.staff, self.service, self.target_date))
+
+    def test_home_visit_hold_covers_the_travel_buffer(self):
+        self.business.travel_buffer = timedelta(minutes=30)
+        self.business.save()
+        hold = place_hold(self.staff, self.service, self.at(9), 'sesion-a', is_domicilio=True)
+        self.assertEqual(hold.end_time, self.at(10, 15))
+        # El buffer de traslado tampoco queda libre para otro cliente
+        with self.assertRaises(SlotUnavailable):
+            place_hold(self.staff, self.service, self.at(10), 'sesion-b')
+
+    def test_cached_slots_expire_with_the_hold(self):
+        place_hold(self.staff, self.service, self.at(9), 'sesion-a', ttl=30)
+        with patch('CoreApps.main.slot_cache.cache.set_many') as set_many:
+            get_staff_available_slots_cached(self.staff, self.service, self.target_date)
+        timeout = set_many.call_args[0][1]
+        self.assertLessEqual(timeout, 30)
+
+    def test_checkout_holds_and_confirm_consumes(self):
+        select_url = reverse('select_staff_and_time', kwargs={'slug': self.business.slug})
+        response = self.client.post(f"{select_url}?date={self.target_date.isoformat()}", {
+            'service_id': self.service.id, 'staff_member_id': self.staff.id,
+            'selected_time': '09:00', 'selected_date': self.target_date.isoformat(),
+        })
+        self.assertRedirects(response, reverse('confirm_booking', kwargs={'slug': self.business.slug}), fetch_redirect_response=False)
+        self.assertEqual(SlotHold.objects.count(), 1)
+
+        # Otro navegador ve el horario ocupado y no puede retenerlo
+        other_browser = Client()
+        response = other_browser.post(select_url, {
+            'service_id': self.service.id, 'staff_member_id': self.staff.id,
+            'selected_time': '09:00', 'selected_date': self.target_date.isoformat(),
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].startswith(select_url))
+        self.assertEqual(SlotHold.objects.count(), 1)
+
+        # El dueño de la reserva confirma (con auto-login, que cambia la sesión) y la reserva se consume
+        response = self.client.post(reverse('confirm_booking', kwargs={'slug': self.business.slug}), {
+            'email': 'nuevo.cliente@tivy.app', 'first_name': 'Nuevo', 'last_name': 'Cliente', 'location_type': 'LOCAL',
+        })
+        appointment = Appointment.objects.get(staff_member=self.staff, start_time=self.at(9))
+        self.assertRedirects(response, reverse('booking_confirmed', kwargs={'pk': appointment.pk}), fetch_redirect_response=False)
+        self.assertFalse(SlotHold.objects.exists())
+
+
+class IdempotentBookingTests(SchedulingDataMixin, TestCase):
+    """
+    Reenviar el formulario de confirmación no crea otra cita ni vuelve a enviar WhatsApp.
+    """
+    def setUp(self):
+        super().setUp()
+        session = self.client.session
+        session['booking_data'] = {
+            'service_id': self.service.id, 'staff_id': self.staff.id,
+            'date_str': self.target_date.isoformat(), 'time_str': '09:00',
+        }
+        session.save()
+        self.url = reverse('confirm_booking', kwargs={'slug': self.business.slug})
+        self.form_data = {
+            'email': 'repetido@tivy.app', 'first_name': 'Repe', 'last_name': 'Tido',
+            'phone_number': '0991234567', 'location_type': 'LOCAL',
+        }
+
+    def test_confirm_form_issues_idempotency_key(self):
+        response = self.client.get(self.url)
+        self.assertContains(response, 'name="idempotency_key"')
+        self.assertEqual(len(response.context['idempotency_key']), 32)
+
+    def test_replay_redirects_to_existing_booking(self):
+        data = dict(self.form_data, idempotency_key='clave-unica-1')
+        first = self.client.post(self.url, data)
+        appointment = Appointment.objects.get(idempotency_key='clave-unica-1')
+        expected = reverse('booking_confirmed', kwargs={'pk': appointment.pk})
+        self.assertRedirects(first, expected, fetch_redirect_response=False)
+
+        # La sesión de reserva ya se consumió; aun así el reenvío llega a la misma confirmación
+        second = self.client.post(self.url, data)
+        self.assertRedirects(second, expected, fetch_redirect_response=False)
+        self.assertEqual(Appointment.objects.count(), 1)
+        self.assertEqual(OutboxMessage.objects.count(), 1)
+
+    def test_concurrent_replay_falls_back_to_lookup(self):
+        """ Si el otro envío gana la carrera después de la verificación inicial, igual se redirige a su cita. """
+        winner = Appointment.objects.create(
+            business=self.business, staff_member=self.staff, customer=self.customer, service=self.service,
+            start_time=self.at(9), end_time=self.at(9) + self.service.duration, idempotency_key='clave-carrera',
+        )
+        real_lookup = ConfirmBookingView.get_replayed_appointment
+        with patch.object(ConfirmBookingView, 'get_replayed_appointment', autospec=True,
+                          side_effect=[None, real_lookup(ConfirmBookingView(), self.business, 'clave-carrera')]):
+            response = self.client.post(self.url, dict(self.form_data, idempotency_key='clave-carrera'))
+        self.assertRedirects(response, reverse('booking_confirmed', kwargs={'pk': winner.pk}), fetch_redirect_response=False)
+        self.assertEqual(Appointment.objects.count(), 1)
+        self.assertFalse(OutboxMessage.objects.exists())
+
+
+class AppointmentConflictCheckTests(SchedulingDataMixin, TestCase):
+    """
+    Anti-choque de Appointment.clean en una sola consulta, y la validación en lote.
+    """
+    def make(self, start_hour, end_hour, staff=None, **extra):
+        return Appointment(
+            business=self.business, staff_member=staff or self.staff, customer=self.customer, service=self.service,
+            start_time=self.at(start_hour), end_time=self.at(end_hour), **extra
+        )
+
+    def test_clean_runs_a_single_query(self):
+        appointment = self.make(9, 10)
+        with self.assertNumQueries(1):
+            appointment.clean()
+
+    def test_appointment_conflict_wins_over_time_off(self):
+        self.make(9, 10).save()
+        TimeOffBlock.objects.create(staff_member=self.staff, start_time=self.at(9), end_time=self.at(10), reason="Almuerzo")
+        with self.assertRaisesMessage(ValidationError, "ya tiene otra cita agendada"):
+            self.make(9, 10).clean()
+
+    def test_time_off_reason_in_message(self):
+        TimeOffBlock.objects.create(staff_member=self.staff, start_time=self.at(12), end_time=self.at(13), reason="Almuerzo")
+        with self.assertRaisesMessage(ValidationError, "no está disponible (Almuerzo)"):
+            self.make(12, 13).clean()
+
+    def test_status_only_change_skips_conflict_check(self):
+        appointment = self.make(9, 10)
+        appointment.save()
+        appointment = Appointment.objects.get(pk=appointment.pk)
+        # Solo el UPDATE (más las consultas de las señales de la caché de slots), ningún SELECT anti-choque
+        with CaptureQueriesContext(connection) as captured:
+            appointment.status = 'COMPLETED'
+            appointment.save(update_fields=['status', 'updated_at'])
+        self.assertFalse([q for q in captured.captured_queries if 'UNION' in q['sql']])
+
+    def test_reactivating_canceled_appointment_is_checked(self):
+        canceled = self.make(9, 10, status='CANCELED')
+        canceled.save()
+        self.make(9, 10).save()
+        canceled = Appointment.objects.get(pk=canceled.pk)
+        canceled.status = 'SCHEDULED'
+        with self.assertRaises(ValidationError):
+            canceled.save()
+
+    def test_moving_appointment_is_checked(self):
+        self.make(9, 10).save()
+        other = self.make(11, 12)
+        other.save()
+        other = Appointment.objects.get(pk=other.pk)
+        other.start_time = self.at(9, 30)
+        with self.assertRaises(ValidationError):
+            other.save()
+
+    def test_find_conflicts_in_bulk(self):
+        second_staff = StaffMember.objects.create(business=self.business, name="Barbero")
+        self.make(9, 10).save()
+        TimeOffBlock.objects.create(staff_member=second_staff, start_time=self.at(14), end_time=self.at(15))
+        batch = [
+            self.make(9, 10, staff=second_staff),       # 0: libre
+            self.make(9, 10),                           # 1: choca con la cita existente
+            self.make(14, 15, staff=second_staff),      # 2: choca con el bloqueo
+            self.make(11, 12),                          # 3: libre
+            self.make(11, 13),                          # 4: choca con la 3 (dentro del lote)
+            self.make(12, 11),                          # 5: horario inválido
+            self.make(16, 17, status='CANCELED'),       # 6: cancelada, no ocupa tiempo
+            self.make(16, 17),                          # 7: libre
+        ]
+        with self.assertNumQueries(2):  # choques + nombres del personal
+            errors = Appointment.find_conflicts(batch)
+        self.assertEqual(sorted(errors), [1, 2, 4, 5])
+        self.assertIn("ya tiene otra cita agendada", errors[1].messages[0])
+        self.assertIn("Barbero no está disponible (tiempo reservado)", errors[2].messages[0])
+        self.assertIn("ya tiene otra cita agendada", errors[4].messages[0])
+
+        with self.assertNumQueries(1):
+            self.assertEqual(Appointment.find_conflicts([batch[0], batch[3], batch[7]]), {})
+
+
+class StubWASenderHandler(BaseHTTPRequestHandler):
+    """ Responde como /api/send-message de WASenderAPI con los códigos de 'responses' (en orden). """
+    protocol_version = 'HTTP/1.1'  # keep-alive, como la API real
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length', 0))
+        server.received.append(json.loads(self.rfile.read(length)))
+        status = server.responses.pop(0) if server.responses else 200
+        body = json.dumps({'success': status == 200, 'message': f'stub {status}'}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubWASenderMixin:
+    """ Levanta un servidor HTTP local (con hilos) que hace de WASenderAPI y apunta la configuración a él. """
+    def setUp(self):
+        super().setUp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubWASenderHandler)
+        self.server.received, self.server.responses, self.server.connections = [], [], 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        settings_override = override_settings(
+            WASENDERAPI_API_KEY='clave-prueba',
+            WASENDERAPI_SEND_URL=f'http://127.0.0.1:{self.server.server_port}/api/send-message',
+            WASENDERAPI_TIMEOUT=5,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+
+class OutboxTests(StubWASenderMixin, SchedulingDataMixin, TestCase):
+    """
+    La reserva encola el WhatsApp en su transacción; drain_outbox lo envía a un servidor HTTP local
+    que hace de WASenderAPI, con reintentos, backoff y descarte.
+    """
+
+    def test_booking_enqueues_confirmation_in_its_transaction(self):
+        session = self.client.session
+        session['booking_data'] = {
+            'service_id': self.service.id, 'staff_id': self.staff.id,
+            'date_str': self.target_date.isoformat(), 'time_str': '09:00',
+        }
+        session.save()
+        self.client.post(reverse('confirm_booking', kwargs={'slug': self.business.slug}), {
+            'email': 'outbox@tivy.app', 'first_name': 'Out', 'last_name': 'Box',
+            'phone_number': '0991234567', 'location_type': 'LOCAL', 'idempotency_key': 'outbox-1',
+        })
+        appointment = Appointment.objects.get(idempotency_key='outbox-1')
+        message = OutboxMessage.objects.get()
+        self.assertEqual(message.dedupe_key, f'appointment:{appointment.pk}:confirmation')
+        self.assertEqual(message.status, 'PENDING')
+        self.assertEqual(self.server.received, [])  # la vista no habla con la API
+
+        self.assertEqual(drain_outbox(), {'SENT': 1, 'PENDING': 0, 'DEAD': 0})
+        self.assertEqual(self.server.received, [{'to': '+593991234567', 'text': message.body}])
+
+    def test_rolled_back_transaction_discards_message(self):
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            enqueue_whatsapp('0991234567', "Hola", dedupe_key='rollback')
+            raise RuntimeError()
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    def test_dedupe_key_ignores_duplicates(self):
+        enqueue_whatsapp('0991234567', "Hola", dedupe_key='unico')
+        enqueue_whatsapp('0991234567', "Hola otra vez", dedupe_key='unico')
+        self.assertEqual(OutboxMessage.objects.get().body, "Hola")
+
+    @patch('CoreApps.main.outbox.OUTBOX_MAX_ATTEMPTS', 3)
+    @patch('CoreApps.main.outbox.OUTBOX_BACKOFF_BASE', 30)
+    def test_retries_with_backoff_then_dead_letters(self):
+        self.server.responses = [500, 503, 500]
+        enqueue_whatsapp('0991234567', "Hola")
+        now = timezone.now()
+
+        self.assertEqual(drain_outbox(now=now), {'SENT': 0, 'PENDING': 1, 'DEAD': 0})
+        message = OutboxMessage.objects.get()
+        self.assertEqual(message.attempts, 1)
+        self.assertAlmostEqual((message.next_attempt_at - now).total_seconds(), 30, delta=5)
+        # Antes de que venza la espera no se reintenta
+        self.assertEqual(drain_outbox(now=now + timedelta(seconds=10)), {'SENT': 0, 'PENDING': 0, 'DEAD': 0})
+
+        self.assertEqual(drain_outbox(now=message.next_attempt_at), {'SENT': 0, 'PENDING': 1, 'DEAD': 0})
+        message.refresh_from_db()
+        self.assertAlmostEqual((message.next_attempt_at - timezone.now()).total_seconds(), 60, delta=5)
+
+        self.assertEqual(drain_outbox(now=message.next_attempt_at), {'SENT': 0, 'PENDING': 0, 'DEAD': 1})
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempts), ('DEAD', 3))
+        self.assertIn("stub 500", message.last_error)
+        self.assertEqual(len(self.server.received), 3)
+
+    def test_retry_succeeds_after_transient_error(self):
+        self.server.responses = [503]
+        enqueue_whatsapp('0991234567', "Hola")
+        drain_outbox()
+        message = OutboxMessage.objects.get()
+        drain_outbox(now=message.next_attempt_at)
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempts, message.last_error), ('SENT', 2, ''))
+
+    def test_claimed_message_is_not_sent_twice(self):
+        enqueue_whatsapp('0991234567', "Hola")
+        stale = OutboxMessage.objects.get()
+        drain_outbox()
+        # Otro worker con una copia vieja (mismo número de intentos) ya no puede tomarlo
+        self.assertFalse(claim(stale, timezone.now()))
+        self.assertEqual(len(self.server.received), 1)
+
+    def test_result_is_not_recorded_after_losing_the_lease(self):
+        enqueue_whatsapp('0991234567', "Hola")
+        now = timezone.now()
+        mine = OutboxMessage.objects.get()
+        self.assertTrue(claim(mine, now))
+        # El lease vence y otro worker toma el mensaje
+        theirs = OutboxMessage.objects.get()
+        self.assertTrue(claim(theirs, now + timedelta(seconds=OUTBOX_LEASE + 1)))
+
+        self.assertIsNone(record_result(mine, True, "ok"))
+        self.assertEqual(record_result(theirs, True, "ok"), 'SENT')
+        message = OutboxMessage.objects.get()
+        self.assertEqual((message.status, message.attempts), ('SENT', 2))
+
+    @patch('CoreApps.main.outbox.OUTBOX_LEASE', 2)
+    @override_settings(WASENDERAPI_RATE_PER_SECOND=1)
+    def test_messages_are_claimed_in_chunks_right_before_sending(self):
+        for index in range(3):
+            enqueue_whatsapp('0991234567', f"Hola {index}")
+        claimed_when_sending = []
+
+        def send(phone_number, text):
+            claimed_when_sending.append(OutboxMessage.objects.filter(attempts__gt=0).count())
+            return True, "ok"
+
+        self.assertEqual(drain_outbox(send=send), {'SENT': 3, 'PENDING': 0, 'DEAD': 0})
+        # Un mensaje por tramo (1 por segundo en la mitad de un lease de 2 s): nadie espera con el lease corriendo
+        self.assertEqual(claimed_when_sending, [1, 2, 3])
+
+    def test_drain_command(self):
+        enqueue_whatsapp('0991234567', "Hola")
+        out = StringIO()
+        call_command('drain_outbox', stdout=out)
+        self.assertIn("Enviados: 1", out.getvalue())
+        self.assertEqual(OutboxMessage.objects.get().status, 'SENT')
+
+
+class WASenderBatchTests(StubWASenderMixin, SimpleTestCase):
+    """
+    Envío en lote: conexiones reutilizadas (keep-alive) y límite de ritmo con token bucket.
+    """
+    def test_batch_reuses_pooled_connection(self):
+        self.server.responses = [200, 500, 200]
+        results = send_whatsapp_batch(
+            [('0991234567', f"Mensaje {i}") for i in range(5)], rate_limiter=TokenBucket(1000), max_workers=1
+        )
+        self.assertEqual([success for success, _ in results], [True, False, True, True, True])
+        self.assertEqual([m['text'] for m in self.server.received], [f"Mensaje {i}" for i in range(5)])
+        self.assertEqual(self.server.connections, 1)
+
+    def test_parallel_batch_keeps_order_and_isolates_errors(self):
+        def flaky_send(phone_number, message):
+            if message == "roto":
+                raise RuntimeError("se cayó")
+            return True, message
+        messages = [('0991234567', "roto" if i == 3 else f"m{i}") for i in range(20)]
+        results = send_whatsapp_batch(messages, send=flaky_send, rate_limiter=TokenBucket(1000), max_workers=4)
+        self.assertEqual(results[3][0], False)
+        self.assertIn("se cayó", results[3][1])
+        self.assertEqual([r for i, r in enumerate(results) if i != 3], [(True, f"m{i}") for i in range(20) if i != 3])
+
+    def test_token_bucket_limits_rate_after_burst(self):
+        clock = [0.0]
+        def sleep(seconds):
+            clock[0] += seconds
+        bucket = TokenBucket(rate=5, capacity=2, clock=lambda: clock[0], sleep=sleep)
+        for _ in range(12):
+            bucket.acquire()
+        # 2 de ráfaga inmediata y los otros 10 a 5 por segundo
+        self.assertAlmostEqual(clock[0], 2.0, places=6)
+
+
+class AppointmentReminderTests(SchedulingDataMixin, TestCase):
+    """
+    Recordatorios por WhatsApp: solo planes con allow_whatsapp_reminders, una vez por cita, vía outbox.
+    """
+    def setUp(self):
+        super().setUp()
+        self.plan = Plan.objects.create(name="Recordatorios", price_monthly=10, allow_whatsapp_reminders=True)
+        Subscription.objects.create(business=self.business, plan=self.plan, status='ACTIVE')
+        self.customer.user.first_name = "Carla"
+        self.customer.user.phone_number = '0991234567'
+        self.customer.user.save()
+        self.now = self.at(8)
+
+    def book(self, hour, **extra):
+        appointment = Appointment(
+            business=self.business, staff_member=self.staff, customer=self.customer, service=self.service,
+            start_time=self.at(hour), end_time=self.at(hour) + self.service.duration, **extra
+        )
+        appointment.save()
+        return appointment
+
+    def test_enqueues_reminders_in_window_once(self):
+        soon = self.book(10)
+        self.book(11, status='CANCELED')
+        later = Appointment.objects.create(
+            business=self.business, staff_member=self.staff, customer=self.customer, service=self.service,
+            start_time=self.at(12) + timedelta(days=2), end_time=self.at(13) + timedelta(days=2),
+        )
+        with self.assertNumQueries(5):  # savepoint + citas + INSERT outbox + UPDATE + release
+            self.assertEqual(send_due_reminders(now=self.now), 1)
+        message = OutboxMessage.objects.get()
+        self.assertIn("Te recordamos tu cita en *Spa Slots*", message.body)
+        self.assertIn("Carla", message.body)
+        self.assertTrue(message.dedupe_key.startswith(f'appointment:{soon.pk}:reminder:'))
+        self.assertEqual(message.recipient, '+593991234567')  # columna ya normalizada
+        soon.refresh_from_db()
+        later.refresh_from_db()
+        self.assertEqual(soon.reminder_sent_at, self.now)
+        self.assertIsNone(later.reminder_sent_at)
+
+        # Una segunda pasada no encuentra nada nuevo
+        self.assertEqual(send_due_reminders(now=self.now), 0)
+        self.assertEqual(OutboxMessage.objects.count(), 1)
+
+    def test_plan_without_reminders_is_skipped(self):
+        self.plan.allow_whatsapp_reminders = False
+        self.plan.save()
+        self.book(10)
+        self.assertEqual(send_due_reminders(now=self.now), 0)
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    def test_rescheduled_appointment_gets_a_new_reminder(self):
+        appointment = self.book(10)
+        send_due_reminders(now=self.now)
+        appointment = Appointment.objects.get(pk=appointment.pk)
+        appointment.start_time, appointment.end_time = self.at(15), self.at(16)
+        appointment.save()
+        self.assertIsNone(appointment.reminder_sent_at)
+        self.assertEqual(send_due_reminders(now=self.now), 1)
+        self.assertEqual(OutboxMessage.objects.count(), 2)
+
+    def test_due_query_uses_partial_index(self):
+        self.book(10)
+        with CaptureQueriesContext(connection) as captured:
+            send_due_reminders(now=self.now)
+        select = next(q['sql'] for q in captured.captured_queries if q['sql'].startswith('SELECT'))
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + select)
+            plan = ' | '.join(str(row[-1]) for row in cursor.fetchall())
+        self.assertIn('appt_reminder_due_idx', plan)
+
+    def test_command(self):
+        self.book(10)
+        out = StringIO()
+        with patch('CoreApps.main.reminders.timezone.now', return_value=self.now):
+            call_command('send_reminders', stdout=out)
+        self.assertIn("Recordatorios encolados: 1", out.getvalue())
+
+
+class WhatsAppMediaDecryptionTests(SimpleTestCase):
+    """
+    Desencriptación por bloques de medios de WhatsApp: mismo resultado que la versión en memoria,
+    con verificación del MAC.
+    """
+    def encrypt(self, plain, media_type=b'WhatsApp Video Keys'):
+        media_key = os.urandom(32)
+        iv, cipher_key, mac_key = media_keys(media_key, media_type)
+        padder = padding.PKCS7(128).padder()
+        encryptor = Cipher(algorithms.AES(cipher_key), modes.CBC(iv)).encryptor()
+        encrypted = encryptor.update(padder.update(plain) + padder.finalize()) + encryptor.finalize()
+        mac = hmac.new(mac_key, iv + encrypted, hashlib.sha256).digest()[:10]
+        return base64.b64encode(media_key).decode(), encrypted + mac
+
+    def test_stream_matches_in_memory_decryption(self):
+        plain = bytes(range(256)) * 4099 + b'fin'
+        key, encrypted = self.encrypt(plain)
+        for chunk_size in (1, 7, 10, 16, 4096, len(encrypted) + 1):
+            chunks = (encrypted[i:i + chunk_size] for i in range(0, len(encrypted), chunk_size))
+            sink = BytesIO()
+            self.assertEqual(decrypt_whatsapp_media_stream(key, chunks, sink, 'video'), len(plain))
+            self.assertEqual(sink.getvalue(), plain)
+        self.assertEqual(decrypt_whatsapp_media(key, encrypted, 'video'), plain)
+
+    def test_stream_from_file_object(self):
+        plain = b'x' * 32  # múltiplo exacto del bloque: el padding es un bloque entero
+        key, encrypted = self.encrypt(plain, b'WhatsApp Document Keys')
+        sink = BytesIO()
+        self.assertEqual(decrypt_whatsapp_media_stream(key, BytesIO(encrypted), sink, 'document', chunk_size=5), 32)
+        self.assertEqual(sink.getvalue(), plain)
+
+    def test_tampered_data_is_rejected(self):
+        key, encrypted = self.encrypt(b'contenido secreto' * 100)
+        tampered = bytearray(encrypted)
+        tampered[20] ^= 1
+        # El MAC se verifica antes de escribir: con un archivo (dos pasadas) o con bloques sueltos
+        # (copia cifrada temporal), nada del contenido alterado llega al destino
+        for source in (BytesIO(bytes(tampered)), iter([bytes(tampered[:700]), bytes(tampered[700:])])):
+            sink = BytesIO()
+            self.assertIsNone(decrypt_whatsapp_media_stream(key, source, sink, 'video', chunk_size=64))
+            self.assertEqual(sink.getvalue(), b'')
+        self.assertIsNone(decrypt_whatsapp_media_stream(key, BytesIO(encrypted), BytesIO(), 'image'))
+        self.assertIsNone(decrypt_whatsapp_media_stream(key, BytesIO(encrypted[:8]), BytesIO(), 'video'))
+
+
+class PhoneNormalizationTests(TestCase):
+    """
+    Normalización de teléfonos en lote (mismo resultado que format_phone_number_for_api)
+    y la columna User.phone_number_normalized.
+    """
+    SAMPLES = [
+        '0991234567', '+593 99 123 4567', '593991234567', '991234567', '593421234567',
+        '(099) 123-4567', '593991234567@s.whatsapp.net', '12345', 'N/A', '', None, 991234567,
+    ]
+
+    def test_bulk_matches_single_number_function(self):
+        normalized, rejected = normalize_phone_numbers(self.SAMPLES)
+        self.assertEqual(normalized, [format_phone_number_for_api(number) for number in self.SAMPLES])
+        self.assertEqual(
+            rejected, [False, False, False, False, False, False, False, True, True, False, False, False]
+        )
+
+    def test_user_save_keeps_normalized_column_in_sync(self):
+        user = User.objects.create_user(username='tel@tivy.app', email='tel@tivy.app', password='x', phone_number='0991234567')
+        self.assertEqual(user.phone_number_normalized, '+593991234567')
+        user.phone_number = '0987654321'
+        user.save(update_fields=['phone_number'])
+        user.refresh_from_db()
+        self.assertEqual(user.phone_number_normalized, '+593987654321')
+
+    def test_user_save_normalizes_only_when_the_phone_changes(self):
+        user = User.objects.create_user(username='tel@tivy.app', email='tel@tivy.app', password='x', phone_number='12345')
+        user = User.objects.get(pk=user.pk)
+        with patch('CoreApps.users.models.normalize_phone_number') as normalize:
+            # Inicio de sesión (update_fields=['last_login']) y guardados sin cambio de teléfono
+            self.client.force_login(user)
+            user.first_name = "Tel"
+            user.save()
+        normalize.assert_not_called()
+        self.assertEqual(user.phone_number_normalized, '')
+
+    def test_backfill_command(self):
+        User.objects.bulk_create([
+            User(username=f'bf{i}@tivy.app', email=f'bf{i}@tivy.app', phone_number=number)
+            for i, number in enumerate(['0991234567', '12345', ''])
+        ])
+        out = StringIO()
+        call_command('backfill_phone_numbers', '--batch-size', '2', stdout=out)
+        self.assertIn("Usuarios revisados: 3 | Actualizados: 1 | Números no formateables: 1", out.getvalue())
+        self.assertEqual(
+            list(User.objects.order_by('pk').values_list('phone_number_normalized', flat=True)),
+            ['+593991234567', '', '']
+        )
+        # Una segunda pasada no tiene nada que escribir
+        call_command('backfill_phone_numbers', stdout=out)
+        self.assertIn("Actualizados: 0", out.getvalue().splitlines()[-1])
+
+
+class DailyMetricsDataMixin(SchedulingDataMixin):
+    """ Negocio con suscripción activa y citas en días relativos a hoy (para el dashboard). """
+    def setUp(self):
+        super().setUp()
+        self.today = timezone.localdate()
+        plan = Plan.objects.create(name="Pro", price_monthly=10)
+        Subscription.objects.create(business=self.business, plan=plan, status='ACTIVE')
+
+    def at_day(self, days, hour):
+        return timezone.make_aware(datetime.combine(self.today + timedelta(days=days), datetime.min.time())) + timedelta(hours=hour)
+
+    def book(self, days, hour, status='SCHEDULED'):
+        start = self.at_day(days, hour)
+        with self.captureOnCommitCallbacks(execute=True):
+            return Appointment.objects.create(
+                business=self.business, staff_member=self.staff, customer=self.customer, service=self.service,
+                start_time=start, end_time=start + self.service.duration, status=status
+            )
+
+    def row(self, days):
+        return BusinessDailyMetrics.objects.get(business=self.business, date=self.today + timedelta(days=days))
+
+
+class DailyMetricsTests(DailyMetricsDataMixin, TestCase):
+    """
+    Resumen diario por negocio: se mantiene con las señales y coincide con recalcular desde cero.
+    """
+    def assertRollupMatchesRebuild(self):
+        # Los incrementos dejan en 0 los días que quedaron vacíos; recalcular simplemente no los tiene
+        fields = ('appointments', 'completed', 'canceled', 'revenue', 'new_customers')
+        expected = compute_daily_metrics(self.business.pk)
+        rows = BusinessDailyMetrics.objects.filter(business=self.business)
+        self.assertTrue(set(expected) <= {row.date for row in rows})
+        for row in rows:
+            self.assertEqual(
+                {field: getattr(row, field) for field in fields}, expected.get(row.date, dict.fromkeys(fields, 0))
+            )
+
+
+    def test_signals_keep_rollup_in_sync(self):
+        self.book(0, 9)
+        self.book(0, 11, status='CANCELED')
+        completed = self.book(-2, 10, status='COMPLETED')
+        today = self.row(0)
+        self.assertEqual((today.appointments, today.canceled, today.revenue), (1, 1, 20))
+        self.assertEqual(self.row(-2).completed, 1)
+
+        # Mover una cita de día la resta del viejo y la suma al nuevo
+        appointment = Appointment.objects.get(pk=completed.pk)
+        appointment.start_time, appointment.end_time = self.at_day(-1, 10), self.at_day(-1, 11)
+        appointment.save()
+        self.assertEqual((self.row(-2).completed, self.row(-2).revenue), (0, 0))
+        self.assertEqual(self.row(-1).completed, 1)
+
+        appointment.delete()
+        self.assertEqual((self.row(-1).appointments, self.row(-1).completed), (0, 0))
+        self.assertRollupMatchesRebuild()
+
+    def test_unrelated_saves_do_not_touch_rollup(self):
+        appointment = Appointment.objects.get(pk=self.book(0, 9).pk)
+        # Sin cambio de día, estado ni servicio: ni siquiera se consulta el resumen
+        appointment.end_time += timedelta(minutes=15)
+        with self.assertNumQueries(0):
+            record_appointment_saved(appointment, created=False)
+        appointment.reminder_sent_at = timezone.now()
+        with CaptureQueriesContext(connection) as queries:
+            appointment.save(update_fields=['reminder_sent_at'])
+        self.assertFalse([query for query in queries if 'main_businessdailymetrics' in query['sql']])
+
+        # Un cambio de estado mueve los contadores con un UPDATE incremental, sin recalcular el día
+        appointment.status = 'CANCELED'
+        with CaptureQueriesContext(connection) as queries:
+            appointment.save(update_fields=['status'])
+        self.assertFalse([query for query in queries if 'scheduling_appointment' in query['sql'] and 'SELECT' in query['sql']])
+        self.assertEqual((self.row(0).appointments, self.row(0).canceled, self.row(0).revenue), (0, 1, 0))
+
+    def test_deleting_a_customer_subtracts_its_appointments(self):
+        self.book(0, 9)
+        self.book(-1, 9, status='COMPLETED')
+        self.customer.delete()
+        self.assertEqual((self.row(0).appointments, self.row(-1).completed, self.row(0).new_customers), (0, 0, 0))
+
+    def test_rollback_does_not_touch_rollup(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                Appointment.objects.create(
+                    business=self.business, staff_member=self.staff, customer=self.customer, service=self.service,
+                    start_time=self.at_day(0, 9), end_time=self.at_day(0, 10)
+                )
+                raise RuntimeError()
+        # Solo queda el alta del cliente de setUp: la cita se deshizo junto con su incremento
+        self.assertEqual((self.row(0).appointments, self.row(0).new_customers), (0, 1))
+
+    def test_rebuild_command_matches_incremental_rollup(self):
+        self.book(0, 9)
+        self.book(-3, 9, status='COMPLETED')
+        # Carga masiva: bulk_create no dispara señales, el comando lo corrige
+        start = self.at_day(-3, 12)
+        Appointment.objects.bulk_create([Appointment(
+            business=self.business, staff_member=self.staff, customer=self.customer, service=self.service,
+            start_time=start, end_time=start + self.service.duration, status='COMPLETED'
+        )])
+        out = StringIO()
+        call_command('rebuild_daily_metrics', stdout=out)
+        self.assertIn("Negocios: 1", out.getvalue())
+        self.assertEqual(self.row(-3).completed, 2)
+        self.assertEqual(self.row(0).appointments, 1)
+        self.assertEqual(
+            {day: values['completed'] for day, values in compute_daily_metrics(self.business.pk).items()},
+            dict(BusinessDailyMetrics.objects.values_list('date', 'completed'))
+        )
+
+    def test_migration_backfills_existing_history(self):
+        migration = importlib.import_module('CoreApps.main.migrations.0003_backfill_businessdailymetrics')
+        # Historia previa a la tabla: sin señales, como si las citas ya existieran
+        Appointment.objects.bulk_create([Appointment(
+            business=self.business, staff_member=self.staff, customer=self.customer, service=self.service,
+            start_time=self.at_day(days, 9), end_time=self.at_day(days, 10), status=status
+        ) for days, status in ((0, 'SCHEDULED'), (-2, 'COMPLETED'), (-2, 'CANCELED'))])
+
+        migration.backfill_daily_metrics(apps, None)
+
+        self.assertEqual(
+            {row.date: {field: getattr(row, field) for field in ('appointments', 'completed', 'canceled', 'revenue', 'new_customers')}
+             for row in BusinessDailyMetrics.objects.all()},
+            compute_daily_metrics(self.business.pk)
+        )
+        self.assertEqual((self.row(-2).completed, self.row(-2).canceled), (1, 1))
+
+    def test_dashboard_reads_kpis_from_rollup(self):
+        self.book(0, 9)
+        self.book(-1, 9, status='COMPLETED')
+        rebuild_daily_metrics(self.business.pk)  # incluye el cliente creado en setUp
+        self.client.force_login(self.business.user)
+        with patch('CoreApps.main.dashboard_metrics.DASHBOARD_USE_DAILY_ROLLUP', True):
+            response = self.client.get(reverse('dashboard'))
+        self.assertEqual(response.context['kpi_total_appointments_today'], 1)
+        self.assertEqual(response.context['kpi_revenue_today'], 20)
+        self.assertEqual(response.context['kpi_new_clients_week'], 1)
+        self.assertEqual(json.loads(response.context['chart_weekly_data']), [0, 0, 0, 0, 0, 1, 0])
+
+
+class DashboardMetricsTests(DailyMetricsDataMixin, TestCase):
+    """
+    Servicio de métricas del dashboard: mismos números que las consultas por separado, en 4 consultas
+    (3 leyendo los KPIs del resumen diario).
+    """
+    def test_dashboard_metrics_in_three_queries(self):
+        barber = StaffMember.objects.create(business=self.business, name="Barbero")
+        cut = Service.objects.create(business=self.business, name="Corte", duration=timedelta(minutes=30), price=8)
+        self.book(0, 9)
+        self.book(-1, 9, status='COMPLETED')
+        self.book(-3, 9, status='COMPLETED')
+        for days, hour in [(0, 10), (0, 11), (-2, 10)]:
+            start = self.at_day(days, hour)
+            with self.captureOnCommitCallbacks(execute=True):
+                Appointment.objects.create(
+                    business=self.business, staff_member=barber, customer=self.customer, service=cut,
+                    start_time=start, end_time=start + cut.duration,
+                    status='CANCELED' if hour == 11 else 'SCHEDULED'
+                )
+        self.book(-40, 9)  # fuera de los 30 días
+
+        # Directo de las citas (por defecto) y desde el resumen diario: mismos números
+        with self.assertNumQueries(4):
+            metrics = get_dashboard_metrics(self.business, now=self.at_day(0, 8))
+        rebuild_daily_metrics(self.business.pk)
+        with patch('CoreApps.main.dashboard_metrics.DASHBOARD_USE_DAILY_ROLLUP', True), self.assertNumQueries(3):
+            self.assertEqual(get_dashboard_metrics(self.business, now=self.at_day(0, 8)), metrics)
+        self.assertEqual(metrics['kpi_total_appointments_today'], 2)
+        self.assertEqual(metrics['kpi_revenue_today'], 28)
+        self.assertEqual(metrics['kpi_new_clients_week'], 1)
+        self.assertEqual(json.loads(metrics['chart_weekly_data']), [0, 0, 0, 1, 0, 1, 0])
+        self.assertEqual(len(json.loads(metrics['chart_weekly_labels'])), 7)
+        self.assertEqual(json.loads(metrics['chart_top_services_labels']), ["Corte", "Masaje"])
+        self.assertEqual(json.loads(metrics['chart_top_services_data']), [3, 3])
+        self.assertEqual(json.loads(metrics['chart_top_staff_labels']), ["Barbero", "Estilista"])
+        self.assertEqual([a.start_time for a in metrics['upcoming_appointments']], [self.at_day(0, 9), self.at_day(0, 10)])
+
+
+class DashboardCacheTests(DailyMetricsDataMixin, TestCase):
+    """
+    Contexto del dashboard en caché por negocio, invalidado al crear citas o cambiar su estado.
+    """
+    def test_hit_miss_and_invalidation(self):
+        appointment = self.book(0, 9)
+        first = get_dashboard_metrics_cached(self.business)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_dashboard_metrics_cached(self.business), first)
+        self.assertEqual(dashboard_cache_stats(), {'hits': 1, 'misses': 1, 'hit_ratio': 0.5})
+
+        # Una cita nueva invalida
+        self.book(0, 11)
+        self.assertEqual(get_dashboard_metrics_cached(self.business)['kpi_total_appointments_today'], 2)
+
+        # Un cambio de estado también (KPIs sin canceladas)
+        appointment = Appointment.objects.get(pk=appointment.pk)
+        appointment.status = 'CANCELED'
+        with self.captureOnCommitCallbacks(execute=True):
+            appointment.save(update_fields=['status', 'updated_at'])
+        self.assertEqual(get_dashboard_metrics_cached(self.business)['kpi_total_appointments_today'], 1)
+        self.assertEqual(dashboard_cache_stats(reset=True)['misses'], 3)
+        self.assertEqual(dashboard_cache_stats()['hits'], 0)
+
+    def test_other_business_is_not_invalidated(self):
+        get_dashboard_metrics_cached(self.business)
+        other_owner = User.objects.create_user(username='otro@tivy.app', email='otro@tivy.app', password='x')
+        other = Business.objects.create(user=other_owner, display_name="Otro", slug="otro")
+        Customer.objects.create(user=other_owner, business=other)
+        get_dashboard_metrics_cached(self.business)
+        self.assertEqual(dashboard_cache_stats()['hits'], 1)
+
+    def test_command(self):
+        get_dashboard_metrics_cached(self.business)
+        out = StringIO()
+        call_command('dashboard_cache_stats', '--reset', stdout=out)
+        self.assertIn("Aciertos: 0 | Fallos: 1", out.getvalue())
+        self.assertEqual(dashboard_cache_stats()['misses'], 0)
+
+
+class PublicProfileCacheTests(DailyMetricsDataMixin, TestCase):
+    """
+    Perfil público en caché por slug: sin consultas en un acierto, invalidado por cambios
+    del negocio, sus servicios o su suscripción, y viejo-pero-rápido mientras otro lo regenera.
+    """
+    def setUp(self):
+        super().setUp()
+        self.url = reverse('business_profile', kwargs={'slug': self.business.slug})
+
+    def save(self, instance):
+        with self.captureOnCommitCallbacks(execute=True):
+            instance.save()
+
+    def test_anonymous_hit_uses_no_queries(self):
+        response = self.client.get(self.url)
+        self.assertContains(response, "Masaje")
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertContains(response, "Spa Slots")
+        self.assertIn('public', response['Cache-Control'])
+        self.assertIn('max-age=', response['Cache-Control'])
+        self.assertIn('Cookie', response['Vary'])
+
+    def test_logged_in_response_is_private(self):
+        self.client.force_login(self.business.user)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('private', response['Cache-Control'])
+        self.assertNotIn('public', response['Cache-Control'])
+        self.assertIn('Cookie', response['Vary'])
+
+    def test_service_changes_invalidate(self):
+        self.client.get(self.url)
+        facial = Service.objects.create(business=self.business, name="Facial", duration=timedelta(minutes=30), price=15)
+        self.assertContains(self.client.get(self.url), "Facial")
+        facial.is_active = False
+        self.save(facial)
+        self.assertNotContains(self.client.get(self.url), "Facial")
+
+    def test_subscription_and_slug_changes_invalidate(self):
+        self.client.get(self.url)
+        subscription = self.business.subscription
+        subscription.status = 'CANCELED'
+        self.save(subscription)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+        subscription.status = 'ACTIVE'
+        self.save(subscription)
+        self.client.get(self.url)
+        self.business.slug = 'spa-nuevo'
+        self.save(self.business)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        self.assertContains(self.client.get(reverse('business_profile', kwargs={'slug': 'spa-nuevo'})), "Masaje")
+
+    def test_unknown_slug_is_404_and_not_cached(self):
+        response = self.client.get(reverse('business_profile', kwargs={'slug': 'no-existe'}))
+        self.assertEqual(response.status_code, 404)
+        self.assertIsNone(cache.get(_profile_key('no-existe')))
+
+    def test_stale_profile_is_served_while_another_request_rebuilds(self):
+        get_public_profile(self.business.slug)
+        # Vence la entrada y cambia el servicio SIN señales (como un cambio que aún no invalidó)
+        key = _profile_key(self.business.slug)
+        cache.set(key, dict(cache.get(key), fresh_until=time.time() - 1))
+        Service.objects.filter(pk=self.service.pk).update(name="Masaje relajante")
+
+        cache.add(_lock_key(self.business.slug), 1)
+        with self.assertNumQueries(0):
+            self.assertNotIn("Masaje relajante", get_public_profile(self.business.slug)['html'])
+
+        # Sin candado, la siguiente petición regenera y deja la entrada fresca
+        cache.delete(_lock_key(self.business.slug))
+        self.assertIn("Masaje relajante", get_public_profile(self.business.slug)['html'])
+        self.assertGreater(cache.get(key)['fresh_until'], time.time())
+        self.assertIsNone(cache.get(_lock_key(self.business.slug)))
+
+    def test_cold_miss_does_not_release_another_requests_lock(self):
+        cache.add(_lock_key(self.business.slug), 1)
+        self.assertIn("Masaje", get_public_profile(self.business.slug)['html'])
+        self.assertEqual(cache.get(_lock_key(self.business.slug)), 1)
+
+
+class EntitlementsTests(DailyMetricsDataMixin, TestCase):
+    """
+    Permisos del plan en caché (por petición y entre peticiones), invalidados al cambiar
+    la suscripción, el plan o el personal.
+    """
+    def save(self, instance):
+        with self.captureOnCommitCallbacks(execute=True):
+            instance.save()
+
+    def fresh_business(self):
+        return Business.objects.get(pk=self.business.pk)
+
+    def test_resolved_once_then_cached(self):
+        business = self.fresh_business()
+        with self.assertNumQueries(2):
+            entitlements = get_entitlements(business)
+        self.assertTrue(entitlements['is_valid'])
+        self.assertEqual((entitlements['max_staff'], entitlements['staff_count']), (1, 1))
+        self.assertFalse(entitlements['can_add_staff'])
+        self.assertEqual(entitlements['plan'].name, "Pro")
+        with self.assertNumQueries(0):
+            get_entitlements(business)
+            get_entitlements(self.business)  # otra petición: sale de la caché compartida
+
+    def test_invalidated_by_subscription_plan_and_staff_changes(self):
+        get_entitlements(self.fresh_business())
+        subscription = Subscription.objects.select_related('plan').get(business=self.business)
+        plan = subscription.plan
+        plan.max_staff = 3
+        self.save(plan)
+        self.assertTrue(get_entitlements(self.fresh_business())['can_add_staff'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            StaffMember.objects.create(business=self.business, name="Barbero")
+            StaffMember.objects.create(business=self.business, name="Manicurista")
+        entitlements = get_entitlements(self.fresh_business())
+        self.assertEqual(entitlements['staff_count'], 3)
+        self.assertFalse(entitlements['can_add_staff'])
+
+        subscription.status = 'PAST_DUE'
+        self.save(subscription)
+        self.assertFalse(get_entitlements(self.fresh_business())['is_valid'])
+
+    def test_business_without_subscription(self):
+        Subscription.objects.filter(business=self.business).delete()
+        entitlements = get_entitlements(self.fresh_business())
+        self.assertIsNone(entitlements['subscription'])
+        self.assertFalse(entitlements['is_valid'])
+        self.assertFalse(entitlements['can_add_staff'])
+
+    def test_add_owner_as_staff_respects_the_cached_limit(self):
+        self.client.force_login(self.business.user)
+        url = reverse('add_owner_as_staff')
+        self.client.post(url)
+        self.assertFalse(StaffMember.objects.filter(user=self.business.user).exists())
+
+        plan = Plan.objects.get(name="Pro")
+        plan.max_staff = -1
+        self.save(plan)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(url)
+        self.assertTrue(StaffMember.objects.filter(user=self.business.user).exists())
+        self.assertEqual(get_entitlements(self.fresh_business())['staff_count'], 2)
+
+    def test_write_paths_recount_staff_ignoring_a_stale_cache(self):
+        plan = Plan.objects.get(name="Pro")
+        plan.max_staff = 2
+        self.save(plan)
+        self.client.force_login(self.business.user)
+        self.assertTrue(get_entitlements(self.fresh_business())['can_add_staff'])  # en caché: 1 de 2
+        # Una carga masiva no dispara señales: la caché sigue diciendo 1 de 2
+        StaffMember.objects.bulk_create([StaffMember(business=self.business, name="Importado")])
+        self.assertTrue(get_entitlements(self.fresh_business())['can_add_staff'])
+
+        self.client.post(reverse('add_owner_as_staff'))
+        self.assertFalse(StaffMember.objects.filter(user=self.business.user).exists())
+        self.client.post(reverse('manage_staff'), {'name': "Otro más"})
+        self.assertEqual(StaffMember.objects.filter(business=self.business).count(), 2)
+
+    def test_manage_staff_page_uses_entitlements(self):
+        self.client.force_login(self.business.user)
+        response = self.client.get(reverse('manage_staff'))
+        self.assertEqual(response.context['current_staff_count'], 1)
+        self.assertEqual(response.context['max_staff'], 1)
+        self.assertFalse(response.context['can_add_staff'])
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('manage_staff'))
+        self.assertFalse([q for q in queries.captured_queries if 'users_subscription' in q['sql']])
+
+
+class LoyaltyAccrualTests(DailyMetricsDataMixin, TestCase):
+    """
+    Puntos de fidelidad al completar citas: historial en bloque, saldo y nivel con F()
+    y reconciliación del saldo desde el historial.
+    """
+    def set_status(self, appointment, status):
+        return self.client.post(
+            reverse('api_update_appointment_status'),
+            data=json.dumps({'appointment_id': appointment.pk, 'status': status}),
+            content_type='application/json',
+        )
+
+    def test_completing_through_the_api_accrues_once(self):
+        appointment = self.book(-1, 10)
+        self.client.force_login(self.business.user)
+        self.assertEqual(self.set_status(appointment, 'COMPLETED').status_code, 200)
+        card = LoyaltyCard.objects.get(customer=self.customer)
+        self.assertEqual((card.points, card.tier_level), (20, 'Bronce'))
+        log = card.logs.get()
+        self.assertEqual((log.appointment_id, log.points_change, log.reason), (appointment.pk, 20, "Cita completada"))
+
+        # Repetir, o volver a completar tras un cambio de estado, no suma otra vez
+        self.set_status(appointment, 'COMPLETED')
+        self.set_status(appointment, 'SCHEDULED')
+        self.set_status(appointment, 'COMPLETED')
+        card.refresh_from_db()
+        self.assertEqual(card.points, 20)
+        self.assertEqual(LoyaltyLog.objects.count(), 1)
+
+    def test_bulk_accrual_uses_constant_queries_and_promotes_tier(self):
+        LoyaltyCard.objects.create(customer=self.customer, points=90)
+        other_user = User.objects.create_user(username='otro.cliente@tivy.app', email='otro.cliente@tivy.app', password='x')
+        other_customer = Customer.objects.create(user=other_user, business=self.business)
+        appointments = [self.book(-days, 10, status='COMPLETED') for days in range(1, 6)]
+        appointments[-1].customer = other_customer
+        appointments[-1].save(update_fields=['customer'])
+        appointments.append(self.book(-6, 10))  # agendada: no suma
+
+        # Citas ya acumuladas, alta de tarjetas, tarjetas, precios, historial y UPDATE (+ savepoint y su cierre)
+        with self.assertNumQueries(8):
+            deltas = accrue_for_completed(appointments)
+        self.assertEqual(sorted(deltas.values()), [20, 80])
+        card = LoyaltyCard.objects.get(customer=self.customer)
+        self.assertEqual((card.points, card.tier_level), (170, 'Plata'))
+        self.assertEqual(LoyaltyCard.objects.get(customer=other_customer).points, 20)
+        self.assertEqual(accrue_for_completed(appointments), {})
+
+    def test_reconcile_recomputes_balances_from_the_ledger(self):
+        self.client.force_login(self.business.user)
+        self.set_status(self.book(-1, 10), 'COMPLETED')
+        card = LoyaltyCard.objects.get(customer=self.customer)
+        LoyaltyLog.objects.create(card=card, points_change=100, reason="Bono de bienvenida")
+        LoyaltyCard.objects.filter(pk=card.pk).update(points=5)
+
+        with self.assertNumQueries(1):
+            self.assertEqual([c.points for c in reconcile_balances(dry_run=True)], [120])
+        out = StringIO()
+        call_command('reconcile_loyalty', stdout=out)
+        self.assertIn("Tarjetas corregidas: 1", out.getvalue())
+        card.refresh_from_db()
+        self.assertEqual((card.points, card.tier_level), (120, 'Plata'))
+        self.assertEqual(reconcile_balances(), [])
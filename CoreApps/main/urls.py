@@ -11,6 +11,8 @@ from .views import (
     DashboardView,
     BusinessPublicProfileView,
     SelectStaffAndTimeView,
+    api_availability_calendar,
+    api_first_available_slots,
     ConfirmBookingView,    # <-- Descomentamos esta importación
     BookingConfirmedView,
     RescheduleAppointmentView,
@@ -75,6 +77,8 @@ urlpatterns = [
     #--------------Flujo de reserva------------------------------------------------------------------------#
     path('p/<slug:slug>/', BusinessPublicProfileView.as_view(), name='business_profile'),
     path('p/<slug:slug>/select-time/', SelectStaffAndTimeView.as_view(), name='select_staff_and_time'),
+    path('p/<slug:slug>/availability/', api_availability_calendar, name='api_availability_calendar'),
+    path('p/<slug:slug>/first-available/', api_first_available_slots, name='api_first_available_slots'),
     path('p/<slug:slug>/confirm/', ConfirmBookingView.as_view(), name='confirm_booking'),
     path('booking-confirmed/<int:pk>/', BookingConfirmedView.as_view(), name='booking_confirmed'),
     path('appointment/<int:pk>/reschedule/', RescheduleAppointmentView.as_view(), name='reschedule_appointment'),
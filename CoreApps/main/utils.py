@@ -1,96 +1,307 @@
 # CoreApps/main/utils.py
 
-from datetime import datetime, timedelta
+from bisect import bisect_right
+from datetime import datetime, time, timedelta
+from django.db.models import Q
 from django.utils import timezone
-# Importamos los 3 modelos relevantes de scheduling
-from CoreApps.scheduling.models import AvailabilityBlock, Appointment, TimeOffBlock
+# Importamos los modelos relevantes de scheduling
+from CoreApps.scheduling.models import AvailabilityBlock, AvailabilityRule, Appointment, SlotHold, TimeOffBlock
 
-def generate_available_slots(staff_member, service, target_date, is_domicilio=False):
-    """
-    Calcula los slots de tiempo disponibles considerando horario laboral (AvailabilityBlock),
-    bloqueos (TimeOffBlock) y citas existentes (Appointment).
-    """
-    available_slots = []
-    business = staff_member.business
-
-    # 1. Obtener los bloques de horario laboral para el día
-    working_blocks = AvailabilityBlock.objects.filter(
-        staff_member=staff_member,
-        start_time__date=target_date # Filtra por la fecha exacta de inicio
-    ).order_by('start_time')
+# Paso mínimo para buscar (granularidad de los slots)
+PROBE_STEP = timedelta(minutes=15)
 
-    # Si no hay horario laboral definido para ese día, no hay slots.
-    if not working_blocks:
-        return []
 
-    # 2. Obtener TODOS los eventos que bloquean tiempo en ese día
-    time_off_blocks = TimeOffBlock.objects.filter(
-        staff_member=staff_member,
-        start_time__date=target_date # Filtra bloqueos que inician ese día
-        # Consideración: Bloqueos que abarcan varios días podrían necesitar un filtro más complejo
-        # ej. filter(staff_member=staff_member, start_time__lte=datetime.combine(target_date, time.max), end_time__gte=datetime.combine(target_date, time.min))
-    )
-    existing_appointments = Appointment.objects.filter(
-        staff_member=staff_member,
-        start_time__date=target_date # Filtra citas que inician ese día
-    )
-
-    # Combinamos todos los bloqueos (citas y tiempo libre) en una lista para facilitar la comprobación
-    blockers = []
-    for block in time_off_blocks:
-        blockers.append((block.start_time, block.end_time))
-    for app in existing_appointments:
-        blockers.append((app.start_time, app.end_time))
-    
-    # Ordenamos los bloqueos por hora de inicio
-    blockers.sort()
-
-    # 3. Calcular la duración TOTAL del bloqueo necesario para el servicio (incluye buffer si aplica)
-    service_actual_duration = service.duration
-    block_duration_with_buffer = service_actual_duration # Duración base
+def get_block_duration(service, business, is_domicilio=False):
+    """
+    Duración TOTAL que bloquea un servicio en la agenda (incluye el buffer de traslado
+    del negocio si el servicio es a domicilio).
+    """
+    block_duration_with_buffer = service.duration # Duración base
     if is_domicilio:
         try:
             # Añadimos el buffer del negocio si es a domicilio
             block_duration_with_buffer += business.travel_buffer
         except TypeError:
              # Manejo básico de error si los tipos no son compatibles (DurationField debería prevenir esto)
-             print(f"Advertencia: No se pudo sumar duration ({type(service_actual_duration)}) y travel_buffer ({type(business.travel_buffer)}) para {business}. Usando duración base.")
+             print(f"Advertencia: No se pudo sumar duration ({type(service.duration)}) y travel_buffer ({type(business.travel_buffer)}) para {business}. Usando duración base.")
              pass # Continuar sin el buffer en caso de error
+    return block_duration_with_buffer
+
+
+def get_advance_step(service):
+    """
+    Cuánto se avanza después de encontrar un slot: la duración del servicio (SIN el buffer
+    de traslado), y nunca menos que PROBE_STEP.
+    """
+    return max(service.duration, PROBE_STEP)
+
+
+def merge_intervals(intervals):
+    """
+    Ordena y fusiona intervalos (inicio, fin) que se solapan o se tocan.
+    Devuelve una lista de intervalos disjuntos ordenados por inicio.
+    """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            # Se solapa (o toca) con el último: extendemos su fin si hace falta
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
 
-    # 4. Definir el paso mínimo para buscar (granularidad)
-    probe_step = timedelta(minutes=15)
-    # El avance después de encontrar un slot debe ser al menos el probe_step
-    advance_step_after_found = max(service_actual_duration, probe_step)
+def _first_probe_at_or_after(current_time, limit, probe_step):
+    """
+    Devuelve el primer current_time + k*probe_step (k >= 1) que sea >= limit.
+    Equivale a avanzar de probe_step en probe_step, pero sin iterar paso a paso.
+    """
+    steps = max(1, -((current_time - limit) // probe_step)) # ceil((limit - current) / step)
+    # Ajuste fino: la suma de timedelta sobre horas "aware" es aritmética de reloj local,
+    # así que corregimos por si el cálculo absoluto difiere (ej: cambios de horario).
+    while steps > 1 and current_time + (steps - 1) * probe_step >= limit:
+        steps -= 1
+    while current_time + steps * probe_step < limit:
+        steps += 1
+    return current_time + steps * probe_step
+
+
+def compute_slots_for_day(target_date, working_blocks, blockers, block_duration, advance_step, probe_step=PROBE_STEP):
+    """
+    Motor de barrido (sweep-line) para un día.
 
+    - working_blocks: lista de (inicio, fin) del horario laboral, en el orden en que se recorren.
+    - blockers: lista de (inicio, fin) que ocupan tiempo (citas, bloqueos).
 
-    # 5. Iterar sobre cada bloque de horario laboral del día
-    for work_block in working_blocks:
+    Los bloqueos se fusionan UNA vez en intervalos ordenados y cada bloque laboral se recorre
+    en una sola pasada lineal: cuando un slot choca, saltamos directamente al primer paso
+    libre después del bloqueo en lugar de re-escanear toda la lista de bloqueos.
+    Devuelve la lista de horas disponibles en formato '%H:%M'.
+    """
+    available_slots = []
+    merged = merge_intervals(blockers)
+    merged_ends = [end for _, end in merged]
+
+    for work_start, work_end in working_blocks:
         # Asegurar que las horas sean "aware" y usen la fecha correcta
-        # Usamos .time() por si el DateTimeField tuviera fecha incorrecta (aunque no debería si se filtra por __date)
-        current_time = timezone.make_aware(datetime.combine(target_date, work_block.start_time.time()))
-        work_end_time = timezone.make_aware(datetime.combine(target_date, work_block.end_time.time()))
-
-        # Iterar dentro del bloque laboral buscando huecos
-        while (current_time + block_duration_with_buffer) <= work_end_time:
-            slot_start_time = current_time
-            slot_end_time = current_time + block_duration_with_buffer
-            
-            # --- Comprobar colisión con CUALQUIER bloqueo (TimeOff o Appointment) ---
-            has_conflict = False
-            for block_start, block_end in blockers:
-                # Hay solapamiento si el inicio del slot es antes que el fin del bloqueo Y
-                # el fin del slot es después que el inicio del bloqueo.
-                if slot_start_time < block_end and slot_end_time > block_start:
-                    has_conflict = True
-                    break # Conflicto encontrado, no seguir revisando bloqueos para este slot
-
-            # --- Decisión: Añadir slot o seguir buscando ---
-            if not has_conflict:
-                # ¡Hueco encontrado! Añadir y avanzar por la duración del servicio (o el probe_step)
-                available_slots.append(slot_start_time.strftime('%H:%M'))
-                current_time += advance_step_after_found
+        current_time = timezone.make_aware(datetime.combine(target_date, work_start.time()))
+        work_end_time = timezone.make_aware(datetime.combine(target_date, work_end.time()))
+
+        # Primer bloqueo que todavía no terminó al inicio del bloque laboral
+        index = bisect_right(merged_ends, current_time)
+
+        while (current_time + block_duration) <= work_end_time:
+            # Descartamos los bloqueos que ya terminaron antes del slot actual
+            while index < len(merged) and merged[index][1] <= current_time:
+                index += 1
+
+            slot_end_time = current_time + block_duration
+            if index < len(merged) and merged[index][0] < slot_end_time:
+                # Conflicto: el slot sigue chocando hasta que el bloqueo termine
+                current_time = _first_probe_at_or_after(current_time, merged[index][1], probe_step)
             else:
-                # Conflicto: Avanzar solo el pequeño paso para probar el siguiente posible inicio
-                current_time += probe_step
+                # ¡Hueco encontrado! Añadir y avanzar por la duración del servicio (o el probe_step)
+                available_slots.append(current_time.strftime('%H:%M'))
+                current_time += advance_step
+
+    return available_slots
+
+
+def local_day_bounds(start_date, end_date=None):
+    """
+    Devuelve (inicio, fin) "aware" que cubren los días locales start_date..end_date (incluidos),
+    como rango semiabierto [inicio, fin). Filtrar con start_time__gte=inicio, start_time__lt=fin
+    equivale a start_time__date__gte/lte, pero sin aplicar una función a la columna,
+    así la base de datos puede usar los índices sobre (staff/negocio, start_time).
+    """
+    end_date = end_date or start_date
+    return (
+        timezone.make_aware(datetime.combine(start_date, time.min)),
+        timezone.make_aware(datetime.combine(end_date + timedelta(days=1), time.min)),
+    )
+
 
-    return available_slots
\ No newline at end of file
+def _group_intervals_by_staff_day(rows):
+    """
+    Agrupa filas (staff_member_id, inicio, fin) en {(staff_member_id, fecha_local): [(inicio, fin), ...]}.
+    La fecha es la del inicio en la zona horaria actual (igual que local_day_bounds).
+    """
+    grouped = {}
+    for staff_member_id, start_time, end_time in rows:
+        key = (staff_member_id, timezone.localdate(start_time))
+        grouped.setdefault(key, []).append((start_time, end_time))
+    return grouped
+
+
+def generate_available_slots_range(staff_members, service, start_date, end_date, is_domicilio=False):
+    """
+    Calcula los slots disponibles de varios miembros del personal para un RANGO de días.
+    Hace UNA consulta por tabla (AvailabilityBlock, AvailabilityRule, TimeOffBlock, Appointment,
+    SlotHold) para todo el rango y todo el personal, y agrupa en memoria por (staff, día).
+    Devuelve {fecha: {staff_member.pk: [slots '%H:%M']}} con todas las fechas del rango.
+    """
+    return generate_available_slots_range_with_expiries(staff_members, service, start_date, end_date, is_domicilio)[0]
+
+
+def generate_available_slots_range_with_expiries(staff_members, service, start_date, end_date, is_domicilio=False):
+    """
+    Igual que generate_available_slots_range, pero devuelve (resultados, vencimientos) donde
+    vencimientos es {(staff_member.pk, fecha): primer expires_at de las reservas temporales}.
+    La caché de slots lo usa para que una lista calculada con una reserva vigente
+    no sobreviva al vencimiento de esa reserva.
+    """
+    staff_members = list(staff_members)
+    days = [start_date + timedelta(days=offset) for offset in range((end_date - start_date).days + 1)]
+    results = {day: {staff.pk: [] for staff in staff_members} for day in days}
+    hold_expiries = {}
+    if not staff_members or not days:
+        return results, hold_expiries
+
+    # Rango semiabierto [inicio, fin) de los días pedidos (usa los índices por staff + start_time)
+    range_start, range_end = local_day_bounds(start_date, end_date)
+
+    # 1. Bloques de horario laboral del rango para todo el personal
+    working_by_staff_day = _group_intervals_by_staff_day(
+        AvailabilityBlock.objects.filter(
+            staff_member__in=staff_members,
+            start_time__gte=range_start,
+            start_time__lt=range_end,
+        ).order_by('start_time').values_list('staff_member_id', 'start_time', 'end_time')
+    )
+    # + Reglas recurrentes vigentes en el rango, expandidas solo para las fechas pedidas
+    rules = AvailabilityRule.objects.filter(
+        staff_member__in=staff_members,
+        valid_from__lte=end_date,
+    ).filter(Q(valid_until__isnull=True) | Q(valid_until__gte=start_date))
+    for rule in rules:
+        for day, start_time, end_time in rule.occurrences(start_date, end_date):
+            working_by_staff_day.setdefault((rule.staff_member_id, day), []).append((start_time, end_time))
+    for working_blocks in working_by_staff_day.values():
+        working_blocks.sort()
+
+    # Si nadie tiene horario laboral en el rango, no hay slots (ni hace falta buscar bloqueos).
+    if not working_by_staff_day:
+        return results, hold_expiries
+    working_staff_ids = {staff_member_id for staff_member_id, _ in working_by_staff_day}
+
+    # 2. Eventos que bloquean tiempo en el rango (solo para quien trabaja en él)
+    blockers_by_staff_day = _group_intervals_by_staff_day(
+        TimeOffBlock.objects.filter(
+            staff_member_id__in=working_staff_ids,
+            start_time__gte=range_start, # Bloqueos que inician dentro del rango
+            start_time__lt=range_end,
+        ).values_list('staff_member_id', 'start_time', 'end_time')
+    )
+    for key, intervals in _group_intervals_by_staff_day(
+        Appointment.blocking_appointments().filter(
+            staff_member_id__in=working_staff_ids,
+            start_time__gte=range_start, # Citas que inician dentro del rango
+            start_time__lt=range_end,
+        ).values_list('staff_member_id', 'start_time', 'end_time')
+    ).items():
+        blockers_by_staff_day.setdefault(key, []).extend(intervals)
+    # Reservas temporales vigentes (checkout en curso); las vencidas se ignoran sin borrarlas
+    for staff_member_id, start_time, end_time, expires_at in SlotHold.objects.filter(
+        staff_member_id__in=working_staff_ids,
+        start_time__gte=range_start,
+        start_time__lt=range_end,
+        expires_at__gt=timezone.now(),
+    ).values_list('staff_member_id', 'start_time', 'end_time', 'expires_at'):
+        key = (staff_member_id, timezone.localdate(start_time))
+        blockers_by_staff_day.setdefault(key, []).append((start_time, end_time))
+        hold_expiries[key] = min(expires_at, hold_expiries.get(key, expires_at))
+
+    # 3. El avance después de encontrar un slot debe ser al menos el probe_step
+    advance_step_after_found = get_advance_step(service)
+
+    # 4. Barrido lineal por cada (staff, día) con horario laboral
+    for staff in staff_members:
+        if staff.pk not in working_staff_ids:
+            continue
+        # Solo tocamos staff.business si hace falta el buffer (evita consultas extra)
+        business = staff.business if is_domicilio else None
+        block_duration_with_buffer = get_block_duration(service, business, is_domicilio)
+        for day in days:
+            working_blocks = working_by_staff_day.get((staff.pk, day))
+            if not working_blocks:
+                continue
+            results[day][staff.pk] = compute_slots_for_day(
+                day,
+                working_blocks,
+                blockers_by_staff_day.get((staff.pk, day), []),
+                block_duration_with_buffer,
+                advance_step_after_found,
+            )
+    return results, hold_expiries
+
+
+def count_available_slots_by_day(staff_members, service, start_date, end_date, is_domicilio=False):
+    """
+    Cantidad total de slots disponibles por día (sumando todo el personal) en el rango.
+    Devuelve {fecha: cantidad}. Pensado para el calendario/heatmap del flujo de reserva.
+    """
+    slots_by_day = generate_available_slots_range(staff_members, service, start_date, end_date, is_domicilio)
+    return {
+        day: sum(len(slots) for slots in slots_by_staff.values())
+        for day, slots_by_staff in slots_by_day.items()
+    }
+
+
+def find_first_available_slots(staff_members, service, limit=5, start=None, max_days=60, window_days=7, is_domicilio=False):
+    """
+    Busca los primeros 'limit' slots libres ("¿cuándo es lo más pronto?") entre todo el personal,
+    avanzando desde 'start' (por defecto ahora) en ventanas de 'window_days' días.
+    Cada ventana se resuelve con una consulta por tabla y la búsqueda termina en cuanto
+    se juntan suficientes resultados, sin revisar días posteriores.
+    Devuelve una lista ordenada de dicts {'start', 'date', 'time', 'staff'}.
+    """
+    staff_members = list(staff_members)
+    if not staff_members or limit <= 0:
+        return []
+
+    now = start or timezone.now()
+    first_day = timezone.localdate(now)
+    last_day = first_day + timedelta(days=max_days - 1)
+    staff_order = {staff.pk: index for index, staff in enumerate(staff_members)}
+    staff_by_pk = {staff.pk: staff for staff in staff_members}
+
+    found = []
+    window_start = first_day
+    while window_start <= last_day and len(found) < limit:
+        window_end = min(window_start + timedelta(days=window_days - 1), last_day)
+        slots_by_day = generate_available_slots_range(staff_members, service, window_start, window_end, is_domicilio)
+
+        for day in sorted(slots_by_day):
+            candidates = []
+            for staff_pk, slots in slots_by_day[day].items():
+                for slot in slots:
+                    slot_start = timezone.make_aware(datetime.combine(day, datetime.strptime(slot, '%H:%M').time()))
+                    if slot_start > now: # Ignoramos horarios que ya pasaron
+                        candidates.append((slot_start, staff_order[staff_pk], slot, staff_pk))
+            # Mismo orden para todos: por hora y luego por el orden del personal recibido
+            for slot_start, _, slot, staff_pk in sorted(candidates):
+                found.append({'start': slot_start, 'date': day, 'time': slot, 'staff': staff_by_pk[staff_pk]})
+                if len(found) >= limit:
+                    return found
+
+        window_start = window_end + timedelta(days=1)
+    return found
+
+
+def generate_available_slots_bulk(staff_members, service, target_date, is_domicilio=False):
+    """
+    Versión por lotes de generate_available_slots para varios miembros del personal.
+    Carga el horario laboral, TimeOffBlock y Appointment con UNA consulta por tabla para
+    todo el personal y agrupa en memoria, así el número de consultas no crece con el staff.
+    Devuelve un diccionario {staff_member.pk: [slots '%H:%M']}.
+    """
+    return generate_available_slots_range(staff_members, service, target_date, target_date, is_domicilio)[target_date]
+
+
+def generate_available_slots(staff_member, service, target_date, is_domicilio=False):
+    """
+    Calcula los slots de tiempo disponibles considerando horario laboral (AvailabilityBlock
+    y reglas recurrentes AvailabilityRule), bloqueos (TimeOffBlock) y citas existentes (Appointment).
+    """
+    return generate_available_slots_bulk([staff_member], service, target_date, is_domicilio)[staff_member.pk]
@@ -14,29 +14,43 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import AuthenticationForm
 from django.contrib.auth.hashers import make_password
 from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers, quote_etag
 from datetime import datetime, date, timedelta, time
 from urllib.parse import urlencode # Para generar el link de Google Calendar
 from django.utils.timezone import localtime # Para mostrar la hora local
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.http import HttpResponseForbidden
 from django.core.exceptions import ObjectDoesNotExist
-from django.db.models import Q, Sum, Count
+from django.db.models import Q, Sum, Count, Max
 from django.contrib import messages
 from django.contrib.auth import login
-from django.db import transaction
+from django.db import IntegrityError, transaction
 # from .forms import RegistrationForm # <-- Descomentaremos esto luego
 from django.urls import reverse_lazy # Para la redirección
 from .forms import UserProfileForm, BusinessConfigForm, StaffMemberForm, ServiceForm # <-- Importar el nuevo form
+import hashlib
 import json
+import uuid
 
 # Importaciones de los nuevos modelos y utilidades
 from CoreApps.users.models import Business, StaffMember, User, Customer, Plan, Subscription, ServiceZone
-from CoreApps.scheduling.models import AvailabilityBlock, TimeOffBlock
+from CoreApps.scheduling.models import AvailabilityBlock, AvailabilityRule, TimeOffBlock
 from CoreApps.catalog.models import Service
 from CoreApps.scheduling.models import Appointment
-from .utils import generate_available_slots
+from .utils import generate_available_slots, count_available_slots_by_day, find_first_available_slots, local_day_bounds
+from .slot_cache import get_available_slots_cached, get_staff_available_slots_cached, invalidate_staff
+from .booking import SlotUnavailable, book_appointment, place_hold, release_holds
+from .dashboard_metrics import get_dashboard_metrics_cached
+from .entitlements import build_entitlements, get_entitlements
+from .loyalty_points import accrue_for_completed
+from .profile_cache import PUBLIC_PROFILE_MAX_AGE, get_public_profile
+from .calendar_feed import (
+    FastJsonResponse, InvalidSyncToken, appointment_events, changed_since, get_appointments_scope,
+    make_sync_token, read_sync_token
+)
 from django.template.loader import render_to_string
-from CoreApps.main.wasenderapi_utils import send_whatsapp_message
+from .outbox import enqueue_whatsapp
+from CoreApps.users.phone import normalize_phone_number
 
 from .forms import EmailAuthenticationForm
 import logging
@@ -211,23 +225,19 @@ class DashboardView(LoginRequiredMixin, TemplateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         user = self.request.user
-        business = None
-        subscription = None
-        plan = None
 
-        # --- Lógica de Negocio y Suscripción (EXISTENTE Y SIN CAMBIOS) ---
+        # --- Lógica de Negocio y Suscripción (permisos del plan en caché, ver entitlements.py) ---
         try:
             business = Business.objects.get(user=user)
-            subscription = Subscription.objects.select_related('plan').get(business=business)
-            plan = subscription.plan
         except Business.DoesNotExist:
             raise Http404("Perfil de negocio no encontrado para este usuario.")
-        except Subscription.DoesNotExist:
+        entitlements = get_entitlements(business)
+        subscription = entitlements['subscription']
+        plan = entitlements['plan']
+        if subscription is None:
             messages.error(self.request, "Error: No se encontró una suscripción para tu negocio.")
-            pass 
 
-        allowed_statuses = ['ACTIVE', 'TRIAL', 'DEMO']
-        is_subscription_valid = subscription and subscription.status in allowed_statuses
+        is_subscription_valid = entitlements['is_valid']
 
         if not is_subscription_valid:
             self.template_name = "dashboard/dashboard_restricted.html" # Plantilla restringida
@@ -241,77 +251,9 @@ class DashboardView(LoginRequiredMixin, TemplateView):
         # --- INICIO DE NUEVA LÓGICA: DATOS DEL DASHBOARD ---
         # Solo calculamos esto si la suscripción es válida
         if is_subscription_valid and business:
-            
-            # --- Definir Fechas ---
-            today = timezone.localdate()
-            now = timezone.now()
-            seven_days_ago = today - timedelta(days=6)
-            thirty_days_ago = today - timedelta(days=29)
-
-            # --- 1. KPIs (Tarjetas Superiores) ---
-            
-            # Citas e Ingresos de HOY
-            today_appointments = Appointment.objects.filter(
-                business=business, 
-                start_time__date=today
-            )
-            context['kpi_total_appointments_today'] = today_appointments.exclude(status='CANCELED').count()
-            
-            context['kpi_revenue_today'] = today_appointments.exclude(status='CANCELED').aggregate(
-                total=Sum('service__price')
-            )['total'] or 0
-            
-            # Nuevos Clientes (Últimos 7 días)
-            context['kpi_new_clients_week'] = Customer.objects.filter(
-                business=business, 
-                created_at__date__gte=seven_days_ago
-            ).count()
-
-            # --- 2. Lista de Próximas Citas ---
-            context['upcoming_appointments'] = Appointment.objects.filter(
-                business=business, 
-                start_time__gte=now, 
-                status='SCHEDULED'
-            ).select_related('service', 'customer', 'staff_member').order_by('start_time')[:3] # Próximas 3
-
-            # --- 3. Datos para Gráficos ---
-
-            # Gráfico de Barras: Rendimiento Semanal (Citas completadas)
-            daily_counts_qs = Appointment.objects.filter(
-                business=business, 
-                start_time__date__gte=seven_days_ago, 
-                status='COMPLETED'
-            ).values('start_time__date').annotate(count=Count('id')).order_by('start_time__date')
-            
-            # Formatear para Chart.js
-            date_map = {item['start_time__date']: item['count'] for item in daily_counts_qs}
-            chart_labels_weekly = []
-            chart_data_weekly = []
-            for i in range(7):
-                date = seven_days_ago + timedelta(days=i)
-                chart_labels_weekly.append(date.strftime('%a %d')) # Ej: "Lun 27"
-                chart_data_weekly.append(date_map.get(date, 0))
-
-            context['chart_weekly_labels'] = json.dumps(chart_labels_weekly)
-            context['chart_weekly_data'] = json.dumps(chart_data_weekly)
-
-            # Gráfico de Pastel: Top 5 Servicios (Últimos 30 días)
-            top_services_qs = Appointment.objects.filter(
-                business=business, 
-                start_time__date__gte=thirty_days_ago
-            ).values('service__name').annotate(count=Count('id')).order_by('-count')[:5]
-
-            context['chart_top_services_labels'] = json.dumps([item['service__name'] for item in top_services_qs])
-            context['chart_top_services_data'] = json.dumps([item['count'] for item in top_services_qs])
-
-            # Gráfico de Pastel: Top 5 Staff (Últimos 30 días)
-            top_staff_qs = Appointment.objects.filter(
-                business=business, 
-                start_time__date__gte=thirty_days_ago
-            ).values('staff_member__name').annotate(count=Count('id')).order_by('-count')[:5]
-
-            context['chart_top_staff_labels'] = json.dumps([item['staff_member__name'] for item in top_staff_qs])
-            context['chart_top_staff_data'] = json.dumps([item['count'] for item in top_staff_qs])
+            # KPIs, próximas citas y gráficos (ver CoreApps/main/dashboard_metrics.py),
+            # en caché por negocio durante unos segundos
+            context.update(get_dashboard_metrics_cached(business))
 
         return context
 
@@ -393,9 +335,12 @@ class ManageStaffView(LoginRequiredMixin, FormMixin, ListView):
         context = super().get_context_data(**kwargs)
         try:
             business = self.request.user.business_profile
-            subscription = Subscription.objects.select_related('plan').get(business=business)
-            plan = subscription.plan
-        except (Business.DoesNotExist, Subscription.DoesNotExist):
+        except Business.DoesNotExist:
+            business = None
+        # Permisos del plan (suscripción, límite y conteo de personal) en caché, ver entitlements.py
+        entitlements = get_entitlements(business) if business else None
+        plan = entitlements['plan'] if entitlements else None
+        if plan is None:
              messages.error(self.request, "No se pudo cargar la información de tu negocio o suscripción.")
              context['can_add_staff'] = False
              context['limit_message'] = "Error al cargar datos."
@@ -409,7 +354,7 @@ class ManageStaffView(LoginRequiredMixin, FormMixin, ListView):
              return context
 
         context['business'] = business
-        context['subscription'] = subscription
+        context['subscription'] = entitlements['subscription']
         context['plan'] = plan
 
         # --- INICIO DE NUEVA LÓGICA ---
@@ -421,11 +366,10 @@ class ManageStaffView(LoginRequiredMixin, FormMixin, ListView):
             context['is_owner_staff'] = False
         # --- FIN DE NUEVA LÓGICA ---
 
-        current_staff_count = self.get_queryset().count()
-        max_staff = plan.max_staff
-        can_add = (max_staff == -1) or (current_staff_count < max_staff)
+        max_staff = entitlements['max_staff']
+        can_add = entitlements['can_add_staff']
 
-        context['current_staff_count'] = current_staff_count
+        context['current_staff_count'] = entitlements['staff_count']
         context['max_staff'] = "Ilimitado" if max_staff == -1 else max_staff
         context['can_add_staff'] = can_add
         if not can_add:
@@ -437,15 +381,18 @@ class ManageStaffView(LoginRequiredMixin, FormMixin, ListView):
     def post(self, request, *args, **kwargs):
         try:
             business = request.user.business_profile
-            subscription = Subscription.objects.select_related('plan').get(business=business)
-            plan = subscription.plan
-        except (Business.DoesNotExist, Subscription.DoesNotExist):
+        except Business.DoesNotExist:
+            messages.error(request, "Error al procesar la solicitud.")
+            return redirect('manage_staff')
+        # Antes de crear personal se cuenta en la base de datos, no en la caché: un cambio que no
+        # pasa por señales (borrado masivo, update, acciones del admin) dejaría el conteo desfasado
+        entitlements = build_entitlements(business.pk)
+        if entitlements['plan'] is None:
             messages.error(request, "Error al procesar la solicitud.")
             return redirect('manage_staff')
 
-        current_staff_count = StaffMember.objects.filter(business=business).count()
-        max_staff = plan.max_staff
-        if max_staff != -1 and current_staff_count >= max_staff:
+        max_staff = entitlements['max_staff']
+        if not entitlements['can_add_staff']:
              messages.error(request, f"No puedes añadir más personal. Has alcanzado el límite de {max_staff} para tu plan.")
              return redirect('manage_staff')
 
@@ -813,20 +760,15 @@ def add_owner_as_staff_view(request):
         messages.warning(request, "Ya eres parte del personal.")
         return redirect('manage_staff')
 
-    # 2. Comprobar el límite de personal (lógica copiada de tu ManageStaffView.post)
-    try:
-        subscription = Subscription.objects.select_related('plan').get(business=business)
-        plan = subscription.plan
-        current_staff_count = StaffMember.objects.filter(business=business).count()
-        max_staff = plan.max_staff
-        
-        if max_staff != -1 and current_staff_count >= max_staff:
-            messages.error(request, f"No puedes añadirte. Has alcanzado el límite de {max_staff} para tu plan.")
-            return redirect('manage_staff')
-            
-    except Subscription.DoesNotExist:
+    # 2. Comprobar el límite de personal (lógica copiada de tu ManageStaffView.post),
+    # con el conteo real de la base de datos (no el de la caché) porque vamos a crear personal
+    entitlements = build_entitlements(business.pk)
+    if entitlements['plan'] is None:
         messages.error(request, "Error al verificar la suscripción.")
         return redirect('manage_staff')
+    if not entitlements['can_add_staff']:
+        messages.error(request, f"No puedes añadirte. Has alcanzado el límite de {entitlements['max_staff']} para tu plan.")
+        return redirect('manage_staff')
 
     # 3. Todo en orden. Crear el StaffMember para el dueño.
     owner_name = request.user.get_full_name() or request.user.email
@@ -872,49 +814,48 @@ def api_create_availability(request):
         if end_datetime <= start_datetime:
             return JsonResponse({'success': False, 'error': 'La hora de fin debe ser posterior a la hora de inicio.'}, status=400)
 
-        blocks_to_create = []
-
         if is_repeating and repeat_days and repeat_until_str:
             # --- Lógica de Recurrencia ---
+            # Guardamos UNA regla por día de la semana; el motor de slots la expande
+            # solo para las fechas que se consultan (ya no se crean cientos de bloques).
             repeat_until_date = datetime.strptime(repeat_until_str, '%Y-%m-%d').date()
-            current_date = start_datetime.date()
-            end_repeat_date = min(repeat_until_date, current_date + timedelta(days=365)) # Límite de 1 año
-
-            repeat_days_int = [int(day) for day in repeat_days] # Convertir a enteros (0=Lunes, 6=Domingo)
-
-            while current_date <= end_repeat_date:
-                # Si el día de la semana está en los días seleccionados
-                if current_date.weekday() in repeat_days_int:
-                    # Crear el datetime de inicio y fin para ESE día
-                    new_start_dt = timezone.make_aware(datetime.combine(current_date, start_time_obj))
-                    new_end_dt = timezone.make_aware(datetime.combine(current_date, end_time_obj))
-                    
-                    blocks_to_create.append(
-                        AvailabilityBlock(
-                            staff_member=staff_member,
-                            start_time=new_start_dt,
-                            end_time=new_end_dt,
-                            staff_can_edit=staff_can_edit
-                        )
-                    )
-                current_date += timedelta(days=1)
-        else:
-            # --- Creación Única ---
-            blocks_to_create.append(
-                AvailabilityBlock(
+            if repeat_until_date < start_datetime.date():
+                return JsonResponse({'success': False, 'error': 'La fecha "Repetir hasta" debe ser posterior al inicio.'}, status=400)
+            if end_time_obj <= start_time_obj:
+                return JsonResponse({'success': False, 'error': 'Un horario recurrente debe empezar y terminar el mismo día.'}, status=400)
+
+            repeat_days_int = sorted({int(day) for day in repeat_days}) # Convertir a enteros (0=Lunes, 6=Domingo)
+
+            rules_to_create = [
+                AvailabilityRule(
                     staff_member=staff_member,
-                    start_time=timezone.make_aware(start_datetime),
-                    end_time=timezone.make_aware(end_datetime),
+                    weekday=weekday,
+                    start_time=start_time_obj,
+                    end_time=end_time_obj,
+                    valid_from=start_datetime.date(),
+                    valid_until=repeat_until_date,
                     staff_can_edit=staff_can_edit
                 )
-            )
+                for weekday in repeat_days_int
+            ]
+            AvailabilityRule.objects.bulk_create(rules_to_create)
+
+            # bulk_create no dispara señales: invalidamos a mano la caché de slots del staff
+            invalidate_staff(staff_member.id)
+
+            return JsonResponse({'success': True, 'message': f'Se crearon {len(rules_to_create)} horarios recurrentes.'})
 
         # TODO: Añadir validación de solapamiento (overlap) aquí antes de crear
 
-        # Crear todos los bloques en la base de datos
-        AvailabilityBlock.objects.bulk_create(blocks_to_create)
-        
-        return JsonResponse({'success': True, 'message': f'Se crearon {len(blocks_to_create)} bloques.'})
+        # --- Creación Única ---
+        AvailabilityBlock.objects.create(
+            staff_member=staff_member,
+            start_time=timezone.make_aware(start_datetime),
+            end_time=timezone.make_aware(end_datetime),
+            staff_can_edit=staff_can_edit
+        )
+
+        return JsonResponse({'success': True, 'message': 'Se creó 1 bloque.'})
 
     except Exception as e:
         print(f"Error en api_create_availability: {e}") # Para depuración en servidor
@@ -962,6 +903,53 @@ def api_create_time_off(request):
         print(f"Error en api_create_time_off: {e}")
         return JsonResponse({'success': False, 'error': str(e)}, status=500)
 
+# Semanas que se expanden por defecto si FullCalendar no envía el rango visible
+DEFAULT_CALENDAR_RANGE_WEEKS = 8
+
+def _parse_calendar_datetime(value):
+    """ Convierte una fecha ISO de FullCalendar (con o sin zona horaria) a un datetime "aware". """
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return parsed if timezone.is_aware(parsed) else timezone.make_aware(parsed)
+
+def _rule_occurrence_date(rule, occurrence):
+    """
+    Fecha de la ocurrencia que trae el ID de un evento recurrente (rule_<pk>_<YYYY-MM-DD>),
+    o None si no es una fecha ISO o la regla no aplica ese día (otro día de la semana,
+    fuera de vigencia o ya excluida).
+    """
+    if len(occurrence) != 1:
+        return None
+    try:
+        day = date.fromisoformat(occurrence[0])
+    except ValueError:
+        return None
+    return day if rule.occurrences(day, day) else None
+
+def _parse_calendar_range(request):
+    """
+    Lee los parámetros 'start' y 'end' que FullCalendar envía automáticamente.
+    Si no vienen, usa desde hoy hasta DEFAULT_CALENDAR_RANGE_WEEKS semanas después.
+    Lanza ValueError si el formato no es válido.
+    """
+    start_str = request.GET.get('start')
+    end_str = request.GET.get('end')
+    if start_str and end_str:
+        return _parse_calendar_datetime(start_str), _parse_calendar_datetime(end_str)
+    range_start = timezone.make_aware(datetime.combine(timezone.localdate(), time.min))
+    return range_start, range_start + timedelta(weeks=DEFAULT_CALENDAR_RANGE_WEEKS)
+
+def _availability_events_etag(staff_member, range_start, range_end, querysets):
+    """
+    ETag del calendario de un staff para un rango: combina, por cada tabla, la última
+    modificación (updated_at) y la cantidad de filas del rango. La cantidad detecta
+    los borrados, que no dejan marca de modificación.
+    """
+    parts = [str(staff_member.pk), range_start.isoformat(), range_end.isoformat()]
+    for queryset in querysets:
+        stats = queryset.order_by().aggregate(last_change=Max('updated_at'), total=Count('pk'))
+        parts.append(f"{stats['total']}:{stats['last_change'].isoformat() if stats['last_change'] else '-'}")
+    return quote_etag(hashlib.md5('|'.join(parts).encode()).hexdigest())
+
 @login_required
 def api_get_availability_events(request):
     """
@@ -971,9 +959,12 @@ def api_get_availability_events(request):
     # Obtenemos el staff_id de los parámetros GET (ej: ?staff_id=8)
     staff_id = request.GET.get('staff_id')
     
-    # Parámetros opcionales que FullCalendar envía automáticamente
-    # start_str = request.GET.get('start')
-    # end_str = request.GET.get('end')
+    # Parámetros opcionales que FullCalendar envía automáticamente.
+    # Los horarios recurrentes solo se expanden dentro de este rango.
+    try:
+        range_start, range_end = _parse_calendar_range(request)
+    except ValueError:
+        return JsonResponse({'error': 'Formato de fecha inválido.'}, status=400)
 
     if not staff_id:
         return JsonResponse([], safe=False) # Devolver lista vacía si no hay staff
@@ -990,10 +981,28 @@ def api_get_availability_events(request):
             return JsonResponse({'error': 'No tienes permiso'}, status=403)
         
         # --- Obtener y Formatear Eventos ---
-        # Filtramos por staff. FullCalendar manejará el filtrado por rango de fechas
-        # si le pasamos todos los eventos.
-        availability_blocks = AvailabilityBlock.objects.filter(staff_member=staff_member)
-        time_off_blocks = TimeOffBlock.objects.filter(staff_member=staff_member)
+        # Solo los bloques que se cruzan con el rango visible de FullCalendar
+        availability_blocks = AvailabilityBlock.objects.filter(
+            staff_member=staff_member, start_time__lt=range_end, end_time__gt=range_start
+        )
+        time_off_blocks = TimeOffBlock.objects.filter(
+            staff_member=staff_member, start_time__lt=range_end, end_time__gt=range_start
+        )
+        # Reglas recurrentes vigentes en el rango visible
+        first_day, last_day = timezone.localdate(range_start), timezone.localdate(range_end)
+        availability_rules = AvailabilityRule.objects.filter(
+            staff_member=staff_member,
+            valid_from__lte=last_day
+        ).filter(Q(valid_until__isnull=True) | Q(valid_until__gte=first_day))
+
+        # --- GET condicional ---
+        # Si nada cambió desde la última vez (mismo ETag), respondemos 304 sin serializar nada.
+        etag = _availability_events_etag(
+            staff_member, range_start, range_end, (availability_blocks, time_off_blocks, availability_rules)
+        )
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            return not_modified
         
         events = []
         # Formatear Horarios Laborales
@@ -1016,6 +1025,23 @@ def api_get_availability_events(request):
                     'editable_by_staff': block.staff_can_edit
                 }
             })
+        # Formatear Horarios Recurrentes (una ocurrencia por fecha del rango)
+        for rule in availability_rules:
+            for day, start_time, end_time in rule.occurrences(first_day, last_day):
+                events.append({
+                    'id': f'rule_{rule.pk}_{day.isoformat()}',
+                    'title': 'Disponible (recurrente)',
+                    'start': start_time.isoformat(),
+                    'end': end_time.isoformat(),
+                    'color': '#198754',
+                    'borderColor': '#146c43',
+                    'textColor': '#ffffff',
+                    'extendedProps': {
+                        'type': 'availability',
+                        'editable_by_staff': rule.staff_can_edit,
+                        'recurring': True
+                    }
+                })
         # Formatear Bloqueos de Tiempo Libre
         for block in time_off_blocks:
              events.append({
@@ -1032,7 +1058,11 @@ def api_get_availability_events(request):
             })
             
         # Devolvemos la lista de eventos como JSON
-        return JsonResponse(events, safe=False)
+        response = JsonResponse(events, safe=False)
+        response['ETag'] = etag
+        # El navegador debe revalidar siempre (con If-None-Match) y no compartir la respuesta
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
 
     except StaffMember.DoesNotExist:
         return JsonResponse([], safe=False)
@@ -1055,8 +1085,10 @@ def api_update_event(request):
             return JsonResponse({'success': False, 'error': 'Faltan datos requeridos.'}, status=400)
 
         # 1. Parsear el ID del evento para saber el tipo y el PK
+        # (las ocurrencias de reglas recurrentes traen además su fecha: rule_<pk>_<YYYY-MM-DD>;
+        # sin fecha, rule_<pk> es la regla completa)
         try:
-            event_type, pk = event_id_str.split('_')
+            event_type, pk, *occurrence = event_id_str.split('_')
             pk = int(pk)
         except (ValueError, IndexError):
             return JsonResponse({'success': False, 'error': 'ID de evento no válido.'}, status=400)
@@ -1067,6 +1099,8 @@ def api_update_event(request):
             model = AvailabilityBlock
         elif event_type == 'off':
             model = TimeOffBlock
+        elif event_type == 'rule':
+            model = AvailabilityRule
         else:
             return JsonResponse({'success': False, 'error': 'Tipo de evento desconocido.'}, status=400)
 
@@ -1080,9 +1114,39 @@ def api_update_event(request):
         if event_obj.staff_member.business.user != request.user:
             return JsonResponse({'success': False, 'error': 'No tienes permiso para editar este bloque.'}, status=403)
 
+        if event_type == 'rule' and not occurrence:
+            # Editar la regla completa: nuevo día de la semana y horas (mismo día, inicio antes del fin)
+            start = timezone.localtime(_parse_calendar_datetime(start_dt_str))
+            end = timezone.localtime(_parse_calendar_datetime(end_dt_str))
+            if start.date() != end.date() or start >= end:
+                return JsonResponse({'success': False, 'error': 'El horario recurrente debe empezar y terminar el mismo día.'}, status=400)
+            event_obj.weekday = start.weekday()
+            event_obj.start_time = start.time()
+            event_obj.end_time = end.time()
+            event_obj.staff_can_edit = request.POST.get('staff_can_edit') == 'on'
+            event_obj.save()
+            return JsonResponse({'success': True, 'message': 'Horario recurrente actualizado correctamente.'})
+
+        if event_type == 'rule':
+            day = _rule_occurrence_date(event_obj, occurrence)
+            if day is None:
+                return JsonResponse({'success': False, 'error': 'La fecha no corresponde a este horario recurrente.'}, status=400)
+            # Editar UNA ocurrencia de un horario recurrente: la excluimos de la regla
+            # y la reemplazamos por un bloque puntual con el nuevo horario.
+            with transaction.atomic():
+                event_obj.excluded_dates = sorted(set(event_obj.excluded_dates or []) | {day.isoformat()})
+                event_obj.save(update_fields=['excluded_dates', 'updated_at'])
+                AvailabilityBlock.objects.create(
+                    staff_member=event_obj.staff_member,
+                    start_time=_parse_calendar_datetime(start_dt_str),
+                    end_time=_parse_calendar_datetime(end_dt_str),
+                    staff_can_edit=request.POST.get('staff_can_edit') == 'on'
+                )
+            return JsonResponse({'success': True, 'message': 'Se actualizó solo este día del horario recurrente.'})
+
         # 3. Actualizar el objeto
-        event_obj.start_time = timezone.make_aware(datetime.fromisoformat(start_dt_str))
-        event_obj.end_time = timezone.make_aware(datetime.fromisoformat(end_dt_str))
+        event_obj.start_time = _parse_calendar_datetime(start_dt_str)
+        event_obj.end_time = _parse_calendar_datetime(end_dt_str)
 
         if event_type == 'avail':
             # Actualiza campos específicos de AvailabilityBlock
@@ -1113,12 +1177,12 @@ def api_delete_event(request):
 
         # Parsear ID y obtener el objeto (lógica similar a la de actualización)
         try:
-            event_type, pk = event_id_str.split('_')
+            event_type, pk, *occurrence = event_id_str.split('_')
             pk = int(pk)
         except (ValueError, IndexError):
             return JsonResponse({'success': False, 'error': 'ID de evento no válido.'}, status=400)
 
-        model = AvailabilityBlock if event_type == 'avail' else TimeOffBlock if event_type == 'off' else None
+        model = {'avail': AvailabilityBlock, 'off': TimeOffBlock, 'rule': AvailabilityRule}.get(event_type)
         if not model:
             return JsonResponse({'success': False, 'error': 'Tipo de evento desconocido.'}, status=400)
 
@@ -1131,7 +1195,16 @@ def api_delete_event(request):
         if event_obj.staff_member.business.user != request.user:
             return JsonResponse({'success': False, 'error': 'No tienes permiso para eliminar este bloque.'}, status=403)
 
-        # Eliminar el objeto
+        if event_type == 'rule' and occurrence:
+            day = _rule_occurrence_date(event_obj, occurrence)
+            if day is None:
+                return JsonResponse({'success': False, 'error': 'La fecha no corresponde a este horario recurrente.'}, status=400)
+            # Eliminar UNA ocurrencia de un horario recurrente = excluir esa fecha de la regla
+            event_obj.excluded_dates = sorted(set(event_obj.excluded_dates or []) | {day.isoformat()})
+            event_obj.save(update_fields=['excluded_dates', 'updated_at'])
+            return JsonResponse({'success': True, 'message': 'Se eliminó este día del horario recurrente.'})
+
+        # Eliminar el objeto (con rule_<pk> sin fecha, la regla completa)
         event_obj.delete()
 
         return JsonResponse({'success': True, 'message': 'Bloque eliminado correctamente.'})
@@ -1149,8 +1222,30 @@ def api_get_appointments(request):
     """
     Endpoint de API para que FullCalendar obtenga las CITAS (Appointments)
     filtradas por el rol del usuario (Dueño vs Staff).
+
+    - Modo completo (?start=&end=): lista de eventos del rango; el token de
+      sincronización viaja en la cabecera X-Sync-Token.
+    - Modo delta (?sync_token=): {'events': [...], 'sync_token': ...} solo con las citas
+      creadas, modificadas o canceladas desde que se emitió el token.
     """
     user = request.user
+    scope, base_queryset = get_appointments_scope(user)
+    # Tomamos la hora ANTES de consultar: lo que cambie durante la consulta saldrá en el próximo delta
+    issued_at = timezone.now()
+    include_staff = hasattr(user, 'business_profile')
+
+    sync_token = request.GET.get('sync_token')
+    if sync_token:
+        try:
+            since = read_sync_token(sync_token, scope)
+        except InvalidSyncToken:
+            # 410: el cliente debe descartar el token y recargar el rango completo
+            return JsonResponse({'error': 'Token de sincronización inválido o vencido.'}, status=410)
+        appointments = changed_since(base_queryset, since).order_by('updated_at')
+        return FastJsonResponse({
+            'events': appointment_events(appointments, include_staff),
+            'sync_token': make_sync_token(scope, issued_at),
+        })
     
     start_str = request.GET.get('start')
     end_str = request.GET.get('end')
@@ -1159,77 +1254,20 @@ def api_get_appointments(request):
         return JsonResponse({'error': 'Faltan parámetros de fecha.'}, status=400)
 
     try:
-        naive_start_date = datetime.fromisoformat(start_str)
-        naive_end_date = datetime.fromisoformat(end_str)
-        
-        start_date = timezone.make_aware(naive_start_date)
-        end_date = timezone.make_aware(naive_end_date)
-        
+        start_date = _parse_calendar_datetime(start_str)
+        end_date = _parse_calendar_datetime(end_str)
     except ValueError:
         return JsonResponse({'error': 'Formato de fecha inválido.'}, status=400)
 
-    base_queryset = Appointment.objects.none()
-
-    if hasattr(user, 'business_profile'):
-        business = user.business_profile
-        base_queryset = Appointment.objects.filter(
-            business=business,
-            start_time__range=[start_date, end_date]
-        )
-    elif hasattr(user, 'staff_profiles') and user.staff_profiles.exists():
-        staff_member = user.staff_profiles.first()
-        base_queryset = Appointment.objects.filter(
-            staff_member=staff_member,
-            start_time__range=[start_date, end_date]
-        )
-    
-    # --- 1. CORRECCIÓN DE RENDIMIENTO (N+1 Query) ---
-    # Le decimos a Django que también traiga el 'user' relacionado al 'customer'.
-    appointments = base_queryset.select_related(
-        'service', 
-        'customer__user', # <-- CORREGIDO: Trae al usuario del cliente
-        'staff_member'
+    # --- RENDIMIENTO ---
+    # Una sola consulta con JOINs que lee solo las columnas del evento (sin instanciar modelos)
+    appointments = base_queryset.filter(
+        start_time__range=[start_date, end_date]
     ).order_by('start_time')
 
-    events = []
-    
-    for app in appointments:
-        
-        # --- 2. CORRECCIÓN DE ATRIBUTO (Título) ---
-        title = f"{app.service.name}\n"
-        # Leemos el nombre desde 'app.customer.user'
-        title += f"Cliente: {app.customer.user.first_name} {app.customer.user.last_name}\n" 
-        
-        if hasattr(user, 'business_profile'):
-             title += f"Staff: {app.staff_member.name}"
-
-        color = '#007bff' 
-        if app.status == 'COMPLETED':
-            color = '#198754' 
-        elif app.status == 'CANCELED':
-            color = '#dc3545' 
-
-        # --- 3. CORRECCIÓN DE ATRIBUTOS (extendedProps) ---
-        events.append({
-            'id': app.pk,
-            'title': title,
-            'start': app.start_time.isoformat(),
-            'end': app.end_time.isoformat(),
-            'color': color, 
-            'borderColor': color,
-            'extendedProps': {
-                'service_name': app.service.name,
-                # Leemos el nombre y teléfono desde 'app.customer.user'
-                'client_name': f"{app.customer.user.first_name} {app.customer.user.last_name}",
-                'client_phone': app.customer.user.phone_number or "N/A",
-                'staff_name': app.staff_member.name,
-                'price': f"${app.service.price}",
-                'status_display': app.get_status_display(),
-                'raw_status': app.status 
-            }
-        })
-
-    return JsonResponse(events, safe=False)
+    response = FastJsonResponse(appointment_events(appointments, include_staff))
+    response['X-Sync-Token'] = make_sync_token(scope, issued_at)
+    return response
 #actualizacion de estado de las citas
 @login_required
 @require_POST
@@ -1267,9 +1305,14 @@ def api_update_appointment_status(request):
         if not is_owner and not is_assigned_staff:
             return JsonResponse({'success': False, 'error': 'No tienes permiso para modificar esta cita.'}, status=403)
         
-        # Actualizar el estado y guardar
+        # Actualizar el estado y guardar; al pasar a COMPLETADA, la cita suma puntos de fidelidad
+        # (en la misma transacción: si algo falla, ni el estado ni los puntos quedan a medias)
+        was_completed = appointment.status == 'COMPLETED'
         appointment.status = new_status
-        appointment.save()
+        with transaction.atomic():
+            appointment.save()
+            if new_status == 'COMPLETED' and not was_completed:
+                accrue_for_completed([appointment])
 
         return JsonResponse({'success': True, 'message': 'Estado de la cita actualizado.'})
 
@@ -1291,38 +1334,28 @@ class BusinessPublicProfileView(DetailView):
     def get(self, request, *args, **kwargs):
         """
         Sobrescribimos el método GET para añadir la verificación de suscripción.
+        El contenido del perfil (negocio + servicios activos) sale de la caché por slug
+        (ver profile_cache): un acierto no consulta la base de datos.
         """
-        try:
-            # Intentamos obtener el objeto Business usando la lógica de DetailView
-            self.object = self.get_object()
-        except Http404:
+        profile = get_public_profile(kwargs.get(self.slug_url_kwarg))
+        if profile is None:
             # Si el negocio no existe por el slug, devolvemos 404
             raise Http404("Negocio no encontrado.")
 
-        # --- Verificación del Estado de la Suscripción ---
-        # Verificamos si tiene suscripción y si el estado es permitido
-        allowed_statuses = ['ACTIVE', 'TRIAL', 'DEMO']
-        has_valid_subscription = (
-            hasattr(self.object, 'subscription') and
-            self.object.subscription is not None and
-            self.object.subscription.status in allowed_statuses
-        )
-
-        if not has_valid_subscription:
+        # --- Verificación del Estado de la Suscripción (ACTIVE, TRIAL o DEMO) ---
+        if not profile['available']:
             # Si no tiene suscripción válida, devolvemos 404
-            # (Podrías renderizar una plantilla específica si lo prefieres)
             raise Http404("Este negocio no está aceptando reservas en este momento.")
 
-        # Si la suscripción es válida, procedemos con la lógica normal de DetailView
-        context = self.get_context_data(object=self.object)
-        return self.render_to_response(context)
-
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-        business = self.get_object() # get_object ya fue llamado en get()
-        context['services'] = business.services.filter(is_active=True)
-        # La obtención de staff_members se hará en el siguiente paso (SelectStaffAndTimeView)
-        return context
+        response = self.render_to_response({'profile': profile})
+        # El fragmento es igual para todos, pero base.html (menú, mensajes) depende del usuario:
+        # la respuesta completa solo se puede compartir si es anónima y sin mensajes pendientes.
+        patch_vary_headers(response, ['Cookie'])
+        if request.user.is_authenticated or len(messages.get_messages(request)):
+            patch_cache_control(response, private=True, no_cache=True)
+        else:
+            patch_cache_control(response, public=True, max_age=PUBLIC_PROFILE_MAX_AGE)
+        return response
 
     def post(self, request, *args, **kwargs):
         # La lógica POST no necesita la verificación de suscripción aquí,
@@ -1340,9 +1373,21 @@ class BusinessPublicProfileView(DetailView):
 
 #Segunda Pantalla donde permite elegir el profesional staff de la empresa y el horario de la cita o servicio
 #tomar en cuenta que esta actualizado con los mnuevos modelos de plan y suscripcion.
+def _session_holder(request):
+    """ Identificador del cliente para las reservas temporales: su clave de sesión. """
+    if not request.session.session_key:
+        request.session.save()
+    return request.session.session_key
+
 class SelectStaffAndTimeView(TemplateView):
     template_name = 'main/select_staff_and_time.html'
 
+    def get(self, request, *args, **kwargs):
+        # Si el cliente vuelve a elegir horario, libera el que tenía retenido
+        if request.session.session_key:
+            release_holds(request.session.session_key)
+        return super().get(request, *args, **kwargs)
+
     def get_context_data(self, **kwargs):
         print("\n--- Iniciando get_context_data (SelectStaffAndTimeView) ---") 
         context = super().get_context_data(**kwargs)
@@ -1415,22 +1460,26 @@ class SelectStaffAndTimeView(TemplateView):
             business=business, 
             services_offered=service, 
             is_active=True
-        )
+        ).select_related('business', 'user')
         
         availability_data = [] # Renombrado para coincidir con tu nuevo template
         
         print(f"DEBUG: Calculando slots para {target_date}...")
+
+        # Pasamos 'is_domicilio' si tu lógica de negocio lo requiere
+        is_domicilio = (service.location_type == 'DOMICILIO')
+
+        # Una sola pasada por lotes (y con caché por staff/día): como mucho 3 consultas
+        # en total sin importar cuánto personal haya
+        slots_by_staff = get_available_slots_cached(
+            staff_members=eligible_staff,
+            service=service,
+            target_date=target_date,
+            is_domicilio=is_domicilio
+        )
         
         for staff in eligible_staff:
-            # Pasamos 'is_domicilio' si tu lógica de negocio lo requiere
-            is_domicilio = (service.location_type == 'DOMICILIO')
-            
-            slots = generate_available_slots(
-                staff_member=staff, 
-                service=service, 
-                target_date=target_date, 
-                is_domicilio=is_domicilio
-            )
+            slots = slots_by_staff.get(staff.pk, [])
             
             if slots:
                 availability_data.append({
@@ -1465,6 +1514,26 @@ class SelectStaffAndTimeView(TemplateView):
 
         # 3. Validación: Necesitamos los 4 datos para avanzar
         if service_id and staff_id and selected_time and selected_date:
+            # Retenemos el horario unos minutos mientras el cliente llena sus datos,
+            # así nadie más puede tomarlo a mitad del checkout.
+            service = get_object_or_404(Service, id=service_id)
+            staff_member = get_object_or_404(StaffMember, id=staff_id)
+            try:
+                start_dt = timezone.make_aware(datetime.combine(
+                    datetime.strptime(selected_date, '%Y-%m-%d').date(),
+                    datetime.strptime(selected_time, '%H:%M').time()
+                ))
+                place_hold(
+                    staff_member, service, start_dt, _session_holder(request),
+                    is_domicilio=(service.location_type == 'DOMICILIO')
+                )
+            except ValueError:
+                messages.error(request, "Ocurrió un error al seleccionar el horario. Intenta de nuevo.")
+                return redirect(request.get_full_path())
+            except SlotUnavailable:
+                messages.error(request, "Lo sentimos, otra persona acaba de tomar ese horario. Por favor elige otro.")
+                return redirect(f"{reverse('select_staff_and_time', kwargs={'slug': self.kwargs.get('slug')})}?{urlencode({'service_id': service_id, 'date': selected_date})}")
+
             # Guardamos TODO en la sesión
             request.session['service_id'] = service_id
             request.session['staff_member_id'] = staff_id
@@ -1494,6 +1563,116 @@ class SelectStaffAndTimeView(TemplateView):
     def get_object(self):
         return get_object_or_404(Business, slug=self.kwargs.get('slug'))
 
+# Máximo de días que se pueden pedir en una sola consulta del calendario de disponibilidad
+AVAILABILITY_CALENDAR_MAX_DAYS = 62
+
+def api_availability_calendar(request, slug):
+    """
+    Endpoint público (JSON) con la CANTIDAD de slots disponibles por día en un rango,
+    para que el flujo de reserva pueda marcar de antemano los días llenos.
+    Parámetros GET: service_id (obligatorio), start y end (YYYY-MM-DD, opcionales).
+    Se calcula con UNA consulta por tabla para todo el rango (no una por día).
+    """
+    business = get_object_or_404(Business, slug=slug)
+
+    service_id = request.GET.get('service_id')
+    if not service_id:
+        return JsonResponse({'error': 'Falta el parámetro service_id.'}, status=400)
+    try:
+        service = Service.objects.get(id=service_id, business=business, is_active=True)
+    except (Service.DoesNotExist, ValueError):
+        return JsonResponse({'error': 'Servicio no encontrado.'}, status=404)
+
+    today = timezone.now().date()
+    try:
+        start_date = datetime.strptime(request.GET['start'], '%Y-%m-%d').date() if request.GET.get('start') else today
+        end_date = datetime.strptime(request.GET['end'], '%Y-%m-%d').date() if request.GET.get('end') else start_date + timedelta(days=30)
+    except ValueError:
+        return JsonResponse({'error': 'Formato de fecha inválido. Usa YYYY-MM-DD.'}, status=400)
+
+    # Evitar viajar al pasado y limitar el tamaño del rango
+    start_date = max(start_date, today)
+    end_date = min(end_date, start_date + timedelta(days=AVAILABILITY_CALENDAR_MAX_DAYS - 1))
+    if end_date < start_date:
+        return JsonResponse({'error': 'El rango de fechas no es válido.'}, status=400)
+
+    eligible_staff = StaffMember.objects.filter(
+        business=business,
+        services_offered=service,
+        is_active=True
+    ).select_related('business')
+
+    counts = count_available_slots_by_day(
+        eligible_staff,
+        service,
+        start_date,
+        end_date,
+        is_domicilio=(service.location_type == 'DOMICILIO')
+    )
+
+    return JsonResponse({
+        'service_id': service.id,
+        'start': start_date.isoformat(),
+        'end': end_date.isoformat(),
+        'days': [
+            {'date': day.isoformat(), 'available_slots': count}
+            for day, count in sorted(counts.items())
+        ],
+    })
+
+def api_first_available_slots(request, slug):
+    """
+    Endpoint público (JSON): "¿cuándo es lo más pronto que alguien puede hacer este servicio?".
+    Parámetros GET: service_id (obligatorio), limit (opcional, 1-20, por defecto 5)
+    y staff_id (opcional, para buscar solo con un profesional).
+    """
+    business = get_object_or_404(Business, slug=slug)
+
+    service_id = request.GET.get('service_id')
+    if not service_id:
+        return JsonResponse({'error': 'Falta el parámetro service_id.'}, status=400)
+    try:
+        service = Service.objects.get(id=service_id, business=business, is_active=True)
+    except (Service.DoesNotExist, ValueError):
+        return JsonResponse({'error': 'Servicio no encontrado.'}, status=404)
+
+    try:
+        limit = min(max(int(request.GET.get('limit', 5)), 1), 20)
+    except ValueError:
+        return JsonResponse({'error': 'El parámetro limit debe ser un número.'}, status=400)
+    try:
+        staff_id = int(request.GET['staff_id']) if request.GET.get('staff_id') else None
+    except ValueError:
+        return JsonResponse({'error': 'El parámetro staff_id debe ser un número.'}, status=400)
+
+    eligible_staff = StaffMember.objects.filter(
+        business=business,
+        services_offered=service,
+        is_active=True
+    ).select_related('business').order_by('name')
+    if staff_id is not None:
+        eligible_staff = eligible_staff.filter(id=staff_id)
+
+    results = find_first_available_slots(
+        eligible_staff,
+        service,
+        limit=limit,
+        is_domicilio=(service.location_type == 'DOMICILIO')
+    )
+
+    return JsonResponse({
+        'service_id': service.id,
+        'slots': [
+            {
+                'date': item['date'].isoformat(),
+                'time': item['time'],
+                'staff_id': item['staff'].id,
+                'staff_name': item['staff'].name,
+            }
+            for item in results
+        ],
+    })
+
 #Tercera pantalla donde se confirma los datos del customer y todo organizado
 
 class ConfirmBookingView(TemplateView):
@@ -1557,12 +1736,58 @@ class ConfirmBookingView(TemplateView):
                 'datetime': start_time
             },
             'target_date': target_date,
-            'target_time': target_time
+            'target_time': target_time,
+            # Clave de idempotencia del formulario (ver post)
+            'idempotency_key': uuid.uuid4().hex
         })
         return context
 
+    def get_replayed_appointment(self, business, idempotency_key):
+        """ Cita ya creada con esta clave (el formulario se envió de nuevo), o None. """
+        if not idempotency_key:
+            return None
+        return Appointment.objects.filter(business=business, idempotency_key=idempotency_key).only('pk').first()
+
+    def enqueue_confirmation(self, phone_to_send, user, business, service, staff_member, customer, appointment):
+        """
+        Encola el WhatsApp de confirmación. Un fallo al armar el mensaje NO debe impedir la reserva.
+        """
+        if not phone_to_send:
+            logger.warning(f"Cliente {user.email} sin teléfono. No se envió WA.")
+            return
+        try:
+            start_dt = localtime(appointment.start_time)
+            b_name = getattr(business, 'business_name', getattr(business, 'name', str(business)))
+            b_address = getattr(business, 'address', getattr(business, 'address_line', 'Ubicación del negocio'))
+
+            message_context = {
+                'customer_name': user.first_name,
+                'service': service,
+                'staff': staff_member,
+                'business': business,
+                'business_name': b_name,
+                'business_address': b_address,
+                'customer': customer,
+                'appointment': appointment,
+                'date': start_dt.strftime('%A, %d de %B'),
+                'time': start_dt.strftime('%I:%M %p'),
+            }
+            message_body = render_to_string('appointments/messages/wa_confirmation.txt', message_context)
+        except Exception as e:
+            logger.error(f"Error armando la notificación WhatsApp (Pero la cita se guardó): {e}")
+            return
+        enqueue_whatsapp(phone_to_send, message_body, dedupe_key=f'appointment:{appointment.pk}:confirmation')
+
     def post(self, request, *args, **kwargs):
         business = self.get_object()
+
+        # Reenvío del mismo formulario (doble clic, reintento del móvil): la cita ya existe,
+        # vamos directo a la confirmación sin tocar la agenda ni volver a enviar WhatsApp.
+        idempotency_key = request.POST.get('idempotency_key', '').strip()[:64] or None
+        replayed = self.get_replayed_appointment(business, idempotency_key)
+        if replayed:
+            return redirect('booking_confirmed', pk=replayed.pk)
+
         data = self.get_booking_data()
 
         if not all(data.values()):
@@ -1583,6 +1808,10 @@ class ConfirmBookingView(TemplateView):
             messages.error(request, "Por favor completa los campos obligatorios.")
             return self.render_to_response(self.get_context_data())
 
+        # Dueño de la reserva temporal del checkout. Se lee ANTES del auto-login,
+        # porque login() cambia la clave de sesión.
+        hold_holder = request.session.session_key
+
         try:
             # INICIO DEL BLOQUE ATÓMICO (Base de Datos)
             with transaction.atomic():
@@ -1604,11 +1833,8 @@ class ConfirmBookingView(TemplateView):
                         user.phone_number = phone_number
                         user.save(update_fields=['phone_number'])
 
-                # 2. Auto-Login seguro
-                if not request.user.is_authenticated:
-                    user.backend = 'CoreApps.main.backends.EmailAuthBackend'
-                    login(request, user)
-                    print(f"DEBUG: Auto-login forzado para {user.email}")
+                # 2. Auto-Login: se hace al salir del bloque atómico (ver abajo), porque login()
+                # cambia la sesión y, si la reserva falla, el rollback la dejaría inválida.
 
                 # 3. Crear Customer
                 customer, created = Customer.objects.get_or_create(
@@ -1626,79 +1852,54 @@ class ConfirmBookingView(TemplateView):
                 start_dt = timezone.make_aware(datetime.combine(t_date, t_time))
                 end_dt = start_dt + service.duration
 
-                # 5. Validación de Conflicto (Locking manual)
-                overlap = Appointment.objects.filter(
-                    staff_member=staff_member,
-                    status__in=['SCHEDULED', 'CONFIRMED'], 
-                    start_time__lt=end_dt,
-                    end_time__gt=start_dt
-                ).exists()
-
-                if overlap:
-                    # Lanzamos una excepción manual para activar el rollback
-                    raise ValueError("HORARIO_OCUPADO")
-
-                # 6. Crear la Cita
-                appointment = Appointment.objects.create(
+                # 5. Crear la Cita bajo el bloqueo del staff
+                # (verifica choques y guarda sin que otra reserva concurrente se cuele en medio)
+                appointment = book_appointment(
                     business=business,
                     staff_member=staff_member,
                     customer=customer,
                     service=service,
                     start_time=start_dt,
                     end_time=end_dt,
-                    status='SCHEDULED'
+                    holder=hold_holder, # Consume la reserva temporal del checkout
+                    idempotency_key=idempotency_key
                 )
-            # FIN DEL BLOQUE ATÓMICO (La cita ya existe y es segura)
 
-            # --- ZONA NO CRÍTICA: NOTIFICACIONES ---
-            # Si esto falla, NO importa, la cita ya se guardó.
-            try:
-                phone_to_send = phone_number or user.phone_number
-                if phone_to_send:
-                    b_name = getattr(business, 'business_name', getattr(business, 'name', str(business)))
-                    b_address = getattr(business, 'address', getattr(business, 'address_line', 'Ubicación del negocio'))
-
-                    message_context = {
-                        'customer_name': user.first_name,
-                        'service': service,
-                        'staff': staff_member,
-                        'business': business,
-                        'business_name': b_name,
-                        'business_address': b_address,
-                        'customer': customer,
-                        'appointment': appointment,
-                        'date': start_dt.strftime('%A, %d de %B'),
-                        'time': start_dt.strftime('%I:%M %p'),
-                    }
-                    
-                    message_body = render_to_string('appointments/messages/wa_confirmation.txt', message_context)
-                    
-                    print(f"DEBUG: Enviando WA a {phone_to_send}...")
-                    success, response = send_whatsapp_message(phone_to_send, message_body)
-                    
-                    if not success:
-                        logger.warning(f"Fallo WASender: {response}")
-                    else:
-                        print(f"DEBUG: WA Enviado correctamente.")
-                else:
-                    logger.warning(f"Cliente {user.email} sin teléfono. No se envió WA.")
-            except Exception as e:
-                logger.error(f"Error CRÍTICO enviando notificación WhatsApp (Pero la cita se guardó): {e}")
-            
+                # 6. Notificación por WhatsApp: se ENCOLA en la misma transacción (outbox)
+                # y la envía el worker 'drain_outbox'. La reserva no espera a la API de mensajería.
+                # Se encola el número ya normalizado (el del formulario o el guardado en el usuario)
+                self.enqueue_confirmation(normalize_phone_number(phone_number) or user.phone_number_normalized, user, business, service, staff_member, customer, appointment)
+            # FIN DEL BLOQUE ATÓMICO (La cita y su notificación ya existen y son seguras)
+
+            # Auto-Login seguro (fuera de la transacción, como en el registro)
+            if not request.user.is_authenticated:
+                user.backend = 'CoreApps.main.backends.EmailAuthBackend'
+                login(request, user)
+                print(f"DEBUG: Auto-login forzado para {user.email}")
+
             # --- Finalización ---
             request.session.pop('booking_data', None)
             messages.success(request, "¡Cita confirmada exitosamente!")
             return redirect('booking_confirmed', pk=appointment.pk)
 
-        except ValueError as e:
-            if str(e) == "HORARIO_OCUPADO":
-                messages.error(request, "Lo sentimos, este horario acaba de ser ocupado. Por favor elige otro.")
-                return redirect('business_profile', slug=business.slug)
+        except (SlotUnavailable, IntegrityError) as e:
+            # Dos envíos simultáneos del mismo formulario: el otro ya creó la cita
+            # (aquí choca con ella o con la clave única de idempotencia)
+            replayed = self.get_replayed_appointment(business, idempotency_key)
+            if replayed:
+                return redirect('booking_confirmed', pk=replayed.pk)
+            if isinstance(e, IntegrityError):
+                logger.error(f"Error CRÍTICO en booking (Rollback ejecutado): {e}")
+                messages.error(request, "Ocurrió un error inesperado. Inténtalo de nuevo.")
             else:
-                # Error de fecha u otro valor
-                logger.error(f"Error de valor en booking: {e}")
-                messages.error(request, "Error en los datos de la cita.")
-                return redirect('business_profile', slug=business.slug)
+                messages.error(request, "Lo sentimos, este horario acaba de ser ocupado. Por favor elige otro.")
+            return redirect('business_profile', slug=business.slug)
+
+        except ValueError as e:
+            # Error de fecha u otro valor
+            logger.error(f"Error de valor en booking: {e}")
+            messages.error(request, "Error en los datos de la cita.")
+            return redirect('business_profile', slug=business.slug)
                 
         except Exception as e:
             # Error grave de base de datos
@@ -1835,7 +2036,7 @@ class RescheduleAppointmentView(TemplateView):
         context['can_go_back'] = (prev_date >= date.today())
 
         # Generar slots (Mantenemos tu variable original 'available_slots')
-        context['available_slots'] = generate_available_slots(staff_member, service, target_date)
+        context['available_slots'] = get_staff_available_slots_cached(staff_member, service, target_date)
 
         return context
 
@@ -2,6 +2,10 @@
 import requests
 import json
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from django.conf import settings
 import re
 import base64
@@ -10,6 +14,11 @@ from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.backends import default_backend
 import hashlib # Necesario para SHA256
+import hmac
+import tempfile
+from functools import lru_cache
+from cryptography.hazmat.primitives import padding
+from CoreApps.users.phone import NORMALIZED_PHONE_NUMBER, normalize_phone_number, normalize_phone_numbers # noqa: F401 (reexportado)
 
 # Constantes para HKDF (generalmente fijas para WhatsApp media)
 # Ajusta si la documentación indica otros valores
@@ -20,7 +29,76 @@ APP_INFO_DOCUMENT = b'WhatsApp Document Keys'
 
 logger = logging.getLogger(__name__)
 
+
+# --- CONEXIONES REUTILIZABLES (keep-alive) ---
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Sesión HTTP compartida por el proceso: reutiliza las conexiones TLS abiertas con WASenderAPI
+    en vez de hacer un handshake nuevo por mensaje. El pool admite WASENDERAPI_POOL_SIZE
+    conexiones simultáneas (una por hilo del envío en lote).
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                pool_size = getattr(settings, 'WASENDERAPI_POOL_SIZE', 10)
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+    return _session
+
+
+class TokenBucket:
+    """
+    Limitador de ritmo "token bucket": se recargan 'rate' fichas por segundo hasta 'capacity'.
+    Cada envío consume una; sin fichas, acquire() espera lo justo. Permite ráfagas cortas
+    sin superar el ritmo promedio que admite el proveedor. Seguro entre hilos.
+    """
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated_at = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1 - 1e-9: # tolerancia por redondeo de floats
+                    self.tokens = max(0.0, self.tokens - 1)
+                    return
+                wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+
+_rate_limiter = None
+
+
+def get_rate_limiter():
+    """ Limitador compartido por el proceso (los lotes seguidos también respetan el límite). """
+    global _rate_limiter
+    if _rate_limiter is None:
+        with _session_lock:
+            if _rate_limiter is None:
+                _rate_limiter = TokenBucket(
+                    getattr(settings, 'WASENDERAPI_RATE_PER_SECOND', 10),
+                    getattr(settings, 'WASENDERAPI_BURST', None)
+                )
+    return _rate_limiter
+
 # --- FUNCIÓN DE FORMATO (Añade '+') ---
+# La normalización vive en CoreApps/users/phone.py (también la usa User.phone_number_normalized)
 def format_phone_number_for_api(phone_number):
     """
     Limpia y formatea un número al formato internacional CON '+'
@@ -28,29 +106,21 @@ def format_phone_number_for_api(phone_number):
     """
     if not phone_number:
         return None
-    cleaned_number = re.sub(r'[^\d+]', '', str(phone_number))
-    cleaned_number = cleaned_number.split('@')[0]
-    if cleaned_number.startswith('+5939') and len(cleaned_number) == 13:
-        return cleaned_number # Ya está correcto
-    elif cleaned_number.startswith('5939') and len(cleaned_number) == 12:
-        return '+' + cleaned_number # Añadir '+'
-    elif cleaned_number.startswith('09') and len(cleaned_number) == 10:
-        return '+593' + cleaned_number[1:] # Reemplazar '0' con '+593'
-    elif cleaned_number.startswith('9') and len(cleaned_number) == 9:
-         return '+593' + cleaned_number # Añadir '+593'
-    else: # Intenta añadir '+' si parece internacional pero falta
-         if len(cleaned_number) == 12 and cleaned_number.startswith('593'):
-             return '+' + cleaned_number
-    logger.warning(f"Número '{phone_number}' no pudo ser formateado a +593...")
-    return None
+    if isinstance(phone_number, str) and NORMALIZED_PHONE_NUMBER.fullmatch(phone_number):
+        return phone_number # Ya viene normalizado (outbox, recordatorios): nada que hacer
+    formatted = normalize_phone_number(phone_number)
+    if formatted is None:
+        logger.warning(f"Número '{phone_number}' no pudo ser formateado a +593...")
+    return formatted
 # --- FIN FUNCIÓN DE FORMATO ---
 
 
 # --- FUNCIÓN DE ENVÍO DEFINITIVA (CORREGIDA CON CURL) ---
-def send_whatsapp_message(phone_number, message):
+def send_whatsapp_message(phone_number, message, session=None):
     """
     Envía un mensaje de texto vía /api/send-message de WASenderAPI.
     Retorna (True, response_data) o (False, error_message).
+    Usa la sesión compartida (get_session) salvo que se indique otra.
     """
     if not settings.WASENDERAPI_API_KEY:
         error_msg = "Error: WASENDERAPI_API_KEY no configurada."
@@ -64,7 +134,8 @@ def send_whatsapp_message(phone_number, message):
         return False, error_msg
 
     # --- ¡URL CORREGIDA SEGÚN CURL EXITOSO! ---
-    api_url = "https://wasenderapi.com/api/send-message" # URL directa que funcionó
+    # Configurable (settings.WASENDERAPI_SEND_URL) para apuntar a un servidor de pruebas
+    api_url = getattr(settings, 'WASENDERAPI_SEND_URL', None) or "https://wasenderapi.com/api/send-message"
 
     headers = {
         'Authorization': f'Bearer {settings.WASENDERAPI_API_KEY}',
@@ -80,7 +151,7 @@ def send_whatsapp_message(phone_number, message):
     # logger.debug(f"Payload: {json.dumps(payload)}") # Descomentar si necesitas depurar
 
     try:
-        response = requests.post(api_url, headers=headers, json=payload, timeout=20)
+        response = (session or get_session()).post(api_url, headers=headers, json=payload, timeout=getattr(settings, 'WASENDERAPI_TIMEOUT', 20))
         response.raise_for_status() # Lanza excepción para 4xx/5xx
         response_data = response.json()
 
@@ -111,8 +182,41 @@ def send_whatsapp_message(phone_number, message):
         logger.exception(error_msg)
         return False, error_msg
 
+def send_whatsapp_batch(messages, send=None, rate_limiter=None, max_workers=None):
+    """
+    Envía muchos mensajes [(teléfono, texto), ...] por la sesión compartida, con varios hilos
+    (hasta WASENDERAPI_POOL_SIZE, uno por conexión del pool) y respetando el límite de ritmo del
+    proveedor. Devuelve [(éxito, respuesta), ...] en el mismo orden; un mensaje que falla
+    (incluso con una excepción) no detiene al resto.
+    """
+    send = send or send_whatsapp_message
+    rate_limiter = rate_limiter or get_rate_limiter()
+    messages = list(messages)
+    if not messages:
+        return []
+
+    def send_one(item):
+        phone_number, message = item
+        rate_limiter.acquire()
+        try:
+            return send(phone_number, message)
+        except Exception as e:
+            logger.exception(f"Error inesperado enviando WhatsApp a {phone_number}: {e}")
+            return False, f"Excepción al enviar: {e}"
+
+    max_workers = max_workers or getattr(settings, 'WASENDERAPI_POOL_SIZE', 10)
+    if max_workers <= 1 or len(messages) == 1:
+        return [send_one(item) for item in messages]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(messages))) as executor:
+        return list(executor.map(send_one, messages))
+
+@lru_cache(maxsize=256)
 def hkdf_expand(key, info, length=32):
-    """Deriva claves usando HKDF-SHA256."""
+    """
+    Deriva claves usando HKDF-SHA256.
+    Resultado cacheado por (clave, info, largo): el mismo medio se descarga varias veces
+    (vista previa, reintentos) y la derivación no cambia.
+    """
     hkdf = HKDF(
         algorithm=hashes.SHA256(),
         length=length,
@@ -122,41 +226,155 @@ def hkdf_expand(key, info, length=32):
     )
     return hkdf.derive(key)
 
+# Tamaño del MAC que WhatsApp anexa al final del archivo cifrado
+MEDIA_MAC_LENGTH = 10
+# Un origen no rebobinable se copia cifrado a un archivo temporal para verificar el MAC antes
+# de desencriptar: hasta este tamaño la copia queda en memoria, después pasa a disco
+MEDIA_SPOOL_MAX_MEMORY = 8 * 1024 * 1024
+
+
+def _decode_media_key(media_key_b64):
+    """ Decodifica la mediaKey y devuelve los 32 bytes que se usan para HKDF. """
+    media_key = base64.b64decode(media_key_b64)
+    if len(media_key) != 32 + 32 + 32: # key + mac_key + ref_key (normalmente 32 bytes cada uno)
+        logger.error(f"MediaKey tiene longitud inesperada: {len(media_key)} bytes.")
+        # Intenta usar solo los primeros 32 bytes si la estructura es diferente
+        if len(media_key) < 32:
+            raise ValueError("MediaKey inválida para HKDF.")
+        # Considera loguear media_key_b64 para depuración si sigue fallando
+    # La documentación de WASender parece usar solo los primeros 32 bytes de la mediaKey para HKDF
+    return media_key[:32]
+
+
+def _media_app_info(media_type):
+    """ APP_INFO de HKDF según el tipo de medio. """
+    if media_type == 'image':
+        return APP_INFO_IMAGE
+    elif media_type == 'video':
+        return APP_INFO_VIDEO
+    elif media_type == 'audio':
+        return APP_INFO_AUDIO
+    elif media_type == 'document':
+        return APP_INFO_DOCUMENT
+    # Fallback o tipo genérico si es necesario, consulta la documentación si existe
+    logger.warning(f"Tipo de medio desconocido '{media_type}', usando APP_INFO_IMAGE como fallback.")
+    return APP_INFO_IMAGE # O define un APP_INFO genérico
+
+
+def media_keys(media_key, app_info):
+    """
+    Devuelve (iv, cipher_key, mac_key) de la expansión HKDF de 112 bytes de WhatsApp:
+    16 de IV, 32 de clave AES, 32 de clave HMAC (y 32 de refKey, que no se usan).
+    HKDF es prefijo-estable: los primeros 48 bytes son los mismos que pedía la versión anterior.
+    """
+    keys = hkdf_expand(media_key, app_info, length=112)
+    return keys[:16], keys[16:48], keys[48:80]
+
+
+def _iter_chunks(source, chunk_size):
+    """ Recorre un archivo (objeto con read()) o un iterable de bloques de bytes. """
+    if hasattr(source, 'read'):
+        return iter(lambda: source.read(chunk_size), b'')
+    return iter(source)
+
+
+def _read_exactly(source, length, chunk_size):
+    """ Bloques de 'source' (objeto con read()) hasta completar 'length' bytes. """
+    while length > 0:
+        chunk = source.read(min(chunk_size, length))
+        if not chunk:
+            raise ValueError("El archivo cambió durante la desencriptación.")
+        length -= len(chunk)
+        yield chunk
+
+
+def _hash_ciphertext(chunks, mac, spool=None):
+    """
+    Primera pasada: agrega al HMAC todo menos los últimos MEDIA_MAC_LENGTH bytes (el MAC
+    anexado) y, si se pasa 'spool', copia ahí los datos cifrados.
+    Devuelve (largo de los datos cifrados, MAC anexado).
+    """
+    length = 0
+    tail = b'' # Últimos bytes vistos: pueden ser el MAC
+    for chunk in chunks:
+        data = tail + chunk
+        encrypted, tail = data[:-MEDIA_MAC_LENGTH], data[-MEDIA_MAC_LENGTH:]
+        if encrypted:
+            mac.update(encrypted)
+            length += len(encrypted)
+            if spool is not None:
+                spool.write(encrypted)
+    return length, tail
+
+
+def decrypt_whatsapp_media_stream(media_key_b64, source, sink, media_type='image', chunk_size=64 * 1024):
+    """
+    Versión por bloques de decrypt_whatsapp_media para medios grandes (video, documentos):
+    lee 'source' (archivo o iterable de bloques), desencripta de a poco y escribe en 'sink'
+    (cualquier objeto con write()). La memoria usada no depende del tamaño del archivo.
+    El MAC final (HMAC-SHA256 de iv + datos cifrados, truncado a 10 bytes) se verifica ANTES
+    de escribir nada: un archivo rebobinable (seek) se lee dos veces; un iterable o un stream
+    de red se copia cifrado a un archivo temporal (MEDIA_SPOOL_MAX_MEMORY) y se desencripta de ahí.
+    Retorna los bytes escritos, o None si el MAC o el padding no son válidos. Con un MAC
+    inválido 'sink' queda intacto; el padding solo puede fallar con un MAC válido (archivo
+    armado con la misma clave) y en ese caso lo escrito debe descartarse.
+    """
+    try:
+        iv, cipher_key, mac_key = media_keys(_decode_media_key(media_key_b64), _media_app_info(media_type))
+        mac = hmac.new(mac_key, iv, hashlib.sha256)
+        seekable = hasattr(source, 'seek') and hasattr(source, 'seekable') and source.seekable()
+
+        with tempfile.SpooledTemporaryFile(max_size=MEDIA_SPOOL_MAX_MEMORY) as spool:
+            if seekable:
+                start = source.tell()
+                length, expected_mac = _hash_ciphertext(_iter_chunks(source, chunk_size), mac)
+            else:
+                length, expected_mac = _hash_ciphertext(_iter_chunks(source, chunk_size), mac, spool)
+
+            if len(expected_mac) < MEDIA_MAC_LENGTH:
+                raise ValueError("Datos cifrados demasiado cortos.")
+            if not hmac.compare_digest(mac.digest()[:MEDIA_MAC_LENGTH], expected_mac):
+                raise ValueError("MAC inválido: el archivo está dañado o la mediaKey no corresponde.")
+
+            # Segunda pasada, ya verificada: desencriptar y escribir
+            ciphertext = source if seekable else spool
+            ciphertext.seek(start if seekable else 0)
+            decryptor = Cipher(algorithms.AES(cipher_key), modes.CBC(iv), backend=default_backend()).decryptor()
+            # El unpadder retiene el último bloque hasta el final para quitar el padding PKCS7
+            unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
+            written = 0
+            for encrypted in _read_exactly(ciphertext, length, chunk_size):
+                plain = unpadder.update(decryptor.update(encrypted))
+                sink.write(plain)
+                written += len(plain)
+            plain = unpadder.update(decryptor.finalize()) + unpadder.finalize()
+            sink.write(plain)
+            written += len(plain)
+
+        logger.info(f"Desencriptación por bloques exitosa para media_type '{media_type}' ({written} bytes).")
+        return written
+
+    except ValueError as ve:
+        logger.error(f"Error de valor durante la desencriptación: {ve}")
+        return None
+    except Exception as e:
+        logger.exception(f"Error inesperado durante la desencriptación de medios: {e}")
+        return None
+
 def decrypt_whatsapp_media(media_key_b64, encrypted_data, media_type='image'):
     """
     Desencripta los datos de medios de WhatsApp usando la mediaKey.
     media_type puede ser 'image', 'video', 'audio', 'document'.
+    Para archivos grandes usar decrypt_whatsapp_media_stream.
     """
     try:
-        media_key = base64.b64decode(media_key_b64)
-        if len(media_key) != 32 + 32 + 32: # key + mac_key + ref_key (normalmente 32 bytes cada uno)
-            logger.error(f"MediaKey tiene longitud inesperada: {len(media_key)} bytes.")
-            # Intenta usar solo los primeros 32 bytes si la estructura es diferente
-            if len(media_key) >= 32:
-                media_key = media_key[:32]
-            else:
-                raise ValueError("MediaKey inválida para HKDF.")
-            # Considera loguear media_key_b64 para depuración si sigue fallando
+        media_key = _decode_media_key(media_key_b64)
 
         # Seleccionar APP_INFO basado en el tipo de medio
-        if media_type == 'image':
-            app_info = APP_INFO_IMAGE
-        elif media_type == 'video':
-            app_info = APP_INFO_VIDEO
-        elif media_type == 'audio':
-            app_info = APP_INFO_AUDIO
-        elif media_type == 'document':
-            app_info = APP_INFO_DOCUMENT
-        else:
-            # Fallback o tipo genérico si es necesario, consulta la documentación si existe
-            logger.warning(f"Tipo de medio desconocido '{media_type}', usando APP_INFO_IMAGE como fallback.")
-            app_info = APP_INFO_IMAGE # O define un APP_INFO genérico
-
-        # Derivar claves IV y Cipher Key usando HKDF
-        # La documentación de WASender parece usar solo los primeros 32 bytes de la mediaKey para HKDF
-        keys = hkdf_expand(media_key[:32], app_info, length=16 + 32) # 16 para IV, 32 para Cipher Key
-        iv = keys[:16]
-        cipher_key = keys[16:]
+        app_info = _media_app_info(media_type)
+
+        # Derivar claves IV y Cipher Key usando HKDF (cacheado por mediaKey)
+        iv, cipher_key, _ = media_keys(media_key, app_info)
 
         # Separar los datos encriptados y el MAC
         # WhatsApp anexa un MAC de 10 bytes al final
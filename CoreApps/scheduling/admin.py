@@ -2,7 +2,7 @@
 
 from django.contrib import admin
 # Añadimos TimeOffBlock a la importación
-from .models import AvailabilityBlock, Appointment, TimeOffBlock 
+from .models import AvailabilityBlock, AvailabilityRule, Appointment, SlotHold, TimeOffBlock 
 
 @admin.register(AvailabilityBlock)
 class AvailabilityBlockAdmin(admin.ModelAdmin):
@@ -13,6 +13,11 @@ class AvailabilityBlockAdmin(admin.ModelAdmin):
     # Hacemos el campo editable directamente en la lista (opcional)
     list_editable = ('staff_can_edit',) 
 
+@admin.register(AvailabilityRule)
+class AvailabilityRuleAdmin(admin.ModelAdmin):
+    list_display = ('staff_member', 'weekday', 'start_time', 'end_time', 'valid_from', 'valid_until', 'staff_can_edit')
+    list_filter = ('staff_member__business', 'staff_member', 'weekday')
+
 # --- NUEVO REGISTRO ADMIN ---
 @admin.register(TimeOffBlock)
 class TimeOffBlockAdmin(admin.ModelAdmin):
@@ -27,4 +32,9 @@ class AppointmentAdmin(admin.ModelAdmin):
     list_display = ('id', 'customer', 'business', 'staff_member', 'service', 'start_time', 'status')
     list_filter = ('status', 'business', 'staff_member')
     search_fields = ('customer__first_name', 'business__display_name', 'staff_member__name')
-    readonly_fields = ('created_at',)
\ No newline at end of file
+    readonly_fields = ('created_at', 'reminder_sent_at')
+
+@admin.register(SlotHold)
+class SlotHoldAdmin(admin.ModelAdmin):
+    list_display = ('staff_member', 'start_time', 'end_time', 'expires_at')
+    list_filter = ('staff_member__business',)
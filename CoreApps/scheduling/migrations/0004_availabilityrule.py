@@ -0,0 +1,37 @@
+# Generated by Django 4.2.25 on 2026-10-18 10:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0008_alter_customer_unique_together_customer_notes_and_more'),
+        ('scheduling', '0003_timeoffblock_alter_availabilityblock_options_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AvailabilityRule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('weekday', models.PositiveSmallIntegerField(choices=[(0, 'Lunes'), (1, 'Martes'), (2, 'Miércoles'), (3, 'Jueves'), (4, 'Viernes'), (5, 'Sábado'), (6, 'Domingo')], help_text='Día de la semana (0=Lunes, 6=Domingo).')),
+                ('start_time', models.TimeField()),
+                ('end_time', models.TimeField()),
+                ('valid_from', models.DateField(help_text='Primer día en que aplica la regla.')),
+                ('valid_until', models.DateField(blank=True, help_text='Último día en que aplica la regla (vacío = sin fecha de fin).', null=True)),
+                ('excluded_dates', models.JSONField(blank=True, default=list, help_text='Fechas (YYYY-MM-DD) en las que la regla NO aplica (feriados, ausencias puntuales).')),
+                ('staff_can_edit', models.BooleanField(default=True, help_text='Permite que el miembro del staff (si tiene login) modifique o elimine este horario.')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('staff_member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='availability_rules', to='users.staffmember')),
+            ],
+            options={
+                'ordering': ['weekday', 'start_time'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='availabilityrule',
+            constraint=models.CheckConstraint(check=models.Q(('start_time__lt', models.F('end_time'))), name='availability_rule_start_before_end'),
+        ),
+    ]
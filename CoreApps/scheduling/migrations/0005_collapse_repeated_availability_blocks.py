@@ -0,0 +1,84 @@
+# Migración de datos: colapsa los AvailabilityBlock repetidos semana a semana
+# (generados por la antigua recurrencia de api_create_availability) en AvailabilityRule.
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from django.db import migrations
+from django.utils import timezone
+
+# Mínimo de semanas repetidas para considerar que un grupo de bloques era una recurrencia
+MIN_OCCURRENCES = 3
+
+
+def collapse_blocks_into_rules(apps, schema_editor):
+    AvailabilityBlock = apps.get_model('scheduling', 'AvailabilityBlock')
+    AvailabilityRule = apps.get_model('scheduling', 'AvailabilityRule')
+
+    # Agrupamos por (staff, día de la semana, hora inicio, hora fin, permiso) en hora local
+    groups = defaultdict(list)
+    for block in AvailabilityBlock.objects.all().iterator():
+        start = timezone.localtime(block.start_time)
+        end = timezone.localtime(block.end_time)
+        if start.date() != end.date():
+            continue # Los bloques que cruzan la medianoche se dejan como están
+        key = (block.staff_member_id, start.weekday(), start.time(), end.time(), block.staff_can_edit)
+        groups[key].append((start.date(), block.pk))
+
+    for (staff_member_id, weekday, start_time, end_time, staff_can_edit), items in groups.items():
+        dates = sorted({day for day, _ in items})
+        if len(dates) < MIN_OCCURRENCES:
+            continue
+
+        # Semanas sin bloque dentro del rango -> fechas excluidas de la regla
+        expected = [dates[0] + timedelta(weeks=week) for week in range((dates[-1] - dates[0]).days // 7 + 1)]
+        excluded = sorted(set(expected) - set(dates))
+        if len(excluded) > len(dates):
+            continue # Demasiados huecos: no parece una recurrencia semanal
+
+        AvailabilityRule.objects.create(
+            staff_member_id=staff_member_id,
+            weekday=weekday,
+            start_time=start_time,
+            end_time=end_time,
+            valid_from=dates[0],
+            valid_until=dates[-1],
+            excluded_dates=[day.isoformat() for day in excluded],
+            staff_can_edit=staff_can_edit,
+        )
+        AvailabilityBlock.objects.filter(pk__in=[pk for _, pk in items]).delete()
+
+
+def expand_rules_into_blocks(apps, schema_editor):
+    """ Reversa: vuelve a materializar cada regla como un bloque por fecha. """
+    AvailabilityBlock = apps.get_model('scheduling', 'AvailabilityBlock')
+    AvailabilityRule = apps.get_model('scheduling', 'AvailabilityRule')
+
+    for rule in AvailabilityRule.objects.all().iterator():
+        # Sin fecha de fin, limitamos a un año como hacía la recurrencia original
+        last_day = rule.valid_until or rule.valid_from + timedelta(days=365)
+        excluded = set(rule.excluded_dates or [])
+        day = rule.valid_from + timedelta(days=(rule.weekday - rule.valid_from.weekday()) % 7)
+        blocks = []
+        while day <= last_day:
+            if day.isoformat() not in excluded:
+                blocks.append(AvailabilityBlock(
+                    staff_member_id=rule.staff_member_id,
+                    start_time=timezone.make_aware(datetime.combine(day, rule.start_time)),
+                    end_time=timezone.make_aware(datetime.combine(day, rule.end_time)),
+                    staff_can_edit=rule.staff_can_edit,
+                ))
+            day += timedelta(days=7)
+        AvailabilityBlock.objects.bulk_create(blocks)
+    AvailabilityRule.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scheduling', '0004_availabilityrule'),
+    ]
+
+    operations = [
+        migrations.RunPython(collapse_blocks_into_rules, expand_rules_into_blocks),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.25 on 2026-10-18 11:45
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scheduling', '0006_availability_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointment',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['business', 'updated_at'], name='appt_business_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['staff_member', 'updated_at'], name='appt_staff_updated_idx'),
+        ),
+    ]
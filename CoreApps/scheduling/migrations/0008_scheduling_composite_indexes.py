@@ -0,0 +1,29 @@
+# Generated by Django 4.2.25 on 2026-10-18 12:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scheduling', '0007_appointment_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['staff_member', 'start_time', 'end_time'], name='appt_staff_start_end_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['business', 'start_time', 'status'], name='appt_business_start_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='availabilityblock',
+            index=models.Index(fields=['staff_member', 'start_time'], name='avail_staff_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='timeoffblock',
+            index=models.Index(fields=['staff_member', 'start_time'], name='timeoff_staff_start_idx'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.25 on 2026-10-18 10:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0008_alter_customer_unique_together_customer_notes_and_more'),
+        ('scheduling', '0008_scheduling_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlotHold',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_time', models.DateTimeField()),
+                ('end_time', models.DateTimeField()),
+                ('holder', models.CharField(db_index=True, max_length=64)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('staff_member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='slot_holds', to='users.staffmember')),
+            ],
+            options={
+                'ordering': ['start_time'],
+                'indexes': [models.Index(fields=['staff_member', 'start_time'], name='slothold_staff_start_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='slothold',
+            constraint=models.CheckConstraint(check=models.Q(('start_time__lt', models.F('end_time'))), name='slothold_start_before_end'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.25 on 2026-10-18 10:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scheduling', '0009_slothold'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointment',
+            name='idempotency_key',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, unique=True),
+        ),
+    ]
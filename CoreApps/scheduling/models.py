@@ -1,14 +1,49 @@
 # CoreApps/scheduling/models.py
 
+from datetime import datetime, timedelta
+from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 from CoreApps.users.models import StaffMember, Customer, Business
 from CoreApps.catalog.models import Service
 
+class ScheduleSnapshotMixin:
+    """
+    Recuerda el horario (SCHEDULE_FIELDS) tal como se cargó de la base de datos, sin consultas
+    extra. Las señales de caché (CoreApps/main/signals.py) lo comparan con el horario nuevo para
+    saber si algo cambió y qué intervalo viejo invalidar.
+    """
+    SCHEDULE_FIELDS = ('staff_member_id', 'start_time', 'end_time')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_schedule = instance._schedule_state()
+        return instance
+
+    def _schedule_state(self):
+        # Leemos de __dict__ para no disparar consultas por campos diferidos (.only/.defer)
+        return tuple(self.__dict__.get(field) for field in self.SCHEDULE_FIELDS)
+
+    def loaded_interval(self):
+        """ (staff_member_id, inicio, fin) con que se cargó la fila, o None si es nueva o no se conoce. """
+        loaded = getattr(self, '_loaded_schedule', None)
+        if loaded is None or None in loaded[:3]:
+            return None
+        return loaded[:3]
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # Las señales post_save ya vieron el horario anterior; desde aquí, el guardado es el nuevo
+        self._loaded_schedule = self._schedule_state()
+
+
 # -----------------------------------------------------------------------------
 # Modelo de Disponibilidad
 # CAMBIO: Ahora se relaciona con 'StaffMember' en lugar de 'Client'.
 # -----------------------------------------------------------------------------
-class AvailabilityBlock(models.Model):
+class AvailabilityBlock(ScheduleSnapshotMixin, models.Model):
     """
     Define un bloque de tiempo específico en el que un profesional ESTÁ disponible
     (su horario laboral base para ese día/periodo).
@@ -22,6 +57,8 @@ class AvailabilityBlock(models.Model):
         help_text="Permite que el miembro del staff (si tiene login) modifique o elimine este bloque."
     )
     # --- FIN NUEVO CAMPO ---
+    # Marca de modificación: el calendario la usa para calcular el ETag (respuestas 304)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         # Muestra la fecha y el rango de horas para fácil lectura en el admin
@@ -32,12 +69,89 @@ class AvailabilityBlock(models.Model):
         constraints = [
             models.CheckConstraint(check=models.Q(start_time__lt=models.F('end_time')), name='availability_start_before_end')
         ]
+        indexes = [
+            # Horario laboral de un staff en un rango de fechas (motor de slots)
+            models.Index(fields=['staff_member', 'start_time'], name='avail_staff_start_idx'),
+        ]
         ordering = ['start_time']
+# -----------------------------------------------------------------------------
+# Modelo de Disponibilidad RECURRENTE
+# Una regla semanal reemplaza a los cientos de AvailabilityBlock que antes se
+# materializaban (uno por día durante un año). Se expande solo para las fechas pedidas.
+# -----------------------------------------------------------------------------
+class AvailabilityRule(models.Model):
+    """
+    Horario laboral que se repite cada semana en un día concreto (ej: Lunes 09:00 - 13:00),
+    vigente entre valid_from y valid_until (o sin fin), salvo las fechas excluidas.
+    Las horas se interpretan en la zona horaria del sistema, igual que AvailabilityBlock.
+    """
+    WEEKDAY_CHOICES = [
+        (0, 'Lunes'),
+        (1, 'Martes'),
+        (2, 'Miércoles'),
+        (3, 'Jueves'),
+        (4, 'Viernes'),
+        (5, 'Sábado'),
+        (6, 'Domingo'),
+    ]
+    staff_member = models.ForeignKey(StaffMember, on_delete=models.CASCADE, related_name='availability_rules')
+    weekday = models.PositiveSmallIntegerField(choices=WEEKDAY_CHOICES, help_text="Día de la semana (0=Lunes, 6=Domingo).")
+    start_time = models.TimeField()
+    end_time = models.TimeField()
+    valid_from = models.DateField(help_text="Primer día en que aplica la regla.")
+    valid_until = models.DateField(null=True, blank=True, help_text="Último día en que aplica la regla (vacío = sin fecha de fin).")
+    excluded_dates = models.JSONField(
+        default=list,
+        blank=True,
+        help_text="Fechas (YYYY-MM-DD) en las que la regla NO aplica (feriados, ausencias puntuales)."
+    )
+    staff_can_edit = models.BooleanField(
+        default=True,
+        help_text="Permite que el miembro del staff (si tiene login) modifique o elimine este horario."
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        until = self.valid_until.strftime('%Y-%m-%d') if self.valid_until else 'sin fin'
+        return f"{self.staff_member.name} | {self.get_weekday_display()} {self.start_time.strftime('%H:%M')} - {self.end_time.strftime('%H:%M')} ({self.valid_from.strftime('%Y-%m-%d')} → {until})"
+
+    def occurrences(self, start_date, end_date):
+        """
+        Expande la regla SOLO para el rango pedido.
+        Devuelve una lista de (fecha, inicio, fin) con datetimes "aware".
+        """
+        first_day = max(start_date, self.valid_from)
+        last_day = min(end_date, self.valid_until) if self.valid_until else end_date
+        if first_day > last_day:
+            return []
+
+        excluded = set(self.excluded_dates or [])
+        # Primer día del rango que cae en el día de la semana de la regla
+        day = first_day + timedelta(days=(self.weekday - first_day.weekday()) % 7)
+        result = []
+        while day <= last_day:
+            if day.isoformat() not in excluded:
+                result.append((
+                    day,
+                    timezone.make_aware(datetime.combine(day, self.start_time)),
+                    timezone.make_aware(datetime.combine(day, self.end_time)),
+                ))
+            day += timedelta(days=7)
+        return result
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(check=models.Q(start_time__lt=models.F('end_time')), name='availability_rule_start_before_end')
+        ]
+        ordering = ['weekday', 'start_time']
+
+
 # -----------------------------------------------------------------------------
 # Modelo para la Cita
 # CAMBIO: Ahora se relaciona con 'StaffMember' y 'Business'.
 # -----------------------------------------------------------------------------
-class Appointment(models.Model):
+class Appointment(ScheduleSnapshotMixin, models.Model):
     STATUS_CHOICES = [
         ('SCHEDULED', 'Agendada'),
         ('COMPLETED', 'Completada'),
@@ -52,10 +166,95 @@ class Appointment(models.Model):
     end_time = models.DateTimeField()
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='SCHEDULED')
     created_at = models.DateTimeField(auto_now_add=True)
+    # Marca de modificación: el calendario la usa para enviar solo los cambios (sync token)
+    updated_at = models.DateTimeField(auto_now=True)
+    # Clave única emitida con el formulario de confirmación: un reenvío (doble clic,
+    # reintento del móvil) encuentra esta cita en lugar de crear otra.
+    idempotency_key = models.CharField(max_length=64, null=True, blank=True, unique=True, editable=False)
+    # Cuándo se encoló el recordatorio por WhatsApp (None = pendiente). Ver CoreApps/main/reminders.py
+    reminder_sent_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # Deltas del calendario: "citas de este negocio/staff cambiadas desde X"
+            models.Index(fields=['business', 'updated_at'], name='appt_business_updated_idx'),
+            models.Index(fields=['staff_member', 'updated_at'], name='appt_staff_updated_idx'),
+            # Citas de un staff en un rango (motor de slots y anti-choque: start_time__lt / end_time__gt)
+            models.Index(fields=['staff_member', 'start_time', 'end_time'], name='appt_staff_start_end_idx'),
+            # Dashboard y calendario del negocio: negocio + rango de fechas (+ estado)
+            models.Index(fields=['business', 'start_time', 'status'], name='appt_business_start_status_idx'),
+            # Recordatorios: índice parcial solo con las citas agendadas aún sin recordar,
+            # así cada pasada del worker lee un rango pequeño y nunca la tabla completa
+            models.Index(
+                fields=['start_time'], name='appt_reminder_due_idx',
+                condition=models.Q(status='SCHEDULED', reminder_sent_at__isnull=True)
+            ),
+        ]
 
     def __str__(self):
         return f"Cita de {self.customer} con {self.staff_member.name} a las {self.start_time}"
     
+    # Estados que ocupan tiempo del staff: la misma regla para el motor de slots, las reservas
+    # temporales y la verificación de choques (ver blocking_appointments)
+    BLOCKING_STATUSES = ('SCHEDULED',)
+
+    # Campos que definen el "horario" de la cita: si ninguno cambia, no puede aparecer un choque nuevo
+    # (el snapshot de carga lo guarda ScheduleSnapshotMixin; ver needs_conflict_check).
+    # service_id va al final: no afecta los choques, pero sí el aporte al resumen diario (metrics.py)
+    SCHEDULE_FIELDS = ('staff_member_id', 'start_time', 'end_time', 'status', 'service_id')
+
+    def needs_conflict_check(self):
+        """
+        True si hay que buscar choques: cita nueva, cambio de staff u horario, o una cita
+        cancelada/completada que vuelve a 'SCHEDULED'. Un cambio SOLO de estado hacia
+        COMPLETED/CANCELED (ej: api_update_appointment_status) no puede crear un choque.
+        """
+        loaded = getattr(self, '_loaded_schedule', None)
+        if self._state.adding or loaded is None:
+            return True
+        staff_member_id, start_time, end_time, status = loaded[:4]
+        if (staff_member_id, start_time, end_time) != (self.staff_member_id, self.start_time, self.end_time):
+            return True
+        return status != 'SCHEDULED' and self.status == 'SCHEDULED'
+
+    @classmethod
+    def blocking_appointments(cls):
+        """ Citas que bloquean tiempo del staff (las canceladas o completadas no lo ocupan). """
+        return cls.objects.filter(status__in=cls.BLOCKING_STATUSES)
+
+    @staticmethod
+    def _conflicts_query(staff_member_ids, start_time, end_time, exclude_pks=()):
+        """
+        UNA consulta (UNION ALL) con las citas agendadas y los bloqueos de tiempo que se cruzan
+        con [start_time, end_time) para los staff indicados.
+        Filas: (tipo, staff_member_id, inicio, fin, motivo); tipo 0 = cita, 1 = bloqueo.
+        """
+        appointments = Appointment.blocking_appointments().filter(
+            staff_member_id__in=staff_member_ids,
+            start_time__lt=end_time, # La otra cita empieza antes de que esta termine
+            end_time__gt=start_time  # La otra cita termina después de que esta empiece
+        ).exclude(pk__in=[pk for pk in exclude_pks if pk]).annotate(
+            kind=models.Value(0), conflict_reason=models.Value('', output_field=models.CharField())
+        ).values_list('kind', 'staff_member_id', 'start_time', 'end_time', 'conflict_reason').order_by()
+        time_offs = TimeOffBlock.objects.filter(
+            staff_member_id__in=staff_member_ids,
+            start_time__lt=end_time,
+            end_time__gt=start_time
+        ).annotate(
+            kind=models.Value(1), conflict_reason=Coalesce('reason', models.Value(''), output_field=models.CharField())
+        ).values_list('kind', 'staff_member_id', 'start_time', 'end_time', 'conflict_reason').order_by()
+        return appointments.union(time_offs, all=True)
+
+    def _conflict_error(self, kind, reason, staff_name=None):
+        staff_name = staff_name or self.staff_member.name
+        if kind == 0:
+            return ValidationError({
+                'start_time': f"El personal {staff_name} ya tiene otra cita agendada en este horario."
+            })
+        return ValidationError({
+            'start_time': f"El personal {staff_name} no está disponible ({reason or 'tiempo reservado'})."
+        })
+
     def clean(self):
         # 1. Validación básica: Inicio debe ser antes que Fin
         if self.start_time and self.end_time and self.start_time >= self.end_time:
@@ -63,54 +262,96 @@ class Appointment(models.Model):
                 'end_time': "La hora de finalización debe ser posterior a la hora de inicio."
             })
 
-        # 2. ANTI-CHOQUE DE CITAS
-        # Buscamos si existe alguna cita del MISMO staff que se solape.
-        # Un solapamiento ocurre si: (InicioA < FinB) Y (FinA > InicioB)
-        conflicting_appointments = Appointment.objects.filter(
-            staff_member=self.staff_member,
-            status='SCHEDULED',  # Ignoramos las canceladas, esas no ocupan tiempo real
-            start_time__lt=self.end_time, # La otra cita empieza antes de que esta termine
-            end_time__gt=self.start_time  # La otra cita termina después de que esta empiece
-        )
-
-        # Si estamos EDITANDO una cita existente (self.pk existe), 
-        # debemos excluirnos a nosotros mismos de la búsqueda para no chocar con nuestra propia sombra.
-        if self.pk:
-            conflicting_appointments = conflicting_appointments.exclude(pk=self.pk)
-
-        if conflicting_appointments.exists():
-            raise ValidationError({
-                'start_time': f"El personal {self.staff_member.name} ya tiene otra cita agendada en este horario."
-            })
+        # Si solo cambió el estado (ej: COMPLETED), el horario ya fue validado al guardarlo
+        if not self.needs_conflict_check():
+            return
 
-        # 3. ANTI-CHOQUE CON TIEMPO LIBRE (TimeOffBlock)
-        # Verificamos que no se intente agendar sobre un almuerzo o permiso
-        # Nota: TimeOffBlock debe estar importado o definido en este archivo.
-        # Como TimeOffBlock está definido ABAJO en tu archivo, Django lo resolverá en tiempo de ejecución,
-        # pero para estar 100% seguros, usaremos una importación interna o moveremos la clase TimeOffBlock arriba.
-        # Asumimos que está en el mismo archivo:
-        
-        # Buscamos bloqueos que se solapen
-        conflicting_timeoffs = TimeOffBlock.objects.filter(
-            staff_member=self.staff_member,
-            start_time__lt=self.end_time,
-            end_time__gt=self.start_time
-        )
-
-        if conflicting_timeoffs.exists():
-            reason = conflicting_timeoffs.first().reason or "tiempo reservado"
-            raise ValidationError({
-                'start_time': f"El personal {self.staff_member.name} no está disponible ({reason})."
-            })
+        # 2. ANTI-CHOQUE DE CITAS y 3. ANTI-CHOQUE CON TIEMPO LIBRE (TimeOffBlock)
+        # Un solapamiento ocurre si: (InicioA < FinB) Y (FinA > InicioB).
+        # Ambas búsquedas van en una sola consulta; las citas tienen prioridad en el mensaje.
+        # Si estamos EDITANDO una cita existente, nos excluimos para no chocar con nuestra propia sombra.
+        conflict = self._conflicts_query(
+            [self.staff_member_id], self.start_time, self.end_time, exclude_pks=[self.pk]
+        ).order_by('kind')[:1]
+        for kind, _, _, _, reason in conflict:
+            raise self._conflict_error(kind, reason)
 
     def save(self, *args, **kwargs):
         # Forzamos la ejecución de clean() antes de guardar.
         # Esto asegura que la validación corra incluso si creas citas desde la consola o API, no solo desde Admin.
         self.clean()
+        # Una cita reprogramada vuelve a necesitar su recordatorio
+        loaded = getattr(self, '_loaded_schedule', None)
+        if loaded and loaded[1] != self.start_time and kwargs.get('update_fields') is None:
+            self.reminder_sent_at = None
         super().save(*args, **kwargs)
 
+    @classmethod
+    def find_conflicts(cls, appointments):
+        """
+        Validación EN LOTE para importaciones o reprogramaciones masivas (ej: antes de bulk_create,
+        que no llama a save/clean). Busca choques de todas las citas con UNA sola consulta y
+        también entre las propias citas del lote (en orden: la primera gana).
+        Devuelve {índice en la lista: ValidationError} solo para las citas con choque.
+        """
+        appointments = list(appointments)
+        errors = {}
+        to_check = []
+        for index, appointment in enumerate(appointments):
+            if appointment.start_time >= appointment.end_time:
+                errors[index] = ValidationError({
+                    'end_time': "La hora de finalización debe ser posterior a la hora de inicio."
+                })
+            elif appointment.needs_conflict_check():
+                to_check.append(index)
+        if not to_check:
+            return errors
+
+        # 1. Citas y bloqueos existentes en la ventana que cubre todo el lote (una consulta)
+        existing = {}
+        for kind, staff_member_id, start_time, end_time, reason in cls._conflicts_query(
+            {appointments[index].staff_member_id for index in to_check},
+            min(appointments[index].start_time for index in to_check),
+            max(appointments[index].end_time for index in to_check),
+            # Las citas del lote se validan con su horario NUEVO, no con el guardado
+            exclude_pks=[appointment.pk for appointment in appointments]
+        ):
+            existing.setdefault(staff_member_id, []).append((start_time, end_time, kind, reason))
+        for intervals in existing.values():
+            intervals.sort(key=lambda item: (item[2], item[0])) # Citas primero (prioridad del mensaje)
+
+        # 2. Recorrido en memoria: contra lo existente y contra las citas ya aceptadas del lote
+        accepted = {}
+        conflicts = {}
+        for index in to_check:
+            appointment = appointments[index]
+            staff_member_id = appointment.staff_member_id
+            found = next((
+                (kind, reason) for start_time, end_time, kind, reason in existing.get(staff_member_id, [])
+                if start_time < appointment.end_time and end_time > appointment.start_time
+            ), None)
+            if found is None and any(
+                start_time < appointment.end_time and end_time > appointment.start_time
+                for start_time, end_time in accepted.get(staff_member_id, [])
+            ):
+                found = (0, '')
+            if found is not None:
+                conflicts[index] = found
+            elif appointment.status == 'SCHEDULED':
+                accepted.setdefault(staff_member_id, []).append((appointment.start_time, appointment.end_time))
+
+        # 3. Mensajes (una consulta más solo si hubo choques, para los nombres del personal)
+        if conflicts:
+            staff_names = dict(StaffMember.objects.filter(
+                pk__in={appointments[index].staff_member_id for index in conflicts}
+            ).values_list('pk', 'name'))
+            for index, (kind, reason) in conflicts.items():
+                appointment = appointments[index]
+                errors[index] = appointment._conflict_error(kind, reason, staff_names.get(appointment.staff_member_id))
+        return dict(sorted(errors.items()))
+
 
-class TimeOffBlock(models.Model):
+class TimeOffBlock(ScheduleSnapshotMixin, models.Model):
     """
     Define un bloque de tiempo específico en el que un StaffMember NO está disponible,
     incluso si cae dentro de su AvailabilityBlock (horario laboral).
@@ -120,6 +361,7 @@ class TimeOffBlock(models.Model):
     start_time = models.DateTimeField()
     end_time = models.DateTimeField()
     reason = models.CharField(max_length=150, blank=True, null=True, help_text="Motivo del bloqueo (opcional)")
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f"Bloqueo para {self.staff_member.name} | {self.start_time.strftime('%Y-%m-%d %H:%M')} - {self.end_time.strftime('%H:%M')}"
@@ -129,4 +371,34 @@ class TimeOffBlock(models.Model):
         constraints = [
             models.CheckConstraint(check=models.Q(start_time__lt=models.F('end_time')), name='timeoff_start_before_end')
         ]
-        ordering = ['start_time']
\ No newline at end of file
+        indexes = [
+            # Bloqueos de un staff en un rango de fechas (motor de slots y anti-choque)
+            models.Index(fields=['staff_member', 'start_time'], name='timeoff_staff_start_idx'),
+        ]
+        ordering = ['start_time']
+
+class SlotHold(ScheduleSnapshotMixin, models.Model):
+    """
+    Reserva TEMPORAL de un horario mientras el cliente completa el formulario de confirmación.
+    Mientras no vence (expires_at), el motor de slots la trata como un bloqueo más.
+    Las vencidas simplemente se ignoran y se borran de forma perezosa.
+    """
+    staff_member = models.ForeignKey(StaffMember, on_delete=models.CASCADE, related_name='slot_holds')
+    start_time = models.DateTimeField()
+    end_time = models.DateTimeField()
+    # Quién retiene el horario (la clave de sesión del navegador)
+    holder = models.CharField(max_length=64, db_index=True)
+    expires_at = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Reserva temporal {self.staff_member.name} | {self.start_time.strftime('%Y-%m-%d %H:%M')} (vence {self.expires_at.strftime('%H:%M:%S')})"
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(check=models.Q(start_time__lt=models.F('end_time')), name='slothold_start_before_end')
+        ]
+        indexes = [
+            models.Index(fields=['staff_member', 'start_time'], name='slothold_staff_start_idx'),
+        ]
+        ordering = ['start_time']
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.25 on 2026-10-18 10:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0008_alter_customer_unique_together_customer_notes_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='phone_number_normalized',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=16),
+        ),
+    ]
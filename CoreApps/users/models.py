@@ -5,6 +5,7 @@ from django.contrib.auth.models import AbstractUser
 from datetime import timedelta
 from django.utils.text import slugify
 from django.templatetags.static import static
+from .phone import normalize_phone_number
 
 # -----------------------------------------------------------------------------
 # Modelo #1: El Usuario Base para Autenticación (SIN CAMBIOS)
@@ -18,12 +19,33 @@ class User(AbstractUser):
         help_text="Foto de perfil del usuario."
     )
     phone_number = models.CharField(max_length=20, blank=True, help_text="Número de teléfono del usuario.")
+    # phone_number ya formateado para WhatsApp (+5939XXXXXXXX); vacío si no se pudo formatear.
+    # Se mantiene al guardar; para filas viejas o cargas masivas: 'manage.py backfill_phone_numbers'
+    phone_number_normalized = models.CharField(max_length=16, blank=True, db_index=True, editable=False)
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username', 'first_name', 'last_name']
 
     def __str__(self):
         return self.email
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Teléfono tal como está en la base: solo se vuelve a normalizar si cambia
+        instance._loaded_phone_number = instance.__dict__.get('phone_number')
+        return instance
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        phone_changed = self._state.adding or self.phone_number != getattr(self, '_loaded_phone_number', None)
+        # Los guardados que no incluyen el teléfono (ej: last_login al iniciar sesión) no lo tocan
+        if phone_changed and (update_fields is None or 'phone_number' in update_fields):
+            self.phone_number_normalized = normalize_phone_number(self.phone_number) or ''
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | {'phone_number_normalized'}
+        super().save(*args, **kwargs)
+        self._loaded_phone_number = self.phone_number
+
 # planes y suscripciones
 class Plan(models.Model):
     name = models.CharField(max_length=50, unique=True, help_text="Nombre del plan (Ej: Básico, Profesional)")
@@ -0,0 +1,59 @@
+# CoreApps/users/phone.py
+
+import logging
+import re
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+_NON_PHONE_CHARS = re.compile(r'[^\d+]')
+# Un número ya normalizado (ej: User.phone_number_normalized)
+NORMALIZED_PHONE_NUMBER = re.compile(r'\+5939\d{8}')
+
+
+@lru_cache(maxsize=65536)
+def _normalize(phone_number):
+    cleaned_number = _NON_PHONE_CHARS.sub('', phone_number)
+    cleaned_number = cleaned_number.split('@')[0]
+    if cleaned_number.startswith('+5939') and len(cleaned_number) == 13:
+        return cleaned_number # Ya está correcto
+    elif cleaned_number.startswith('5939') and len(cleaned_number) == 12:
+        return '+' + cleaned_number # Añadir '+'
+    elif cleaned_number.startswith('09') and len(cleaned_number) == 10:
+        return '+593' + cleaned_number[1:] # Reemplazar '0' con '+593'
+    elif cleaned_number.startswith('9') and len(cleaned_number) == 9:
+         return '+593' + cleaned_number # Añadir '+593'
+    else: # Intenta añadir '+' si parece internacional pero falta
+         if len(cleaned_number) == 12 and cleaned_number.startswith('593'):
+             return '+' + cleaned_number
+    return None
+
+
+def normalize_phone_number(phone_number):
+    """
+    Número en el formato internacional CON '+' que usa WhatsApp (ej: +5939XXXXXXXX),
+    o None si viene vacío o no se puede formatear. Sin logs; memoizado: en un envío masivo
+    los mismos números se repiten mucho (un cliente en varios negocios, varias citas).
+    """
+    if not phone_number:
+        return None
+    return _normalize(str(phone_number))
+
+
+def normalize_phone_numbers(phone_numbers):
+    """
+    Versión en lote para envíos masivos y backfills.
+    Devuelve (normalizados, rechazados): dos listas alineadas con la entrada; 'rechazados[i]'
+    es True si el número i venía con datos pero no se pudo formatear (los vacíos dan None
+    sin contar como rechazo). Un solo aviso en el log para todo el lote.
+    """
+    normalized = []
+    rejected = []
+    for phone_number in phone_numbers:
+        formatted = normalize_phone_number(phone_number)
+        normalized.append(formatted)
+        rejected.append(formatted is None and bool(phone_number))
+    rejected_count = sum(rejected)
+    if rejected_count:
+        logger.warning(f"{rejected_count} de {len(normalized)} números no pudieron ser formateados a +593...")
+    return normalized, rejected
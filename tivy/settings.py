@@ -204,6 +204,34 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 STATICFILES_DIRS = [os.path.join(BASE_DIR, 'static')]
 
 
+# Caché (listas de slots de disponibilidad, etc.)
+# Por defecto en memoria local; con varios procesos/servidores usar un backend compartido
+# (ej: CACHE_BACKEND=django.core.cache.backends.redis.RedisCache, CACHE_LOCATION=redis://...)
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', 'tivy-default'),
+    }
+}
+# Segundos que vive una lista de slots en caché (la invalidación real es por señales)
+SLOTS_CACHE_TIMEOUT = 60 * 60
+# Segundos que un horario queda retenido mientras el cliente confirma la reserva
+SLOT_HOLD_TTL = 5 * 60
+# Segundos que se reutilizan los KPIs y gráficos del dashboard (se invalidan al cambiar citas)
+DASHBOARD_CACHE_TIMEOUT = 60
+# KPIs del dashboard desde el resumen diario (BusinessDailyMetrics) en vez de las citas
+DASHBOARD_USE_DAILY_ROLLUP = False
+# Perfil público por slug: segundos "fresco", margen en que se sirve viejo mientras se regenera,
+# y max-age para navegadores/proxies (solo visitantes anónimos)
+PUBLIC_PROFILE_CACHE_TIMEOUT = 5 * 60
+PUBLIC_PROFILE_STALE_TIMEOUT = 60 * 60
+PUBLIC_PROFILE_MAX_AGE = 60
+# Segundos que se reutilizan los permisos del plan de cada negocio (se invalidan por señales)
+ENTITLEMENTS_CACHE_TIMEOUT = 10 * 60
+# Fidelidad: puntos por cada dólar del servicio de una cita completada y niveles (umbral, nombre)
+LOYALTY_POINTS_PER_UNIT = 1
+LOYALTY_TIERS = [(300, 'Oro'), (100, 'Plata'), (0, 'Bronce')]
+
 # Al final de settings.py
 LOGIN_URL = '/login/'
 LOGIN_REDIRECT_URL = '/dashboard/'
@@ -212,5 +240,20 @@ LOGIN_REDIRECT_URL = '/dashboard/'
 # WASenderAPI Configuration
 WASENDERAPI_API_KEY = os.getenv('WASENDERAPI_API_KEY')
 WASENDERAPI_BASE_URL = os.getenv('WASENDERAPI_BASE_URL')
+# Endpoint de envío de mensajes (se puede apuntar a un servidor de pruebas)
+WASENDERAPI_SEND_URL = os.getenv('WASENDERAPI_SEND_URL', 'https://wasenderapi.com/api/send-message')
+# Segundos máximos de espera por respuesta de la API (el envío lo hace el worker del outbox, no la vista)
+WASENDERAPI_TIMEOUT = 20
+# Conexiones keep-alive abiertas con la API (y hilos del envío en lote)
+WASENDERAPI_POOL_SIZE = 10
+# Límite de ritmo del proveedor: mensajes por segundo y ráfaga máxima
+WASENDERAPI_RATE_PER_SECOND = 10
+WASENDERAPI_BURST = 10
+# Outbox de mensajes (comando drain_outbox): intentos máximos y espera entre reintentos en segundos
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_BACKOFF_BASE = 30
+OUTBOX_BACKOFF_MAX = 60 * 60
+# Recordatorios por WhatsApp (comando send_reminders): horas de anticipación
+APPOINTMENT_REMINDER_LEAD_HOURS = 24
 print(f"WASenderAPI Key loaded: {WASENDERAPI_API_KEY is not None and len(WASENDERAPI_API_KEY) > 0}")
 print(f"WASenderAPI Base URL loaded: {WASENDERAPI_BASE_URL}")